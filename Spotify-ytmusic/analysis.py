@@ -0,0 +1,175 @@
+import numpy as np
+from collections import Counter
+
+# Value used for tracks whose audio features are unavailable
+NEUTRAL = 0.5
+# Percentiles reported for energy and valence
+PERCENTILES = (10, 25, 50, 75, 90)
+# Number of tracks averaged by each point of the rolling curves
+ROLLING_WINDOW = 10
+# Number of genres returned
+TOP_GENRES = 5
+
+
+def mood_label(avg_energy, avg_valence):
+    """
+    Maps average energy and valence to a human-readable mood.
+    """
+    if avg_energy > 0.65:
+        return "Exuberant / Pumped" if avg_valence > 0.6 else "Intense / Aggressive"
+    if avg_energy < 0.35:
+        return "Peaceful / Calm" if avg_valence > 0.6 else "Melancholic / Sad"
+    if avg_valence > 0.6:
+        return "Happy / Chill"
+    if avg_valence < 0.4:
+        return "Moody / Dark"
+    return "Balanced / Focused"
+
+
+def rolling_mean(values, window=ROLLING_WINDOW):
+    """
+    Moving average over `window` tracks, shorter at the start of the
+    playlist, so the curve has one point per track.
+    """
+    if len(values) == 0:
+        return values
+    cumsum = np.cumsum(np.insert(values, 0, 0.0))
+    ends = np.arange(1, len(values) + 1)
+    starts = np.maximum(ends - window, 0)
+    return (cumsum[ends] - cumsum[starts]) / (ends - starts)
+
+
+class PlaylistStats:
+    """
+    Running aggregates for one snapshot of a playlist.
+
+    Averages and genre counts are kept as running sums, so moving to a new
+    snapshot with update() only touches the tracks that were added or
+    removed. Curves and percentiles depend on track order and are rebuilt
+    from the per-track features in one vectorized pass by result().
+
+    Instances are never modified after creation; update() returns a new
+    one, so a cached instance can be shared between requests.
+    """
+    def __init__(self):
+        self.track_ids = [] # in playlist order; may contain duplicates
+        self.features = {} # track ID -> {'energy', 'valence'} or None
+        self.track_artists = {} # track ID -> artist IDs
+        self.artist_genres = {} # artist ID -> genres
+        self.artist_refs = Counter() # artist ID -> number of playlist tracks by them
+        self.genre_counts = Counter() # genre -> number of the playlist's artists tagged with it
+        self.energy_sum = 0.0
+        self.valence_sum = 0.0
+        self.known_count = 0 # tracks with features
+
+    def diff(self, track_ids):
+        """
+        Returns (added, removed) Counters of track IDs between this
+        snapshot and a playlist with the given tracks.
+        """
+        old, new = Counter(self.track_ids), Counter(track_ids)
+        return new - old, old - new
+
+    def update(self, tracks, features, artist_genres):
+        """
+        Returns the stats for a new snapshot of the playlist.
+
+        tracks: the new snapshot's (track ID, artist IDs) pairs, in order.
+        features, artist_genres: lookups covering at least the tracks and
+        artists that are new compared to this snapshot.
+        """
+        track_ids = [track_id for track_id, _ in tracks]
+        added, removed = self.diff(track_ids)
+
+        stats = PlaylistStats()
+        stats.track_ids = track_ids
+        stats.features = dict(self.features)
+        stats.track_artists = dict(self.track_artists)
+        stats.artist_genres = dict(self.artist_genres)
+        stats.artist_refs = Counter(self.artist_refs)
+        stats.genre_counts = Counter(self.genre_counts)
+        stats.energy_sum = self.energy_sum
+        stats.valence_sum = self.valence_sum
+        stats.known_count = self.known_count
+
+        # Additions first, so an artist whose old tracks were swapped for
+        # new ones keeps the genres we already know
+        new_artists = dict(tracks)
+        for track_id, count in added.items():
+            stats._add_track(track_id, count, features.get(track_id), new_artists[track_id], artist_genres)
+
+        remaining = set(track_ids)
+        for track_id, count in removed.items():
+            stats._remove_track(track_id, count)
+            if track_id not in remaining:
+                stats.features.pop(track_id, None)
+                stats.track_artists.pop(track_id, None)
+        stats.genre_counts = +stats.genre_counts # Drop genres no artist has any more
+        return stats
+
+    def _add_track(self, track_id, count, f, artist_ids, artist_genres):
+        self.features[track_id] = f
+        self.track_artists[track_id] = artist_ids
+        if f:
+            self.energy_sum += f['energy'] * count
+            self.valence_sum += f['valence'] * count
+            self.known_count += count
+        for artist_id in artist_ids:
+            if self.artist_refs[artist_id] == 0:
+                self.artist_genres[artist_id] = artist_genres.get(artist_id, [])
+                self.genre_counts.update(self.artist_genres[artist_id])
+            self.artist_refs[artist_id] += count
+
+    def _remove_track(self, track_id, count):
+        f = self.features.get(track_id)
+        if f:
+            self.energy_sum -= f['energy'] * count
+            self.valence_sum -= f['valence'] * count
+            self.known_count -= count
+        for artist_id in self.track_artists.get(track_id, []):
+            self.artist_refs[artist_id] -= count
+            if self.artist_refs[artist_id] <= 0:
+                del self.artist_refs[artist_id]
+                self.genre_counts.subtract(self.artist_genres.pop(artist_id, []))
+
+    def result(self):
+        """
+        Builds the /analyze response.
+        """
+        features = [self.features.get(track_id) for track_id in self.track_ids]
+        energy = np.array([f['energy'] if f else np.nan for f in features], dtype=float)
+        valence = np.array([f['valence'] if f else np.nan for f in features], dtype=float)
+        known = ~np.isnan(energy)
+
+        if self.known_count > 0:
+            avg_energy = self.energy_sum / self.known_count
+            avg_valence = self.valence_sum / self.known_count
+            track_count = self.known_count
+            energy_pct = np.percentile(energy[known], PERCENTILES)
+            valence_pct = np.percentile(valence[known], PERCENTILES)
+        else:
+            # No features at all (e.g. restricted API access): report a neutral
+            # playlist so the visualization does not break
+            avg_energy = avg_valence = NEUTRAL
+            track_count = len(features)
+            energy_pct = valence_pct = np.full(len(PERCENTILES), NEUTRAL)
+
+        # Tracks without features are drawn at the neutral level
+        energy = np.where(known, energy, NEUTRAL)
+        valence = np.where(known, valence, NEUTRAL)
+
+        return {
+            "mood_label": mood_label(avg_energy, avg_valence),
+            "avg_energy": round(avg_energy, 2),
+            "avg_valence": round(avg_valence, 2),
+            "energy_curve": np.round(energy, 2).tolist(),
+            "valence_curve": np.round(valence, 2).tolist(),
+            "energy_rolling": np.round(rolling_mean(energy), 3).tolist(),
+            "valence_rolling": np.round(rolling_mean(valence), 3).tolist(),
+            "percentiles": {
+                "energy": {f"p{p}": round(float(v), 3) for p, v in zip(PERCENTILES, energy_pct)},
+                "valence": {f"p{p}": round(float(v), 3) for p, v in zip(PERCENTILES, valence_pct)},
+            },
+            "genres": dict(self.genre_counts.most_common(TOP_GENRES)),
+            "track_count": track_count,
+        }
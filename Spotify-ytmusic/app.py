@@ -1,15 +1,47 @@
-from flask import Flask, render_template, request, redirect, session, url_for, Response, stream_with_context, jsonify
+from flask import Flask, render_template, request, redirect, session, url_for, Response, jsonify
 import os
 import json
 import time
+import uuid
+import socket
+import itertools
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
+from spotipy.cache_handler import MemoryCacheHandler
 from spotify_service import SpotifyService
 from ytmusic_service import YTMusicService
+from match_cache import MatchCache
+from matching import MATCHER_VERSION
+from conversion_jobs import ConversionJobStore, JobLost, FINISHED_STATUSES, public_job
 
 load_dotenv()
 
 app = Flask(__name__)
-app.secret_key = os.urandom(24)
+
+def load_secret_key():
+    """
+    Returns the session signing key.
+    All server processes must share it, otherwise a session created by one
+    process is rejected by the next, so a random key is generated once and
+    kept in a local file unless SECRET_KEY is set.
+    """
+    env_key = os.getenv('SECRET_KEY')
+    if env_key:
+        return env_key
+    key_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.flask_secret')
+    try:
+        # O_EXCL: only the first process to start creates the key
+        fd = os.open(key_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(os.urandom(24))
+    except FileExistsError:
+        pass
+    with open(key_path, 'rb') as f:
+        return f.read()
+
+app.secret_key = load_secret_key()
 
 # Initialize Services
 spotify_service = SpotifyService()
@@ -17,6 +49,36 @@ spotify_service = SpotifyService()
 # but for now let's assume oauth.json is there or will be handled.
 yt_service = YTMusicService()
 
+# Number of YouTube Music searches a conversion runs at the same time.
+# The overall request rate is capped by yt_service.limiter, not by this.
+MATCH_WORKERS = int(os.getenv('MATCH_WORKERS', '8'))
+
+# Spotify track -> YouTube Music video matches, shared by all users and processes
+match_cache = MatchCache(
+    os.getenv('MATCH_CACHE_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'match_cache.sqlite3')),
+    ttl=int(os.getenv('MATCH_CACHE_TTL', str(30 * 24 * 3600))),
+    negative_ttl=int(os.getenv('MATCH_CACHE_NEGATIVE_TTL', str(24 * 3600))),
+    version=MATCHER_VERSION,
+)
+match_cache.expire()
+
+# Conversions run as background jobs persisted here, so they survive the
+# browser going away and are resumed after a restart
+conversion_jobs = ConversionJobStore(
+    os.getenv('CONVERSION_JOBS_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'conversion_jobs.sqlite3')),
+    stale_after=int(os.getenv('CONVERSION_JOB_STALE_AFTER', '60')),
+)
+# Conversions one server process runs at the same time
+CONVERSION_WORKERS = int(os.getenv('CONVERSION_WORKERS', '2'))
+# Finished jobs are deleted after this many seconds
+JOB_TTL = int(os.getenv('CONVERSION_JOB_TTL', str(7 * 24 * 3600)))
+JOB_HEARTBEAT_INTERVAL = 5
+# Identifies this process as the owner of the jobs it runs
+JOB_OWNER = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+running_jobs = set()
+running_jobs_lock = threading.Lock()
+job_wakeup = threading.Event()
+
 @app.route('/')
 def index():
     # Check if user is logged in to Spotify
@@ -116,78 +178,300 @@ def logout():
 def docs():
     return render_template('docs.html')
 
-@app.route('/convert', methods=['POST'])
-def convert():
-    token_info = session.get('token_info')
-    if not token_info:
-        return json.dumps({'error': 'Not authenticated with Spotify'}), 401
+def match_track(track):
+    """
+    Returns the YouTube Music match for a Spotify track (a dict with at
+    least 'videoId'), or None if there is none. Checks the match cache
+    first and stores what a search finds, including "no match". Searches
+    that fail with an error are not cached.
+    """
+    found, match = match_cache.get(track.get('id'), track.get('isrc'))
+    if found:
+        return match
+    try:
+        match = yt_service.search_song(f"{track['name']} {track['artist']}", track=track, raise_errors=True)
+    except Exception as e:
+        print(f"Error searching for '{track['name']}': {e}")
+        return None
+    match_cache.put(track.get('id'), track.get('isrc'), match)
+    return match
 
-    playlist_url = request.form.get('playlist_url')
-    if not playlist_url:
-        return json.dumps({'error': 'No playlist URL provided'}), 400
+def match_tracks(tracks):
+    """
+    Matches every track (see match_track) using a pool of MATCH_WORKERS
+    threads and yields (track, match) in playlist order.
+    At most a few searches per worker run ahead of the consumer, so a
+    client that disconnects does not leave thousands of searches queued.
+    """
+    executor = ThreadPoolExecutor(max_workers=MATCH_WORKERS, thread_name_prefix='match')
+    pending = deque()
+    track_iter = iter(tracks)
 
-    def generate():
-        try:
-            yield f"data: {json.dumps({'status': 'Fetching Spotify playlist...'})}\n\n"
-            
-            yield f"data: {json.dumps({'status': 'Fetching Spotify playlist...'})}\n\n"
-            
-            # Auth is now handled internally by the service (using Flask Session)
-            # which automatically refreshes the token if needed.
-            playlist_name, tracks = spotify_service.get_playlist_tracks(playlist_url)
-            total_tracks = len(tracks)
-            
-            yield f"data: {json.dumps({'status': 'Playlist fetched', 'total': total_tracks, 'playlist_name': playlist_name})}\n\n"
-
-            yield f"data: {json.dumps({'status': 'Playlist fetched', 'total': total_tracks, 'playlist_name': playlist_name})}\n\n"
-
-            
+    def submit_next():
+        track = next(track_iter, None)
+        if track is not None:
+            pending.append((track, executor.submit(match_track, track)))
+
+    try:
+        for _ in range(MATCH_WORKERS * 4):
+            submit_next()
+        while pending:
+            track, future = pending.popleft()
+            result = future.result()
+            submit_next()
+            yield track, result
+    finally:
+        for _, future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+@app.route('/stats')
+def stats():
+    return jsonify({
+        'match_cache': match_cache.stats(),
+        'ytmusic_rate_limiter': yt_service.limiter.stats(),
+        'audio_features_cache': spotify_service.features_cache.stats(),
+        'artist_genres_cache': spotify_service.genres_cache.stats(),
+        'playlist_analyses': spotify_service.playlist_analyses.stats(),
+    })
+
+def sse(event, event_id=None):
+    prefix = f"id: {event_id}\n" if event_id is not None else ''
+    return f"{prefix}data: {json.dumps(event)}\n\n"
+
+def run_conversion(job):
+    """
+    Runs (or resumes) a conversion job in the background.
+
+    Progress goes to the job store as events for clients to follow. A
+    checkpoint (tracks done, added and skipped counts) is saved whenever
+    every track before it has been written to YouTube Music, and the
+    created playlist's ID is saved as soon as it exists, so a job picked up
+    again after a restart continues from its checkpoint. Tracks already in
+    the playlist are not added twice.
+    """
+    job_id = job['job_id']
+
+    def update(event=None, **fields):
+        conversion_jobs.update(job_id, JOB_OWNER, event=event, **fields)
+
+    try:
+        start = job['checkpoint_index']
+        added_count = job['checkpoint_added']
+        skipped_count = job['checkpoint_skipped']
+
+        if job['tracks_saved']:
+            playlist_name, total_tracks = job['playlist_name'], job['total']
+            tracks = conversion_jobs.iter_tracks(job_id, start)
+        else:
+            update(event={'status': 'Fetching Spotify playlist...'})
+            # The job may run after the request that started it, so it
+            # uses the token saved with the job rather than the session
+            sp = spotify_service.get_spotify_client(MemoryCacheHandler(job['token_info']))
+            if not sp:
+                raise Exception("Session expired. Please login again.")
+            # Tracks arrive page by page; matching starts on the first page
+            # while the following ones are still being fetched
+            playlist_name, total_tracks, fetched = spotify_service.iter_playlist_tracks(job['playlist_url'], sp=sp)
+            update(playlist_name=playlist_name, total=total_tracks)
+            tracks = itertools.islice(save_job_tracks(job_id, fetched), start, None)
+
+        update(event={'status': 'Playlist fetched', 'total': total_tracks, 'playlist_name': playlist_name})
+
+        playlist_id = job['yt_playlist_id']
+        existing = set()
+        if playlist_id:
+            # Resuming: tracks added after the checkpoint are already there
+            existing = yt_service.get_playlist_video_ids(playlist_id)
+        else:
             # Create YT Music Playlist
             yt_playlist_name = f"Spotify – {playlist_name}"
             yt_description = "Converted from Spotify using a free Python tool"
-            
-            yield f"data: {json.dumps({'status': 'Creating YouTube Music playlist...'})}\n\n"
-            
+            update(event={'status': 'Creating YouTube Music playlist...'})
             try:
                 playlist_id = yt_service.create_playlist(yt_playlist_name, yt_description)
             except Exception as e:
-                yield f"data: {json.dumps({'error': f'Failed to create playlist: {str(e)}'})}\n\n"
-                return
+                raise Exception(f'Failed to create playlist: {str(e)}')
+            update(yt_playlist_id=playlist_id)
 
-            added_count = 0
-            skipped_count = 0
-
-            for index, track in enumerate(tracks):
-                track_name = track['name']
-                artist_name = track['artist']
-                query = f"{track_name} {artist_name}"
-                
-                yield f"data: {json.dumps({'status': 'processing', 'current_track': track_name, 'artist': artist_name, 'progress': index + 1, 'total': total_tracks, 'added': added_count, 'skipped': skipped_count})}\n\n"
-                
-                # Search on YT Music
-                search_result = yt_service.search_song(query)
-                
-                if search_result:
-                    video_id = search_result['videoId']
-                    # Optional: Verify duration if needed, but for now we trust the top result
-                    
-                    success = yt_service.add_track_to_playlist(playlist_id, video_id)
-                    if success:
-                        added_count += 1
-                    else:
-                        skipped_count += 1
+        # Matched tracks are written in batches rather than one request each
+        batch = yt_service.playlist_batch(playlist_id, existing=existing)
+        processed_count = start
+
+        def record_writes(results):
+            # Counts the outcome of tracks the batch has written so far
+            # and saves an event for each one that failed
+            nonlocal added_count, skipped_count
+            for written_track, error in results:
+                if error is None:
+                    added_count += 1
                 else:
                     skipped_count += 1
-                
-                # Small delay to be nice to the API
-                time.sleep(0.5)
+                    update(event={'status': f"Could not add {written_track['name']} ({error})"})
+
+        # Searches run concurrently; results come back in playlist order,
+        # so tracks are added in the same order as on Spotify
+        for track, search_result in match_tracks(tracks):
+            processed_count += 1
+            if search_result:
+                record_writes(batch.add(search_result['videoId'], track))
+            else:
+                skipped_count += 1
+            if batch.due():
+                record_writes(batch.flush())
+
+            checkpoint = {}
+            if not batch.pending:
+                # Everything up to here is settled
+                checkpoint = dict(checkpoint_index=processed_count, checkpoint_added=added_count,
+                                  checkpoint_skipped=skipped_count)
+            update(
+                event={'status': 'processing', 'current_track': track['name'], 'artist': track['artist'],
+                       'progress': processed_count, 'total': total_tracks, 'added': added_count,
+                       'skipped': skipped_count},
+                processed=processed_count, added=added_count, skipped=skipped_count, **checkpoint,
+            )
+
+        record_writes(batch.flush())
+        # Local files and unavailable items are never offered for matching
+        skipped_count += max(0, total_tracks - processed_count)
+
+        conversion_jobs.finish(
+            job_id, JOB_OWNER, 'completed',
+            event={'status': 'completed', 'added': added_count, 'skipped': skipped_count, 'playlist_id': playlist_id},
+            processed=processed_count, added=added_count, skipped=skipped_count,
+        )
+
+    except JobLost:
+        print(f"Conversion {job_id} was cancelled or taken over, stopping")
+    except Exception as e:
+        print(f"Conversion {job_id} failed: {e}")
+        try:
+            conversion_jobs.finish(job_id, JOB_OWNER, 'failed', event={'error': str(e)}, error=str(e))
+        except JobLost:
+            pass
+    finally:
+        with running_jobs_lock:
+            running_jobs.discard(job_id)
+        job_wakeup.set()
 
-            yield f"data: {json.dumps({'status': 'completed', 'added': added_count, 'skipped': skipped_count, 'playlist_id': playlist_id})}\n\n"
+def save_job_tracks(job_id, tracks, chunk_size=100):
+    """
+    Passes tracks through while saving them to the job store in chunks,
+    and marks the job's track list complete at the end.
+    """
+    chunk = []
+    saved = 0
+    for track in tracks:
+        chunk.append(track)
+        if len(chunk) >= chunk_size:
+            conversion_jobs.save_tracks(job_id, saved, chunk)
+            saved += len(chunk)
+            chunk = []
+        yield track
+    conversion_jobs.save_tracks(job_id, saved, chunk)
+    conversion_jobs.update(job_id, JOB_OWNER, tracks_saved=1, token_info=None)
 
+def job_scheduler():
+    """
+    Background loop of each server process: claims queued jobs (and jobs
+    whose process died) while fewer than CONVERSION_WORKERS run here,
+    keeps the heartbeat of this process's jobs fresh, and expires old jobs.
+    """
+    last_expiry = 0
+    while True:
+        try:
+            conversion_jobs.heartbeat(JOB_OWNER)
+            while True:
+                with running_jobs_lock:
+                    if len(running_jobs) >= CONVERSION_WORKERS:
+                        break
+                job = conversion_jobs.claim_next(JOB_OWNER)
+                if job is None:
+                    break
+                with running_jobs_lock:
+                    running_jobs.add(job['job_id'])
+                threading.Thread(target=run_conversion, args=(job,), daemon=True,
+                                 name=f"convert-{job['job_id'][:8]}").start()
+            if time.time() - last_expiry > 3600:
+                conversion_jobs.expire(JOB_TTL)
+                last_expiry = time.time()
         except Exception as e:
-            yield f"data: {json.dumps({'error': str(e)})}\n\n"
+            print(f"Conversion job scheduler error: {e}")
+        job_wakeup.wait(JOB_HEARTBEAT_INTERVAL)
+        job_wakeup.clear()
+
+def stream_job_events(job_id, last_event_id=0):
+    """
+    SSE stream of a job's events from last_event_id on. Ends after the
+    job's final event. Each event carries its ID, so a client that
+    reconnects (or reattaches after a refresh) can continue where it left off.
+    """
+    last_keepalive = time.time()
+    while True:
+        events = conversion_jobs.events_since(job_id, last_event_id)
+        for event_id, event in events:
+            last_event_id = event_id
+            yield sse(event, event_id)
+        if not events:
+            job = conversion_jobs.get(job_id)
+            if job is None or job['status'] in FINISHED_STATUSES:
+                return
+            if time.time() - last_keepalive > 15:
+                last_keepalive = time.time()
+                yield ": keepalive\n\n"
+            time.sleep(conversion_jobs.POLL_INTERVAL)
+
+@app.route('/convert', methods=['POST'])
+def convert():
+    """
+    Starts a background conversion job and streams its progress.
+    The first event carries the job ID; the job keeps running if the
+    stream is closed, and /convert/<job_id>/events reattaches to it.
+    """
+    token_info = session.get('token_info')
+    if not token_info:
+        return json.dumps({'error': 'Not authenticated with Spotify'}), 401
+
+    playlist_url = request.form.get('playlist_url')
+    if not playlist_url:
+        return json.dumps({'error': 'No playlist URL provided'}), 400
+
+    # Refresh the token now if needed; the job gets its own copy
+    if not spotify_service.get_spotify_client():
+        return json.dumps({'error': 'Session expired. Please login again.'}), 401
+
+    job_id = uuid.uuid4().hex
+    conversion_jobs.create(job_id, playlist_url, session['token_info'])
+    job_wakeup.set()
+
+    return Response(stream_job_events(job_id), mimetype='text/event-stream')
+
+@app.route('/convert/<job_id>')
+def conversion_status(job_id):
+    job = conversion_jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown conversion job'}), 404
+    return jsonify(public_job(job))
+
+@app.route('/convert/<job_id>/events')
+def conversion_events(job_id):
+    if conversion_jobs.get(job_id) is None:
+        return jsonify({'error': 'Unknown conversion job'}), 404
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('after') or 0
+    try:
+        last_event_id = int(last_event_id)
+    except ValueError:
+        last_event_id = 0
+    return Response(stream_job_events(job_id, last_event_id), mimetype='text/event-stream')
+
+@app.route('/convert/<job_id>/cancel', methods=['POST'])
+def cancel_conversion(job_id):
+    if conversion_jobs.get(job_id) is None:
+        return jsonify({'error': 'Unknown conversion job'}), 404
+    return jsonify({'cancelled': conversion_jobs.cancel(job_id)})
 
-    return Response(stream_with_context(generate()), mimetype='text/event-stream')
+threading.Thread(target=job_scheduler, daemon=True, name='job-scheduler').start()
 
 if __name__ == '__main__':
     app.run(debug=True, port=5000)
@@ -0,0 +1,258 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+
+# Statuses after which a job never runs again
+FINISHED_STATUSES = ('completed', 'failed', 'cancelled')
+
+JOB_FIELDS = (
+    'job_id', 'playlist_url', 'status', 'owner', 'heartbeat', 'token_info',
+    'playlist_name', 'yt_playlist_id', 'total', 'tracks_saved', 'processed',
+    'added', 'skipped', 'checkpoint_index', 'checkpoint_added',
+    'checkpoint_skipped', 'error', 'created_at', 'updated_at',
+)
+# Fields returned to API clients
+PUBLIC_FIELDS = (
+    'job_id', 'status', 'playlist_name', 'yt_playlist_id', 'total',
+    'processed', 'added', 'skipped', 'error',
+)
+
+
+def public_job(job):
+    """
+    Returns the part of a job dict that is shown to clients.
+    """
+    return {field: job[field] for field in PUBLIC_FIELDS}
+
+
+class JobLost(Exception):
+    """
+    Raised to a job's runner when the job was cancelled or claimed by
+    another process, so the runner must stop.
+    """
+
+
+class ConversionJobStore:
+    """
+    Persists conversion jobs in SQLite so they outlive the request that
+    started them and the process that runs them.
+
+    A job is run by whichever server process claims it. The claiming
+    process keeps the job's heartbeat fresh; a running job whose heartbeat
+    is older than stale_after seconds is assumed to belong to a process
+    that died and can be claimed again, resuming from its checkpoint.
+
+    Besides the job row, the store keeps:
+    - the playlist's tracks, saved while they are first fetched, so a
+      resumed job sees the same tracks in the same order;
+    - the job's progress events, numbered, so a client can reattach and
+      replay them from any point.
+    """
+    POLL_INTERVAL = 0.25
+
+    def __init__(self, path, stale_after=60):
+        self.path = path
+        self.stale_after = stale_after
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        with self._connection() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS jobs ('
+                ' job_id TEXT PRIMARY KEY, playlist_url TEXT, status TEXT, owner TEXT,'
+                ' heartbeat REAL, token_info TEXT, playlist_name TEXT, yt_playlist_id TEXT,'
+                ' total INTEGER, tracks_saved INTEGER DEFAULT 0, processed INTEGER DEFAULT 0,'
+                ' added INTEGER DEFAULT 0, skipped INTEGER DEFAULT 0,'
+                ' checkpoint_index INTEGER DEFAULT 0, checkpoint_added INTEGER DEFAULT 0,'
+                ' checkpoint_skipped INTEGER DEFAULT 0, error TEXT,'
+                ' created_at REAL, updated_at REAL)'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, heartbeat)')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS job_tracks ('
+                ' job_id TEXT, idx INTEGER, data TEXT, PRIMARY KEY (job_id, idx))'
+            )
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS job_events ('
+                ' id INTEGER PRIMARY KEY AUTOINCREMENT, job_id TEXT, data TEXT)'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS job_events_job ON job_events (job_id, id)')
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # isolation_level=None so transactions are opened explicitly with BEGIN
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def create(self, job_id, playlist_url, token_info):
+        now = time.time()
+        conn = self._connection()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute(
+                'INSERT INTO jobs (job_id, playlist_url, status, token_info, created_at, updated_at)'
+                " VALUES (?, ?, 'queued', ?, ?, ?)",
+                (job_id, playlist_url, json.dumps(token_info), now, now),
+            )
+            self._add_event(conn, job_id, {'status': 'Conversion queued', 'job_id': job_id})
+
+    def claim_next(self, owner):
+        """
+        Atomically takes the oldest queued job, or a running job whose
+        owner stopped sending heartbeats, and returns it as a dict.
+        Returns None if there is nothing to run.
+        """
+        now = time.time()
+        conn = self._connection()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute(
+                "SELECT * FROM jobs WHERE status = 'queued'"
+                " OR (status = 'running' AND heartbeat < ?) ORDER BY created_at LIMIT 1",
+                (now - self.stale_after,),
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE jobs SET status = 'running', owner = ?, heartbeat = ?, updated_at = ? WHERE job_id = ?",
+                (owner, now, now, row['job_id']),
+            )
+        job = self._to_job(row)
+        job.update(status='running', owner=owner)
+        return job
+
+    def heartbeat(self, owner):
+        """
+        Marks every job running in this process as alive.
+        """
+        with self._connection() as conn:
+            conn.execute(
+                "UPDATE jobs SET heartbeat = ? WHERE owner = ? AND status = 'running'",
+                (time.time(), owner),
+            )
+
+    def update(self, job_id, owner, event=None, **fields):
+        """
+        Updates a running job owned by owner and optionally appends a
+        progress event, in one transaction. Raises JobLost if the job was
+        cancelled or taken over by another process.
+        """
+        for field in fields:
+            if field not in JOB_FIELDS:
+                raise ValueError(f"Unknown job field: {field}")
+        if 'token_info' in fields and fields['token_info'] is not None:
+            fields['token_info'] = json.dumps(fields['token_info'])
+        assignments = ''.join(f'{field} = ?, ' for field in fields)
+        conn = self._connection()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            cursor = conn.execute(
+                f'UPDATE jobs SET {assignments}updated_at = ?'
+                " WHERE job_id = ? AND owner = ? AND status = 'running'",
+                (*fields.values(), time.time(), job_id, owner),
+            )
+            if cursor.rowcount == 0:
+                raise JobLost(job_id)
+            if event is not None:
+                self._add_event(conn, job_id, event)
+
+    def finish(self, job_id, owner, status, event, **fields):
+        """
+        Moves a job to a finished status and appends its final event.
+        """
+        self.update(job_id, owner, event=event, status=status, token_info=None, **fields)
+
+    def cancel(self, job_id):
+        """
+        Cancels a job that has not finished. Returns False if it already had.
+        """
+        placeholders = ', '.join('?' for _ in FINISHED_STATUSES)
+        conn = self._connection()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            cursor = conn.execute(
+                f"UPDATE jobs SET status = 'cancelled', token_info = NULL, updated_at = ?"
+                f' WHERE job_id = ? AND status NOT IN ({placeholders})',
+                (time.time(), job_id, *FINISHED_STATUSES),
+            )
+            if cursor.rowcount == 0:
+                return False
+            self._add_event(conn, job_id, {'status': 'cancelled', 'job_id': job_id})
+            return True
+
+    def get(self, job_id):
+        row = self._connection().execute('SELECT * FROM jobs WHERE job_id = ?', (job_id,)).fetchone()
+        return self._to_job(row) if row else None
+
+    def save_tracks(self, job_id, start, tracks):
+        """
+        Stores tracks at positions start, start + 1, ... of the job's playlist.
+        """
+        with self._connection() as conn:
+            conn.executemany(
+                'INSERT OR REPLACE INTO job_tracks (job_id, idx, data) VALUES (?, ?, ?)',
+                [(job_id, start + i, json.dumps(track)) for i, track in enumerate(tracks)],
+            )
+
+    def iter_tracks(self, job_id, start=0, chunk_size=500):
+        """
+        Yields the saved tracks from position start on, a chunk at a time.
+        """
+        while True:
+            rows = self._connection().execute(
+                'SELECT idx, data FROM job_tracks WHERE job_id = ? AND idx >= ? ORDER BY idx LIMIT ?',
+                (job_id, start, chunk_size),
+            ).fetchall()
+            for row in rows:
+                yield json.loads(row['data'])
+            if len(rows) < chunk_size:
+                return
+            start = rows[-1]['idx'] + 1
+
+    def events_since(self, job_id, last_event_id=0):
+        """
+        Returns the job's events after last_event_id as (id, dict) pairs.
+        """
+        rows = self._connection().execute(
+            'SELECT id, data FROM job_events WHERE job_id = ? AND id > ? ORDER BY id',
+            (job_id, last_event_id),
+        ).fetchall()
+        return [(row['id'], json.loads(row['data'])) for row in rows]
+
+    def expire(self, ttl):
+        """
+        Deletes finished jobs (with their tracks and events) older than ttl
+        seconds. Returns how many were removed.
+        """
+        cutoff = time.time() - ttl
+        placeholders = ', '.join('?' for _ in FINISHED_STATUSES)
+        conn = self._connection()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            job_ids = [row['job_id'] for row in conn.execute(
+                f'SELECT job_id FROM jobs WHERE status IN ({placeholders}) AND updated_at < ?',
+                (*FINISHED_STATUSES, cutoff),
+            )]
+            for job_id in job_ids:
+                conn.execute('DELETE FROM job_tracks WHERE job_id = ?', (job_id,))
+                conn.execute('DELETE FROM job_events WHERE job_id = ?', (job_id,))
+                conn.execute('DELETE FROM jobs WHERE job_id = ?', (job_id,))
+        return len(job_ids)
+
+    @staticmethod
+    def _add_event(conn, job_id, event):
+        conn.execute('INSERT INTO job_events (job_id, data) VALUES (?, ?)', (job_id, json.dumps(event)))
+
+    @staticmethod
+    def _to_job(row):
+        job = {field: row[field] for field in JOB_FIELDS}
+        job['token_info'] = json.loads(job['token_info']) if job['token_info'] else None
+        return job
@@ -0,0 +1,18 @@
+# Gunicorn configuration for production serving:
+#   gunicorn -c gunicorn.conf.py wsgi:app
+#
+# All worker processes share the session key (.flask_secret or SECRET_KEY)
+# and the credentials saved by /setup, so any process can serve any request.
+import os
+
+bind = f"127.0.0.1:{os.getenv('PORT', '5000')}"
+workers = int(os.getenv('WEB_CONCURRENCY', '2'))
+# Each worker gets its share of the YouTube Music request rate (see ytmusic_service.py)
+os.environ.setdefault('YTMUSIC_PROCESSES', str(workers))
+# Threaded workers, since each open progress stream holds a thread
+worker_class = 'gthread'
+threads = int(os.getenv('WEB_THREADS', '8'))
+timeout = 120
+# On shutdown, give open progress streams this long to finish. Conversions
+# themselves run as background jobs and resume after a restart
+graceful_timeout = int(os.getenv('GRACEFUL_TIMEOUT', '600'))
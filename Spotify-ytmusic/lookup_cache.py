@@ -0,0 +1,129 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+
+
+class LookupCache:
+    """
+    A process-wide cache for data Spotify returns per ID that is the same
+    for every user, such as a track's audio features or an artist's genres.
+
+    Entries are kept in an in-memory LRU of max_entries items. When db_path
+    is given they are also written to a SQLite table, so they survive
+    restarts and are shared by every server process; memory misses fall
+    back to it. None is a valid cached value (e.g. "Spotify has no features
+    for this track"), so callers do not ask again for IDs known to have no data.
+    """
+    def __init__(self, name, max_entries=100000, ttl=None, db_path=None):
+        self.name = name
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.db_path = db_path
+        self._entries = OrderedDict() # key -> (stored_at, value)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._stats = {'hits': 0, 'misses': 0}
+        if db_path:
+            directory = os.path.dirname(db_path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            with self._connection() as conn:
+                conn.execute(
+                    f'CREATE TABLE IF NOT EXISTS "{name}" (key TEXT PRIMARY KEY, value TEXT, stored_at REAL)'
+                )
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def _is_fresh(self, stored_at):
+        return self.ttl is None or time.time() - stored_at < self.ttl
+
+    def get_many(self, keys):
+        """
+        Returns ({key: value} for the keys that are cached, [keys that are not]).
+        """
+        found = {}
+        missing = []
+        with self._lock:
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is not None and self._is_fresh(entry[0]):
+                    self._entries.move_to_end(key)
+                    found[key] = entry[1]
+                else:
+                    missing.append(key)
+
+        if missing and self.db_path:
+            loaded = self._load(missing)
+            if loaded:
+                found.update({key: value for key, (_, value) in loaded.items()})
+                missing = [key for key in missing if key not in loaded]
+                with self._lock:
+                    for key, entry in loaded.items():
+                        self._remember_locked(key, entry)
+
+        with self._lock:
+            self._stats['hits'] += len(found)
+            self._stats['misses'] += len(missing)
+        return found, missing
+
+    def put_many(self, values):
+        """
+        Stores {key: value}. Values must be JSON serializable if the cache
+        is persisted to disk.
+        """
+        if not values:
+            return
+        stored_at = time.time()
+        with self._lock:
+            for key, value in values.items():
+                self._remember_locked(key, (stored_at, value))
+        if self.db_path:
+            try:
+                with self._connection() as conn:
+                    conn.executemany(
+                        f'INSERT OR REPLACE INTO "{self.name}" (key, value, stored_at) VALUES (?, ?, ?)',
+                        [(key, json.dumps(value), stored_at) for key, value in values.items()],
+                    )
+            except sqlite3.Error as e:
+                print(f"Could not persist {self.name} cache entries: {e}")
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats, size=len(self._entries))
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = round(stats['hits'] / lookups, 3) if lookups else None
+        return stats
+
+    def _load(self, keys):
+        """
+        Reads fresh entries for keys from disk. Returns {key: (stored_at, value)}.
+        """
+        loaded = {}
+        conn = self._connection()
+        # Stay well below SQLite's limit on the number of query parameters
+        for start in range(0, len(keys), 500):
+            batch = keys[start:start + 500]
+            placeholders = ', '.join('?' for _ in batch)
+            rows = conn.execute(
+                f'SELECT key, value, stored_at FROM "{self.name}" WHERE key IN ({placeholders})', batch
+            ).fetchall()
+            for key, value, stored_at in rows:
+                if self._is_fresh(stored_at):
+                    loaded[key] = (stored_at, json.loads(value))
+        return loaded
+
+    def _remember_locked(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
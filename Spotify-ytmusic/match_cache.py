@@ -0,0 +1,130 @@
+import os
+import time
+import sqlite3
+import threading
+
+
+class MatchCache:
+    """
+    Remembers which YouTube Music video a Spotify track was matched to,
+    so a song that shows up in many playlists is only searched once.
+
+    Entries are keyed by Spotify track ID, with the track's ISRC as a second
+    key: the same recording released on several albums has different track
+    IDs but one ISRC. "No match" results are cached too, for a shorter time,
+    since new uploads can make a track findable later.
+
+    The cache lives in a SQLite file shared by every server process. Entries
+    written by an older matcher (see `version`) are ignored, so improving
+    the matching logic does not keep serving the old answers.
+    """
+    def __init__(self, path, ttl=30 * 24 * 3600, negative_ttl=24 * 3600, version=1):
+        self.path = path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.version = version
+        self._local = threading.local()
+        self._stats = {'hits': 0, 'negative_hits': 0, 'misses': 0, 'stores': 0}
+        self._stats_lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        with self._connection() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS matches ('
+                ' track_id TEXT PRIMARY KEY, isrc TEXT, video_id TEXT, title TEXT,'
+                ' stored_at REAL, version INTEGER)'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS matches_isrc ON matches (isrc)')
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            # WAL lets every server process read while one of them writes
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def get(self, track_id, isrc=None):
+        """
+        Returns (found, match) for a track. match is a dict with 'videoId'
+        and 'title', or None if the track is cached as having no match.
+        found is False when the track has to be searched for.
+        """
+        row = None
+        conn = self._connection()
+        if track_id:
+            row = self._fresh(conn.execute(
+                'SELECT * FROM matches WHERE track_id = ?', (track_id,)
+            ).fetchone())
+        if row is None and isrc:
+            row = self._fresh(conn.execute(
+                'SELECT * FROM matches WHERE isrc = ? AND video_id IS NOT NULL'
+                ' ORDER BY stored_at DESC LIMIT 1', (isrc,)
+            ).fetchone())
+
+        if row is None:
+            self._count('misses')
+            return False, None
+        if row['video_id'] is None:
+            self._count('negative_hits')
+            return True, None
+        self._count('hits')
+        return True, {'videoId': row['video_id'], 'title': row['title']}
+
+    def put(self, track_id, isrc, match):
+        """
+        Stores the match for a track; match=None records that nothing was found.
+        """
+        if not track_id:
+            return
+        video_id = match.get('videoId') if match else None
+        title = match.get('title') if match else None
+        try:
+            with self._connection() as conn:
+                conn.execute(
+                    'INSERT OR REPLACE INTO matches (track_id, isrc, video_id, title, stored_at, version)'
+                    ' VALUES (?, ?, ?, ?, ?, ?)',
+                    (track_id, isrc, video_id, title, time.time(), self.version),
+                )
+        except sqlite3.Error as e:
+            print(f"Could not cache match for {track_id}: {e}")
+            return
+        self._count('stores')
+
+    def expire(self):
+        """
+        Deletes stale entries. Returns how many were removed.
+        """
+        now = time.time()
+        with self._connection() as conn:
+            cursor = conn.execute(
+                'DELETE FROM matches WHERE version != ?'
+                ' OR (video_id IS NOT NULL AND stored_at < ?)'
+                ' OR (video_id IS NULL AND stored_at < ?)',
+                (self.version, now - self.ttl, now - self.negative_ttl),
+            )
+            return cursor.rowcount
+
+    def stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+        lookups = stats['hits'] + stats['negative_hits'] + stats['misses']
+        stats['hit_rate'] = round((stats['hits'] + stats['negative_hits']) / lookups, 3) if lookups else None
+        stats['entries'] = self._connection().execute('SELECT COUNT(*) FROM matches').fetchone()[0]
+        return stats
+
+    def _fresh(self, row):
+        if row is None or row['version'] != self.version:
+            return None
+        ttl = self.ttl if row['video_id'] is not None else self.negative_ttl
+        if time.time() - row['stored_at'] > ttl:
+            return None
+        return row
+
+    def _count(self, name):
+        with self._stats_lock:
+            self._stats[name] += 1
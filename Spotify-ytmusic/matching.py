@@ -0,0 +1,141 @@
+import re
+import unicodedata
+from difflib import SequenceMatcher
+
+# Version of the matching logic. Stored with cached matches, so bump it
+# whenever a change here would pick different videos.
+MATCHER_VERSION = 2
+
+# Relative weight of each signal in a candidate's score
+WEIGHTS = {'title': 0.4, 'artist': 0.3, 'duration': 0.2, 'album': 0.1}
+
+# Candidates scoring below this are rejected rather than added
+MIN_SCORE = 0.55
+# A duration this far off (in seconds) means a different recording,
+# however similar the names are
+MAX_DURATION_DELTA = 30
+# Deltas up to this many seconds count as a perfect duration match
+DURATION_TOLERANCE = 3
+# Below this artist similarity the candidate is another artist's
+# recording (usually a cover), whatever its title
+MIN_ARTIST_SIMILARITY = 0.5
+
+# Words that mark a different version of a song. A candidate containing
+# one that the Spotify title does not is penalized.
+VERSION_WORDS = (
+    'live', 'remix', 'acoustic', 'karaoke', 'instrumental', 'cover',
+    'sped up', 'slowed', 'nightcore', '8d', 'edit', 'version', 'demo',
+)
+VERSION_WORD_RES = [re.compile(rf'\b{word}\b') for word in VERSION_WORDS]
+VERSION_PENALTY = 0.25
+
+# "(feat. X)", "[Remastered 2011]", " - 2011 Remaster" and similar suffixes
+FEATURE_RE = re.compile(r'[\(\[]\s*(?:feat|ft|with)\.?\s[^\)\]]*[\)\]]|\s-\s.*remaster.*$|[\(\[][^\)\]]*remaster[^\)\]]*[\)\]]')
+NON_WORD_RE = re.compile(r'[^\w\s]')
+
+
+def normalize(text):
+    """
+    Lowercases, strips accents, featuring credits, remaster notes and
+    punctuation so that titles from both services compare cleanly.
+    """
+    text = unicodedata.normalize('NFKD', text or '')
+    text = ''.join(c for c in text if not unicodedata.combining(c)).lower()
+    text = FEATURE_RE.sub(' ', text)
+    text = NON_WORD_RE.sub(' ', text)
+    return ' '.join(text.split())
+
+
+def similarity(a, b):
+    """
+    Similarity of two normalized strings between 0 and 1: the better of a
+    character-level ratio and word overlap, so reordered words still match.
+    """
+    if not a or not b:
+        return 0.0
+    ratio = SequenceMatcher(None, a, b).ratio()
+    words_a, words_b = set(a.split()), set(b.split())
+    overlap = len(words_a & words_b) / len(words_a | words_b)
+    return max(ratio, overlap)
+
+
+def duration_score(track_ms, candidate_seconds):
+    """
+    1 within DURATION_TOLERANCE seconds, falling to 0 at MAX_DURATION_DELTA.
+    None if either duration is unknown.
+    """
+    if not track_ms or not candidate_seconds:
+        return None
+    delta = abs(track_ms / 1000 - candidate_seconds)
+    if delta <= DURATION_TOLERANCE:
+        return 1.0
+    return max(0.0, 1 - (delta - DURATION_TOLERANCE) / (MAX_DURATION_DELTA - DURATION_TOLERANCE))
+
+
+def candidate_seconds(candidate):
+    if candidate.get('duration_seconds'):
+        return candidate['duration_seconds']
+    # Older ytmusicapi versions only return "m:ss"
+    try:
+        seconds = 0
+        for part in (candidate.get('duration') or '').split(':'):
+            seconds = seconds * 60 + int(part)
+        return seconds or None
+    except ValueError:
+        return None
+
+
+def score_candidate(track, candidate):
+    """
+    Scores a YouTube Music search result against a Spotify track, from 0
+    to 1. Returns None if the candidate is certainly a different recording.
+    """
+    seconds = candidate_seconds(candidate)
+    duration = duration_score(track.get('duration_ms'), seconds)
+    if duration == 0.0:
+        return None
+
+    track_title = normalize(track.get('name'))
+    candidate_title = normalize(candidate.get('title'))
+    scores = {'title': similarity(track_title, candidate_title)}
+
+    track_artists = [normalize(name) for name in track.get('artists') or [track.get('artist')]]
+    candidate_artists = [normalize(artist.get('name')) for artist in candidate.get('artists') or []]
+    scores['artist'] = max(
+        (similarity(a, b) for a in track_artists for b in candidate_artists),
+        default=0.0,
+    )
+    if scores['artist'] < MIN_ARTIST_SIMILARITY:
+        return None
+
+    if duration is not None:
+        scores['duration'] = duration
+
+    album = (candidate.get('album') or {}).get('name')
+    if track.get('album') and album:
+        scores['album'] = similarity(normalize(track['album']), normalize(album))
+
+    # Signals we could not compare are left out rather than counted as misses
+    weight = sum(WEIGHTS[name] for name in scores)
+    score = sum(WEIGHTS[name] * value for name, value in scores.items()) / weight
+
+    for word_re in VERSION_WORD_RES:
+        if word_re.search(candidate_title) and not word_re.search(track_title):
+            score -= VERSION_PENALTY
+            break
+    return score
+
+
+def best_match(track, candidates):
+    """
+    Returns the best scoring candidate for track, or None if none of them
+    reaches MIN_SCORE. Earlier search results win ties.
+    """
+    best, best_score = None, MIN_SCORE
+    for candidate in candidates:
+        if not candidate.get('videoId'):
+            continue
+        score = score_candidate(track, candidate)
+        if score is not None and score > best_score:
+            best, best_score = candidate, score
+    return best
@@ -0,0 +1,81 @@
+import re
+import time
+import threading
+
+# ytmusicapi reports HTTP errors as exceptions whose message contains the status code
+RATE_LIMIT_RE = re.compile(r'\b429\b|too many requests', re.IGNORECASE)
+
+
+def is_rate_limit_error(error):
+    """
+    Returns True if an exception raised by an API client means we are
+    being rate limited (HTTP 429).
+    """
+    response = getattr(error, 'response', None)
+    if getattr(response, 'status_code', None) == 429:
+        return True
+    return bool(RATE_LIMIT_RE.search(str(error)))
+
+
+class TokenBucket:
+    """
+    A thread-safe token bucket that adapts its rate to the server.
+
+    Every request takes one token; tokens refill at `rate` per second up to
+    `burst`. When the server answers 429, backoff() halves the rate and
+    stops all callers for a while; each successful request then raises the
+    rate again by a small step until it is back at max_rate. This replaces
+    a fixed sleep between requests: we go as fast as the server allows and
+    slow down only when told to.
+    """
+    def __init__(self, rate=5.0, burst=5, min_rate=0.5, increase_step=0.1):
+        self.max_rate = rate
+        # A floor above the maximum would keep backoff() from slowing down at all
+        self.min_rate = min(min_rate, rate)
+        self.increase_step = increase_step
+        self.burst = burst
+        self.rate = rate
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._backoffs = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Blocks until a request may be sent.
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill_locked(now)
+                if now >= self._paused_until and self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = max(self._paused_until - now, (1 - self._tokens) / self.rate)
+            time.sleep(wait)
+
+    def on_success(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.increase_step)
+
+    def backoff(self, retry_after=None):
+        """
+        Called after a 429. Halves the rate and pauses every caller for
+        retry_after seconds (or a couple of refill intervals if unknown).
+        """
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self._tokens = 0.0
+            pause = retry_after if retry_after is not None else 2 / self.rate
+            self._paused_until = max(self._paused_until, time.monotonic() + pause)
+            self._backoffs += 1
+            print(f"Rate limited, slowing down to {self.rate:.2f} requests/s")
+
+    def stats(self):
+        with self._lock:
+            return {'rate': round(self.rate, 2), 'max_rate': self.max_rate, 'backoffs': self._backoffs}
+
+    def _refill_locked(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
@@ -1,8 +1,14 @@
 import os
+import json
+import itertools
 import spotipy
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from spotipy.oauth2 import SpotifyOAuth, SpotifyClientCredentials
 from spotipy.cache_handler import CacheHandler
 from flask import session
+import analysis
+from lookup_cache import LookupCache
 
 class FlaskSessionCacheHandler(CacheHandler):
     """
@@ -20,17 +26,90 @@ class FlaskSessionCacheHandler(CacheHandler):
     def save_token_to_cache(self, token_info):
         session[self.session_key] = token_info
 
+# Only the parts of a playlist page that _clean_track reads, which keeps
+# each response a fraction of its full size
+PAGE_FIELDS = (
+    "total,items(track(type,name,id,uri,duration_ms,is_local,"
+    "artists(name,id),album(name),external_ids(isrc)))"
+)
+
+def chunks(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
 class SpotifyService:
+    # Spotify returns at most 100 playlist items per request
+    PAGE_SIZE = 100
+    # Playlist pages fetched at the same time
+    PAGE_WORKERS = int(os.getenv('SPOTIFY_PAGE_WORKERS', '4'))
+    # Most IDs Spotify accepts per audio_features / artists request
+    FEATURES_BATCH = 100
+    ARTISTS_BATCH = 50
+    # Feature and artist batches fetched at the same time by analyze_playlist
+    ANALYSIS_WORKERS = int(os.getenv('SPOTIFY_ANALYSIS_WORKERS', '4'))
+    # Audio features and artist genres are cached here for every user and
+    # process; set ANALYSIS_CACHE_PATH to an empty string to keep them in memory only
+    ANALYSIS_CACHE_PATH = os.getenv(
+        'ANALYSIS_CACHE_PATH',
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), 'analysis_cache.sqlite3'),
+    )
+
+    # Credentials entered on /setup are saved here, so every server process
+    # (e.g. each gunicorn worker) sees them, not just the one that handled /setup
+    CREDENTIALS_FILE = 'spotify_credentials.json'
+
     def __init__(self):
         # Strict Manual Mode: No environment variables
         self.client_id = None
         self.client_secret = None
         self.redirect_uri = 'http://127.0.0.1:5000/callback'
         self.scope = "playlist-read-private"
+        self._credentials_mtime = None
+        self._load_saved_credentials()
+        # Audio features never change; genres do, slowly
+        self.features_cache = LookupCache('audio_features', db_path=self.ANALYSIS_CACHE_PATH or None)
+        self.genres_cache = LookupCache(
+            'artist_genres',
+            ttl=int(os.getenv('ARTIST_GENRES_TTL', str(7 * 24 * 3600))),
+            db_path=self.ANALYSIS_CACHE_PATH or None,
+        )
+        # Latest analysis of each playlist, for incremental re-analysis
+        self.playlist_analyses = LookupCache(
+            'playlist_analyses', max_entries=int(os.getenv('ANALYSIS_PLAYLISTS_CACHED', '256')),
+        )
 
     def is_configured(self):
+        self._load_saved_credentials()
         return bool(self.client_id and self.client_secret)
 
+    def _load_saved_credentials(self):
+        """
+        Picks up credentials saved by /setup (possibly in another process)
+        if the file changed since we last read it.
+        """
+        try:
+            mtime = os.stat(self.CREDENTIALS_FILE).st_mtime_ns
+            if mtime == self._credentials_mtime:
+                return
+            with open(self.CREDENTIALS_FILE, 'r', encoding='utf-8') as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return
+        self.client_id = saved.get('client_id')
+        self.client_secret = saved.get('client_secret')
+        self._credentials_mtime = mtime
+
+    def _save_credentials(self):
+        tmp_path = f"{self.CREDENTIALS_FILE}.{os.getpid()}.tmp"
+        try:
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump({'client_id': self.client_id, 'client_secret': self.client_secret}, f)
+            os.replace(tmp_path, self.CREDENTIALS_FILE)
+            self._credentials_mtime = os.stat(self.CREDENTIALS_FILE).st_mtime_ns
+        except OSError as e:
+            print(f"Could not save Spotify credentials: {e}")
+
     def validate_and_setup(self, client_id, client_secret):
         """
         Validates the credentials by attempting to get a client token.
@@ -48,19 +127,23 @@ class SpotifyService:
             # If no exception, credentials are valid
             self.client_id = client_id
             self.client_secret = client_secret
+            self._save_credentials()
             return True
         except Exception as e:
             print(f"Spotify Validation Failed: {e}")
             return False
 
-    def get_auth_manager(self):
+    def get_auth_manager(self, cache_handler=None):
         """
         Returns a SpotifyOAuth object with a custom cache handler that syncs with Flask session.
+        Pass another cache_handler to use a token outside of a request,
+        e.g. in a background conversion job.
         """
         if not self.is_configured():
             raise Exception("Spotify credentials not set. Please go to /setup")
             
-        cache_handler = FlaskSessionCacheHandler()
+        if cache_handler is None:
+            cache_handler = FlaskSessionCacheHandler()
         return SpotifyOAuth(
             client_id=self.client_id,
             client_secret=self.client_secret,
@@ -80,12 +163,13 @@ class SpotifyService:
         token_info = auth_manager.get_access_token(code)
         return token_info
 
-    def get_spotify_client(self):
+    def get_spotify_client(self, cache_handler=None):
         """
         Returns a valid spotipy.Spotify client.
-        Automatically handles token refreshing using the refresh_token in the session.
+        Automatically handles token refreshing using the refresh_token in the session
+        (or in cache_handler, see get_auth_manager).
         """
-        auth_manager = self.get_auth_manager()
+        auth_manager = self.get_auth_manager(cache_handler)
         
         # Get the token info from the session (via cache handler)
         token_info = auth_manager.cache_handler.get_cached_token()
@@ -110,151 +194,185 @@ class SpotifyService:
         """
         Analyzes playlist audio features and genres to determine mood.
         Returns a dict with stats, curve data, and mood labels.
+        Covers every track and artist of the playlist; audio features and
+        artists are fetched in batches of FEATURES_BATCH and ARTISTS_BATCH
+        IDs, all batches at the same time.
+
+        Results are kept per playlist along with its snapshot_id. If the
+        playlist has not changed, the cached result is returned after a
+        single request; if it has, only the added tracks are looked up and
+        the previous aggregates are updated rather than rebuilt.
         """
         sp = self.get_spotify_client()
         if not sp:
             return None
 
         try:
-            # 1. Fetch Tracks (Limit to first 50 for speed/relevance in this demo)
-            results = sp.playlist_items(playlist_id, limit=50)
-            items = results['items']
-            track_ids = []
-            artist_ids = set()
-            
-            for item in items:
-                track = item.get('track')
-                if track and track.get('id'):
-                    track_ids.append(track['id'])
-                    for artist in track.get('artists', []):
-                        if artist.get('id'):
-                            artist_ids.add(artist['id'])
-
-            if not track_ids:
+            # 1. Check whether the playlist changed since the last analysis
+            snapshot_id = sp.playlist(playlist_id, fields="snapshot_id")['snapshot_id']
+            cached, _ = self.playlist_analyses.get_many([playlist_id])
+            previous = cached.get(playlist_id)
+            if previous and previous['snapshot_id'] == snapshot_id:
+                return previous['result']
+            stats = previous['stats'] if previous else analysis.PlaylistStats()
+
+            # 2. Fetch Tracks
+            _, _, tracks = self.iter_playlist_tracks(playlist_id)
+            track_list = [(track['id'], track['artist_ids']) for track in tracks if track.get('id')]
+            if not track_list:
                 return None
 
-            # 2. Fetch Audio Features (Batch)
-            features_list = []
-            try:
-                # Spotify allows 100 ids per request
-                features_list = sp.audio_features(track_ids)
-            except Exception as e:
-                print(f"Audio Features fetch failed (likely 403 restricted): {e}")
-                features_list = [] # Proceed without features
-            
-            # 3. Calculate Stats
-            total_energy = 0
-            total_valence = 0
-            energy_curve = []
-            valence_curve = []
-            valid_count = 0
-
-            # Fallback for when features are empty or restricted
-            if not features_list or all(f is None for f in features_list):
-                 # Create neutral dummy data so visualization doesn't break
-                 for _ in track_ids:
-                     energy_curve.append(0.5)
-                     valence_curve.append(0.5)
-                 avg_energy = 0.5
-                 avg_valence = 0.5
-                 valid_count = len(track_ids)
-            else:
-                for f in features_list:
-                    if f:
-                        total_energy += f['energy']
-                        total_valence += f['valence']
-                        energy_curve.append(round(f['energy'], 2))
-                        valence_curve.append(round(f['valence'], 2))
-                        valid_count += 1
-                    else:
-                        energy_curve.append(0.5) # Fallback
-                        valence_curve.append(0.5)
-
-                avg_energy = total_energy / valid_count if valid_count > 0 else 0.5
-                avg_valence = total_valence / valid_count if valid_count > 0 else 0.5
-
-            # 4. Determine Mood Label
-            mood_label = "Neutral"
-            if avg_energy > 0.65:
-                if avg_valence > 0.6: mood_label = "Exuberant / Pumped"
-                else: mood_label = "Intense / Aggressive"
-            elif avg_energy < 0.35:
-                if avg_valence > 0.6: mood_label = "Peaceful / Calm"
-                else: mood_label = "Melancholic / Sad"
-            else:
-                if avg_valence > 0.6: mood_label = "Happy / Chill"
-                elif avg_valence < 0.4: mood_label = "Moody / Dark"
-                else: mood_label = "Balanced / Focused"
-
-            # 5. Fetch Genres (aggregating efficiently)
-            # Limit artist fetch to top 20 to save API calls time
-            artist_check_ids = list(artist_ids)[:20]
-            if artist_check_ids:
-                artists_info = sp.artists(artist_check_ids)
-                genre_counts = {}
-                for artist in artists_info['artists']:
-                    for genre in artist.get('genres', []):
-                        genre_counts[genre] = genre_counts.get(genre, 0) + 1
-                
-                # Sort and take top 5
-                sorted_genres = sorted(genre_counts.items(), key=lambda x: x[1], reverse=True)[:5]
-                top_genres = {k: v for k, v in sorted_genres}
-            else:
-                top_genres = {}
-
-            return {
-                "mood_label": mood_label,
-                "avg_energy": round(avg_energy, 2),
-                "avg_valence": round(avg_valence, 2),
-                "energy_curve": energy_curve,
-                "valence_curve": valence_curve,
-                "genres": top_genres,
-                "track_count": valid_count
-            }
+            # 3. Fetch Audio Features and Genres of what was added (concurrent batches)
+            added, _ = stats.diff([track_id for track_id, _ in track_list])
+            new_artists = {}  # dict as an ordered set
+            for track_id, artist_ids in track_list:
+                if track_id in added:
+                    for artist_id in artist_ids:
+                        if artist_id not in stats.artist_refs:
+                            new_artists[artist_id] = None
+            features, genres = self._fetch_features_and_genres(sp, list(added), list(new_artists))
+
+            # 4. Update Stats and Mood
+            stats = stats.update(track_list, features, genres)
+            result = stats.result()
+            self.playlist_analyses.put_many({
+                playlist_id: {'snapshot_id': snapshot_id, 'stats': stats, 'result': result},
+            })
+            return result
 
         except Exception as e:
             print(f"Analysis failed: {e}")
             return None
 
+    def _fetch_features_and_genres(self, sp, track_ids, artist_ids):
+        """
+        Returns ({track ID: {'energy', 'valence'} or None}, {artist ID: [genres]}).
+        Only IDs missing from features_cache / genres_cache are requested,
+        and whatever Spotify returns is cached, including "no features for
+        this track". If audio features are refused (the endpoint is
+        restricted for many apps), the analysis continues without them and
+        nothing is cached for those tracks.
+        """
+        features, missing_tracks = self.features_cache.get_many(track_ids)
+        genres, missing_artists = self.genres_cache.get_many(artist_ids)
+
+        def fetch_features(batch):
+            try:
+                results = sp.audio_features(batch)
+            except Exception as e:
+                print(f"Audio Features fetch failed (likely 403 restricted): {e}")
+                return
+            fetched = {track_id: None for track_id in batch}
+            for track_id, f in zip(batch, results or []):
+                if f:
+                    fetched[track_id] = {'energy': f['energy'], 'valence': f['valence']}
+            self.features_cache.put_many(fetched)
+            features.update(fetched)
+
+        def fetch_artists(batch):
+            fetched = {artist_id: [] for artist_id in batch}
+            for artist in sp.artists(batch)['artists']:
+                if artist:
+                    fetched[artist['id']] = artist.get('genres', [])
+            self.genres_cache.put_many(fetched)
+            genres.update(fetched)
+
+        with ThreadPoolExecutor(max_workers=self.ANALYSIS_WORKERS) as executor:
+            futures = [executor.submit(fetch_features, batch) for batch in chunks(missing_tracks, self.FEATURES_BATCH)]
+            futures += [executor.submit(fetch_artists, batch) for batch in chunks(missing_artists, self.ARTISTS_BATCH)]
+            for future in futures:
+                future.result()
+        return features, genres
+
     def get_playlist_tracks(self, playlist_url):
         """
         Fetches tracks from the given Spotify playlist URL.
+        Returns (playlist name, list of tracks); see iter_playlist_tracks
+        for a variant that does not hold the whole playlist in memory.
+        """
+        playlist_name, _, tracks = self.iter_playlist_tracks(playlist_url)
+        try:
+            return playlist_name, list(tracks)
+        except Exception as e:
+            print(f"Error fetching playlist: {e}")
+            raise e
+
+    def iter_playlist_tracks(self, playlist_url, sp=None):
+        """
+        Starts fetching the given Spotify playlist and returns
+        (playlist name, number of items, iterator of tracks).
         Uses the internal get_spotify_client to ensure valid auth.
+
+        The first request returns the name, the item count and the first
+        page. The iterator yields compact track records page by page while
+        the next PAGE_WORKERS pages are fetched concurrently, so callers can
+        start on the first tracks right away and memory use does not grow
+        with the playlist. The item count includes local files and other
+        items the iterator skips. sp defaults to the current session's client.
         """
-        sp = self.get_spotify_client()
+        if sp is None:
+            sp = self.get_spotify_client()
         if not sp:
             raise Exception("Session expired. Please login again.")
 
         try:
-            results = sp.playlist_items(playlist_url, limit=100)
-            tracks = results['items']
-            
-            while results['next']:
-                results = sp.next(results)
-                tracks.extend(results['items'])
-            
-            cleaned_tracks = []
-            for item in tracks:
-                track = item.get('track')
-                if not track or track.get('is_local'):
-                    continue
-                
-                cleaned_tracks.append({
-                    'name': track['name'],
-                    'artist': track['artists'][0]['name'] if track['artists'] else "Unknown Artist",
-                    'id': track['id'],
-                    'artist_id': track['artists'][0]['id'] if track['artists'] else None,
-                    'duration_ms': track['duration_ms'],
-                    'uri': track['uri']
-                })
-            
-            playlist_info = sp.playlist(playlist_url, fields="name")
-            playlist_name = playlist_info['name']
-
-            return playlist_name, cleaned_tracks
-            
+            playlist = sp.playlist(playlist_url, fields=f"name,tracks({PAGE_FIELDS})")
         except Exception as e:
             print(f"Error fetching playlist: {e}")
             raise e
+        first_page = playlist['tracks']
+        offsets = range(len(first_page['items']), first_page['total'], self.PAGE_SIZE)
+        return playlist['name'], first_page['total'], self._iter_pages(sp, playlist_url, first_page['items'], offsets)
+
+    def _iter_pages(self, sp, playlist_url, first_items, offsets):
+        def fetch(offset):
+            return sp.playlist_items(playlist_url, fields=PAGE_FIELDS, limit=self.PAGE_SIZE, offset=offset)['items']
 
+        executor = ThreadPoolExecutor(max_workers=self.PAGE_WORKERS)
+        pending = deque()
+        offset_iter = iter(offsets)
+        try:
+            for offset in itertools.islice(offset_iter, self.PAGE_WORKERS):
+                pending.append(executor.submit(fetch, offset))
+            items = first_items
+            while True:
+                for item in items:
+                    track = self._clean_track(item)
+                    if track:
+                        yield track
+                if not pending:
+                    break
+                # Pages are consumed in order; keep PAGE_WORKERS of them in flight
+                items = pending.popleft().result()
+                for offset in itertools.islice(offset_iter, 1):
+                    pending.append(executor.submit(fetch, offset))
+        finally:
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+    @staticmethod
+    def _clean_track(item):
+        """
+        Returns the compact track record used for matching, or None for
+        local files, removed tracks and podcast episodes.
+        """
+        track = item.get('track')
+        if not track or track.get('is_local'):
+            return None
+        # Episodes have no artists; 'type' is missing only from hand-built items
+        if track.get('type', 'track') != 'track' or 'artists' not in track:
+            return None
 
+        return {
+            'name': track['name'],
+            'artist': track['artists'][0]['name'] if track['artists'] else "Unknown Artist",
+            'artists': [artist['name'] for artist in track['artists']],
+            'album': (track.get('album') or {}).get('name'),
+            'id': track['id'],
+            'artist_id': track['artists'][0]['id'] if track['artists'] else None,
+            'artist_ids': [artist['id'] for artist in track['artists'] if artist.get('id')],
+            'duration_ms': track['duration_ms'],
+            'uri': track['uri'],
+            'isrc': (track.get('external_ids') or {}).get('isrc')
+        }
@@ -0,0 +1,36 @@
+from spotify_service import SpotifyService
+
+
+def make_item(**track):
+    base = {
+        'type': 'track', 'name': 'Song', 'id': 't1', 'uri': 'spotify:track:t1', 'duration_ms': 1000,
+        'is_local': False, 'artists': [{'name': 'Artist', 'id': 'a1'}], 'album': {'name': 'Album'},
+        'external_ids': {'isrc': 'X'},
+    }
+    base.update(track)
+    return {'track': base}
+
+
+def test_clean_track_keeps_tracks():
+    track = SpotifyService._clean_track(make_item())
+    assert track['artist'] == 'Artist'
+    assert track['isrc'] == 'X'
+
+
+def test_clean_track_skips_episodes():
+    episode = {'track': {
+        'type': 'episode', 'name': 'Episode 1', 'id': 'e1', 'uri': 'spotify:episode:e1',
+        'duration_ms': 1000, 'is_local': False,
+    }}
+    assert SpotifyService._clean_track(episode) is None
+
+
+def test_clean_track_skips_items_without_artists():
+    item = make_item()
+    del item['track']['artists']
+    assert SpotifyService._clean_track(item) is None
+
+
+def test_clean_track_skips_local_and_removed_tracks():
+    assert SpotifyService._clean_track(make_item(is_local=True)) is None
+    assert SpotifyService._clean_track({'track': None}) is None
@@ -1,18 +1,70 @@
-from ytmusicapi import YTMusic
+from ytmusicapi import YTMusic, setup as ytmusic_setup
+import os
+import json
 import time
+from rate_limiter import TokenBucket, is_rate_limit_error
+from matching import best_match
 
 class YTMusicService:
+    # Credentials from /setup are written here, so every server process
+    # (e.g. each gunicorn worker) picks them up
+    AUTH_FILE = "browser.json"
+    # How often a request that was rate limited is retried before giving up
+    MAX_RETRIES = int(os.getenv('YTMUSIC_MAX_RETRIES', '4'))
+
     def __init__(self):
         # Dictionary to store config if manually setup
         self.auth_data = None 
+        self.yt = None
+        self._auth_mtime = None
+        # Shared by every conversion in this process, since YouTube Music
+        # rate limits the account rather than a single conversion. The bucket
+        # only sees this process, so YTMUSIC_RATE/YTMUSIC_BURST (the budget for
+        # the whole account) are split between the YTMUSIC_PROCESSES server
+        # processes (set by gunicorn.conf.py to its worker count)
+        processes = max(1, int(os.getenv('YTMUSIC_PROCESSES', '1')))
+        self.limiter = TokenBucket(
+            rate=float(os.getenv('YTMUSIC_RATE', '5')) / processes,
+            burst=max(1, int(os.getenv('YTMUSIC_BURST', '5')) // processes),
+            # ...and so is the floor backoff() may slow down to
+            min_rate=0.5 / processes,
+        )
         # Attempt minimal init if browser.json exists on disk, else None
+        self._load_auth_file()
+
+    def is_configured(self):
+        self._load_auth_file()
+        return self.yt is not None
+
+    def _load_auth_file(self):
+        """
+        (Re)initializes from browser.json if it changed since we last
+        loaded it, e.g. because /setup ran in another process.
+        """
         try:
-            self.yt = YTMusic("browser.json")
+            mtime = os.stat(self.AUTH_FILE).st_mtime_ns
+        except OSError:
+            return
+        if mtime == self._auth_mtime:
+            return
+        self._auth_mtime = mtime
+        try:
+            self.yt = YTMusic(self.AUTH_FILE)
         except Exception:
             self.yt = None
 
-    def is_configured(self):
-        return self.yt is not None
+    def _save_auth_file(self, auth_json):
+        # The file holds the account's cookies, so only we may read it, and other
+        # processes reload it on change, so it is replaced atomically
+        tmp_path = f"{self.AUTH_FILE}.{os.getpid()}.tmp"
+        try:
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.write(auth_json)
+            os.replace(tmp_path, self.AUTH_FILE)
+            self._auth_mtime = os.stat(self.AUTH_FILE).st_mtime_ns
+        except OSError as e:
+            print(f"Could not save {self.AUTH_FILE}: {e}")
 
     def _validate(self):
         """
@@ -32,14 +84,16 @@ class YTMusicService:
         Initialize using a dictionary (parsed from browser.json or constructed).
         """
         try:
-            import json
             if isinstance(json_data, str):
                 self.auth_data = json.loads(json_data)
             else:
                 self.auth_data = json_data
                 
             self.yt = YTMusic(self.auth_data)
-            return self._validate()
+            if not self._validate():
+                return False
+            self._save_auth_file(json.dumps(self.auth_data))
+            return True
         except Exception as e:
             print(f"Setup failed: {e}")
             return False
@@ -50,34 +104,74 @@ class YTMusicService:
         """
         try:
             self.yt = YTMusic(auth=headers_raw)
-            return self._validate()
+            if not self._validate():
+                return False
+            # Convert the raw headers to the browser.json format and save them
+            self._save_auth_file(ytmusic_setup(headers_raw=headers_raw))
+            return True
         except Exception as e:
             print(f"Setup from headers failed: {e}")
             return False
 
+    def _call(self, func, *args, **kwargs):
+        """
+        Calls a YTMusic API method through the rate limiter, backing off
+        and retrying when the server answers 429.
+        """
+        for attempt in range(self.MAX_RETRIES + 1):
+            self.limiter.acquire()
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                if not is_rate_limit_error(e) or attempt == self.MAX_RETRIES:
+                    raise
+                self.limiter.backoff(self._retry_after(e))
+                continue
+            self.limiter.on_success()
+            return result
+
+    @staticmethod
+    def _retry_after(error):
+        response = getattr(error, 'response', None)
+        try:
+            return float(response.headers['Retry-After'])
+        except (AttributeError, KeyError, TypeError, ValueError):
+            return None
+
     def create_playlist(self, title, description):
         if not self.yt:
             raise Exception("YTMusic not initialized. Check browser.json.")
         try:
-            playlist_id = self.yt.create_playlist(title=title, description=description)
+            playlist_id = self._call(self.yt.create_playlist, title=title, description=description)
             return playlist_id
         except Exception as e:
             print(f"Error creating playlist: {e}")
             raise e
 
-    def search_song(self, query):
+    def search_song(self, query, track=None, raise_errors=False):
+        """
+        Returns the best matching song for query, or None if there is none.
+        When the Spotify track is given, every result of the search is
+        scored against its title, artists, album and duration (see
+        matching.py) and poor matches are rejected; otherwise the top
+        result is returned.
+        Errors are logged and reported as None unless raise_errors is set,
+        which lets callers tell "no match" apart from a failed search.
+        """
         if not self.yt:
             raise Exception("YTMusic not initialized.")
         try:
             # Search for songs
-            results = self.yt.search(query, filter="songs")
+            results = self._call(self.yt.search, query, filter="songs")
             if not results:
                 return None
             
-            # Return the first result (best match)
-            # We could add more complex logic here to check duration, etc.
-            return results[0]
+            if track is None:
+                return results[0]
+            return best_match(track, results)
         except Exception as e:
+            if raise_errors:
+                raise
             print(f"Error searching for song '{query}': {e}")
             return None
 
@@ -85,8 +179,116 @@ class YTMusicService:
         if not self.yt:
             raise Exception("YTMusic not initialized.")
         try:
-            self.yt.add_playlist_items(playlist_id, [video_id])
-            return True
+            return self._succeeded(self._call(self.yt.add_playlist_items, playlist_id, [video_id]))
         except Exception as e:
             print(f"Error adding track to playlist: {e}")
             return False
+
+    def add_tracks_to_playlist(self, playlist_id, video_ids):
+        """
+        Adds several tracks with a single request.
+        Returns the list of video IDs that could not be added. If the batch
+        as a whole is rejected, its tracks are retried one at a time so a
+        single bad track does not lose the others.
+        """
+        if not self.yt:
+            raise Exception("YTMusic not initialized.")
+        if not video_ids:
+            return []
+        try:
+            if self._succeeded(self._call(self.yt.add_playlist_items, playlist_id, list(video_ids))):
+                return []
+            print(f"Adding {len(video_ids)} tracks in one request failed, retrying them one by one")
+        except Exception as e:
+            print(f"Error adding {len(video_ids)} tracks to playlist, retrying them one by one: {e}")
+        return [video_id for video_id in video_ids if not self.add_track_to_playlist(playlist_id, video_id)]
+
+    @staticmethod
+    def _succeeded(response):
+        # add_playlist_items returns the raw response instead of raising when YouTube rejects the edit
+        return isinstance(response, dict) and 'SUCCEEDED' in str(response.get('status', ''))
+
+    def get_playlist_video_ids(self, playlist_id):
+        """
+        Returns the set of video IDs already in a playlist.
+        """
+        if not self.yt:
+            raise Exception("YTMusic not initialized.")
+        playlist = self._call(self.yt.get_playlist, playlist_id, limit=None)
+        return {track['videoId'] for track in playlist.get('tracks', []) if track.get('videoId')}
+
+    def playlist_batch(self, playlist_id, batch_size=None, flush_interval=None, existing=()):
+        """
+        Returns a PlaylistBatch that collects tracks for playlist_id and
+        adds them in chunks. Video IDs in existing are already in the
+        playlist and are reported as added without being sent again.
+        """
+        return PlaylistBatch(
+            self, playlist_id, existing=existing,
+            batch_size=batch_size or int(os.getenv('YTMUSIC_ADD_BATCH_SIZE', '50')),
+            flush_interval=flush_interval or float(os.getenv('YTMUSIC_ADD_FLUSH_INTERVAL', '5')),
+        )
+
+
+class PlaylistBatch:
+    """
+    Accumulates matched tracks for one playlist and adds them with one
+    add_playlist_items call per batch_size tracks (or sooner, once the
+    oldest pending track has waited flush_interval seconds), instead of
+    one request per track.
+
+    add() and flush() return the outcome of every track they wrote as
+    (item, error) pairs, where item is whatever the caller passed in and
+    error is None on success. Tracks already added to this playlist are
+    reported as duplicates rather than sent again, since YouTube Music
+    rejects a whole batch that contains a duplicate. Tracks given in
+    existing (e.g. added before a resumed conversion stopped) count as
+    added without being sent.
+    """
+    def __init__(self, service, playlist_id, batch_size=50, flush_interval=5.0, existing=()):
+        self.service = service
+        self.playlist_id = playlist_id
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._pending = [] # (video_id, item)
+        self._first_pending_at = None
+        self._seen = set()
+        self._existing = set(existing)
+
+    def add(self, video_id, item=None):
+        if video_id in self._existing:
+            self._existing.discard(video_id)
+            self._seen.add(video_id)
+            return [(item, None)]
+        if video_id in self._seen:
+            return [(item, 'duplicate')]
+        self._seen.add(video_id)
+        self._pending.append((video_id, item))
+        if self._first_pending_at is None:
+            self._first_pending_at = time.monotonic()
+        if self.due():
+            return self.flush()
+        return []
+
+    @property
+    def pending(self):
+        """
+        Number of tracks waiting to be written.
+        """
+        return len(self._pending)
+
+    def due(self):
+        """
+        True once the pending tracks should be written.
+        """
+        if not self._pending:
+            return False
+        return (len(self._pending) >= self.batch_size
+                or time.monotonic() - self._first_pending_at >= self.flush_interval)
+
+    def flush(self):
+        pending, self._pending, self._first_pending_at = self._pending, [], None
+        if not pending:
+            return []
+        failed = set(self.service.add_tracks_to_playlist(self.playlist_id, [video_id for video_id, _ in pending]))
+        return [(item, 'failed' if video_id in failed else None) for video_id, item in pending]
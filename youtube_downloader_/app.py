@@ -1,18 +1,44 @@
 # Import necessary libraries
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, request, jsonify, Response
 from flask_cors import CORS
 import yt_dlp
 import os
 import threading
-import queue
 import time
 import re
+import copy
+import signal
+import socket
+import io
+import hashlib
+import subprocess
+from urllib.parse import quote
+from werkzeug.http import http_date
+from werkzeug.middleware.proxy_fix import ProxyFix
+import hmac
+import json
+import bisect
+import zipfile
+import multiprocessing
+from contextlib import contextmanager
 import requests # Added for Gemini API calls
+from yt_dlp.postprocessor import FFmpegExtractAudioPP, FFmpegVideoConvertorPP, FFmpegVideoRemuxerPP
+from yt_dlp.postprocessor.ffmpeg import FFmpegPostProcessor
+from info_cache import InfoCache, normalize_video_key
+from artifact_store import ArtifactStore, make_artifact_key
+from task_store import create_task_store, TERMINAL_STATUSES
+from scheduler import FairScheduler
+from ydl_pool import YoutubeDLPool
 
 # Initialize the Flask application
 app = Flask(__name__)
 # Enable CORS for all routes, allowing your frontend to communicate with this backend
 CORS(app)
+# Behind a reverse proxy, take the client address and scheme from the
+# X-Forwarded-* headers added by the PROXY_HOPS trusted proxies
+PROXY_HOPS = int(os.getenv('PROXY_HOPS', '0'))
+if PROXY_HOPS:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=PROXY_HOPS, x_proto=PROXY_HOPS, x_host=PROXY_HOPS)
 
 # --- Configuration ---
 # IMPORTANT: Set the full path to your ffmpeg executable here.
@@ -30,12 +56,196 @@ DOWNLOAD_FOLDER = 'downloads'
 if not os.path.exists(DOWNLOAD_FOLDER):
     os.makedirs(DOWNLOAD_FOLDER)
 
-# A simple queue to manage download tasks.
-# This helps prevent the server from hanging on long downloads
-# and allows for more robust error handling.
-download_queue = queue.Queue()
-# A dictionary to store download statuses, keyed by a unique task ID
-download_statuses = {}
+# --- Worker Pool Configuration ---
+# Number of download workers pulling from the queue.
+DOWNLOAD_WORKERS = int(os.getenv('DOWNLOAD_WORKERS', '4'))
+# 'thread' runs workers inside the web process, 'process' runs each worker
+# in its own process (useful when ffmpeg work would starve the web server).
+# 'external' runs no workers in the web process at all: tasks are queued in the
+# SQLite task store and picked up by worker.py (see gunicorn.conf.py).
+WORKER_MODE = os.getenv('WORKER_MODE', 'thread')
+# How many tasks may fetch from the network at once.
+FETCH_CONCURRENCY = int(os.getenv('FETCH_CONCURRENCY', str(DOWNLOAD_WORKERS)))
+# How many ffmpeg conversions (FFmpegExtractAudio / FFmpegVideoConvertor) may run at once.
+POSTPROCESS_CONCURRENCY = int(os.getenv('POSTPROCESS_CONCURRENCY', str(max(1, (os.cpu_count() or 2) // 2))))
+
+# --- Info Cache Configuration ---
+# extract_info results are shared by /get_video_info and the workers.
+# Keep the TTL well below YouTube's stream URL expiry (~6 hours).
+INFO_CACHE_SIZE = int(os.getenv('INFO_CACHE_SIZE', '512'))
+INFO_CACHE_TTL = int(os.getenv('INFO_CACHE_TTL', '1800'))
+# Optional directory for an on-disk copy of the cache (shared between processes).
+# External workers run in another process than the /get_video_info requests that
+# warm the cache, so in that mode it is kept on disk by default.
+INFO_CACHE_DIR = os.getenv('INFO_CACHE_DIR') or (
+    os.path.join(DOWNLOAD_FOLDER, '.info_cache') if WORKER_MODE == 'external' else None
+)
+
+info_cache = InfoCache(max_entries=INFO_CACHE_SIZE, ttl=INFO_CACHE_TTL, disk_dir=INFO_CACHE_DIR)
+
+# --- YoutubeDL Pool Configuration ---
+# Extraction reuses YoutubeDL instances (with their warm extractors and open
+# HTTP connections) instead of building one per request. Up to
+# YDL_POOL_MAX_IDLE idle instances are kept per option set; each is replaced
+# after YDL_POOL_MAX_USES uses or YDL_POOL_MAX_AGE seconds.
+YDL_POOL_MAX_IDLE = int(os.getenv('YDL_POOL_MAX_IDLE', '4'))
+YDL_POOL_MAX_USES = int(os.getenv('YDL_POOL_MAX_USES', '500'))
+YDL_POOL_MAX_AGE = int(os.getenv('YDL_POOL_MAX_AGE', '3600'))
+# Instances built at startup, so the first /get_video_info is not cold
+YDL_POOL_PREWARM = int(os.getenv('YDL_POOL_PREWARM', '1'))
+
+ydl_pool = YoutubeDLPool(max_idle=YDL_POOL_MAX_IDLE, max_uses=YDL_POOL_MAX_USES, max_age=YDL_POOL_MAX_AGE)
+
+# Options for plain info extraction (/get_video_info and the workers)
+INFO_YDL_OPTS = {'quiet': True, 'no_warnings': True, 'skip_download': True, 'noplaylist': True}
+if FFMPEG_PATH: # Pass ffmpeg location for info extraction if specified
+    INFO_YDL_OPTS['ffmpeg_location'] = FFMPEG_PATH
+ydl_pool.prewarm(INFO_YDL_OPTS, YDL_POOL_PREWARM)
+
+# --- Artifact Store Configuration ---
+# Byte budget for DOWNLOAD_FOLDER; least recently used files are evicted beyond it.
+ARTIFACT_MAX_BYTES = int(os.getenv('ARTIFACT_MAX_BYTES', str(10 * 1024 ** 3))) # 10 GB
+# Optional maximum age (seconds) of a finished file, regardless of the budget
+ARTIFACT_MAX_AGE = int(os.getenv('ARTIFACT_MAX_AGE', '0')) or None
+# Seconds between eviction passes, so expiry happens even when nothing new is added
+ARTIFACT_SWEEP_INTERVAL = int(os.getenv('ARTIFACT_SWEEP_INTERVAL', '300'))
+
+# Finished downloads, keyed by (video ID, format, quality).
+# With external workers, the worker process owns the folder and web processes only read it.
+artifact_store = ArtifactStore(
+    DOWNLOAD_FOLDER, max_bytes=ARTIFACT_MAX_BYTES, max_age=ARTIFACT_MAX_AGE,
+    read_only=(WORKER_MODE == 'external'),
+)
+
+# --- Scheduling Configuration ---
+# Queued downloads are shared fairly between clients (see scheduler.py).
+# Clients are told apart by their address (see PROXY_HOPS above).
+# Trusted callers (e.g. another backend acting for many users) may name the
+# client with an X-Client-Id header, if they also send this token as X-Client-Token
+CLIENT_ID_TOKEN = os.getenv('CLIENT_ID_TOKEN', '')
+# Beyond these many queued tasks (in total, or for one client), new
+# downloads are rejected with 429 so the backlog cannot grow without bound.
+MAX_BACKLOG = int(os.getenv('MAX_BACKLOG', '2000'))
+MAX_CLIENT_BACKLOG = int(os.getenv('MAX_CLIENT_BACKLOG', '500'))
+# Seconds a rejected client is asked to wait (Retry-After)
+BACKLOG_RETRY_AFTER = 30
+# Used to estimate a task's cost when its video info is not cached yet
+DEFAULT_DURATION = 300 # seconds
+# Typical bitrates (kbit/s) of each video quality, for videos without a known filesize
+VIDEO_BITRATES = {'360p': 700, '480p': 1200, '720p': 2500, '1080p': 4500, '2K': 9000, '4K': 18000}
+# How often a running download checks whether it was cancelled
+CANCEL_CHECK_INTERVAL = 1.0
+
+# --- MP4 Conversion Configuration ---
+# How a downloaded file becomes the requested output, cheapest first:
+# 'copy' - already an MP4 (yt-dlp merged compatible streams), nothing to do
+# 'remux' - codecs MP4 can hold, only the container changes (stream copy)
+# 'audio_transcode' - video copied, audio (e.g. Opus) re-encoded to AAC
+# 'transcode' - video re-encoded as well (e.g. VP9)
+# 'extract_audio' - MP3 output
+CONVERSION_PATHS = ('copy', 'remux', 'audio_transcode', 'transcode', 'extract_audio')
+# Codec prefixes (as in yt-dlp's vcodec/acodec) that can be copied into an MP4 container
+MP4_VIDEO_CODECS = ('avc1', 'h264', 'hev1', 'hvc1', 'hevc', 'av01')
+MP4_AUDIO_CODECS = ('mp4a', 'aac', 'mp3', 'ac-3', 'ec-3')
+# Bitrate of the AAC track when only the audio has to be re-encoded
+MP4_AUDIO_BITRATE = '192k'
+# Among the formats allowed by the selector, prefer the highest resolution
+# and frame rate, then MP4/M4A streams, so compatible streams win whenever
+# they offer the same quality and the download only needs a remux
+MP4_FORMAT_SORT = ['res', 'fps', 'ext:mp4:m4a']
+
+# Download tasks waiting for a worker. In thread mode the workers take
+# tasks from the scheduler directly; in process mode a feeder thread hands
+# them to the workers' queue one idle worker at a time.
+task_scheduler = FairScheduler()
+download_queue = task_scheduler
+
+# --- Task Store Configuration ---
+# 'memory' keeps task statuses in this process; 'sqlite' stores them in
+# TASK_DB_PATH so several server processes can share them.
+TASK_STORE = os.getenv('TASK_STORE', 'memory')
+TASK_DB_PATH = os.getenv('TASK_DB_PATH', os.path.join(DOWNLOAD_FOLDER, '.tasks.sqlite3'))
+# Completed and failed tasks are forgotten after TASK_TTL seconds
+TASK_TTL = int(os.getenv('TASK_TTL', '3600'))
+MAX_TASKS = int(os.getenv('MAX_TASKS', '10000'))
+# Seconds between sweeps for expired tasks
+TASK_SWEEP_INTERVAL = 60
+# With the SQLite store, unfinished tasks are leased to the process running
+# them; a task whose lease was not renewed for TASK_LEASE seconds is failed
+TASK_LEASE = int(os.getenv('TASK_LEASE', '60'))
+TASK_HEARTBEAT_INTERVAL = 10
+# Identifies this process as the owner of the tasks it queues or runs
+TASK_OWNER = f"{socket.gethostname()}:{os.getpid()}:{os.urandom(4).hex()}"
+
+# Download statuses, keyed by a unique task ID
+if WORKER_MODE == 'external' and TASK_STORE != 'sqlite':
+    raise RuntimeError("WORKER_MODE=external requires TASK_STORE=sqlite")
+task_store = create_task_store(TASK_STORE, ttl=TASK_TTL, max_tasks=MAX_TASKS, db_path=TASK_DB_PATH, lease=TASK_LEASE)
+
+# --- Streaming Configuration ---
+# How many /stream responses (each running its own ffmpeg) may run at once
+STREAM_CONCURRENCY = int(os.getenv('STREAM_CONCURRENCY', '4'))
+# Whether a fully streamed MP3 is also kept in the artifact store. Streamed MP4s
+# never are: they are fragmented and built from other formats than /download's
+STREAM_TEE_TO_STORE = os.getenv('STREAM_TEE_TO_STORE', '1') == '1'
+STREAM_CHUNK_SIZE = 64 * 1024
+stream_slots = threading.BoundedSemaphore(STREAM_CONCURRENCY)
+
+# --- File Serving Configuration ---
+# When the app runs behind nginx, set this to an `internal` location that maps
+# to DOWNLOAD_FOLDER (e.g. '/protected-downloads/') and nginx will send the
+# files itself via X-Accel-Redirect.
+X_ACCEL_REDIRECT_PREFIX = os.getenv('X_ACCEL_REDIRECT_PREFIX', '')
+FILE_CHUNK_SIZE = 256 * 1024
+
+# --- Shutdown Configuration ---
+# How long a shutting-down worker waits for running downloads to finish
+DRAIN_TIMEOUT = int(os.getenv('DRAIN_TIMEOUT', '600'))
+# How often an external worker checks the task store for queued tasks
+CLAIM_POLL_INTERVAL = 0.5
+# Cleared when shutting down, so no new downloads are started
+accepting_downloads = threading.Event()
+accepting_downloads.set()
+
+# Separate limits for the network-bound and CPU-bound stages, so a long
+# 4K conversion does not hold back short MP3 jobs that are still fetching.
+fetch_slots = threading.BoundedSemaphore(FETCH_CONCURRENCY)
+postprocess_slots = threading.BoundedSemaphore(POSTPROCESS_CONCURRENCY)
+
+# --- Progress Event Configuration ---
+# Progress updates from yt-dlp are only published when the percentage moved
+# by at least PROGRESS_MIN_STEP points or PROGRESS_MIN_INTERVAL seconds passed.
+PROGRESS_MIN_STEP = float(os.getenv('PROGRESS_MIN_STEP', '1'))
+PROGRESS_MIN_INTERVAL = float(os.getenv('PROGRESS_MIN_INTERVAL', '0.5'))
+# Seconds between keep-alive comments on idle /download_events streams
+EVENTS_KEEPALIVE = 15
+
+# --- Batch Download Configuration ---
+# Most items one /download_batch request may queue (longer playlists are cut off)
+MAX_BATCH_ITEMS = int(os.getenv('MAX_BATCH_ITEMS', '500'))
+# How often /batch_events re-reads the progress of a batch's tasks
+BATCH_EVENTS_INTERVAL = 1.0
+
+# Pool statistics exposed on /stats, guarded by stats_lock
+stats_lock = threading.Lock()
+pool_stats = {
+    'active_workers': 0,
+    'stages': {
+        stage: {'count': 0, 'total_wait': 0.0, 'max_wait': 0.0}
+        for stage in ('queue', 'fetch', 'postprocess')
+    },
+    # Finished conversions by path, to see how much CPU transcoding costs
+    'conversions': {path: 0 for path in CONVERSION_PATHS},
+}
+# Hit/miss counters for the caches, also exposed on /stats
+cache_stats = {
+    'info_cache': {'hits': 0, 'misses': 0},
+}
+
+# In process mode, workers send status/stat events back over this queue.
+# _event_queue is what a worker publishes to, _pump_queue is what the web process reads.
+_event_queue = None
+_pump_queue = None
 
 # --- Helper Functions for yt-dlp ---
 
@@ -51,197 +261,941 @@ def sanitize_filename(filename):
     # Limit filename length to avoid issues on some file systems
     return filename[:200]
 
+# Offered video qualities by their shorter side (the height, or the width of a
+# portrait video: 1080x1920 is 1080p). A format counts for the lowest quality
+# at least as large as it (e.g. 1072p for 1080p), like the <=N selectors.
+VIDEO_QUALITIES = [(360, '360p'), (480, '480p'), (720, '720p'), (1080, '1080p'), (1440, '2K'), (2160, '4K')]
+VIDEO_QUALITY_HEIGHTS = [height for height, _ in VIDEO_QUALITIES]
+# Formats this much shorter than 360p are too small to offer as 360p
+MIN_VIDEO_HEIGHT = 240
+# MP3 bitrates FFmpeg can produce, in kbit/s
+AUDIO_TARGETS = (192, 256, 320)
+# Bump when the index layout changes, so indexes cached with older info dicts are rebuilt
+FORMATS_INDEX_VERSION = 3
+
+def format_size(fmt, duration):
+    """
+    Returns a format's size in bytes: exact, approximate, or estimated
+    from its bitrate and the video's duration. None if nothing is known.
+    """
+    size = fmt.get('filesize') or fmt.get('filesize_approx')
+    if not size and duration and fmt.get('tbr'):
+        size = int(fmt['tbr'] * duration * 125) # kbit/s to bytes
+    return size
+
+def build_formats_index(info):
+    """
+    Indexes an info dict's formats in one pass: the best video format for
+    each offered quality (by frame rate, then bitrate, then size) and the
+    best audio stream, which sizes the audio of every video quality and
+    decides which MP3 bitrates are worth offering.
+    """
+    duration = info.get('duration')
+    best_video = {} # quality -> (rank, format)
+    best_audio, best_audio_rank = None, None
+
+    for fmt in info.get('formats') or []:
+        has_video = fmt.get('vcodec') not in (None, 'none')
+        if has_video and fmt.get('height'):
+            side = min(fmt['height'], fmt.get('width') or fmt['height'])
+            position = bisect.bisect_left(VIDEO_QUALITY_HEIGHTS, side)
+            if side < MIN_VIDEO_HEIGHT or position == len(VIDEO_QUALITIES):
+                continue
+            quality = VIDEO_QUALITIES[position][1]
+            rank = (fmt.get('fps') or 0, fmt.get('tbr') or fmt.get('vbr') or 0, format_size(fmt, duration) or 0)
+            if quality not in best_video or rank > best_video[quality][0]:
+                best_video[quality] = (rank, fmt)
+        elif not has_video and fmt.get('acodec') not in (None, 'none'):
+            rank = (fmt.get('abr') or fmt.get('tbr') or 0, format_size(fmt, duration) or 0)
+            if best_audio_rank is None or rank > best_audio_rank:
+                best_audio, best_audio_rank = fmt, rank
+
+    audio_size = format_size(best_audio, duration) if best_audio else None
+    video_formats = []
+    for _, quality in VIDEO_QUALITIES:
+        if quality not in best_video:
+            continue
+        fmt = best_video[quality][1]
+        size = format_size(fmt, duration)
+        # Separate video streams are downloaded together with the best audio
+        if size and fmt.get('acodec') in (None, 'none'):
+            size += audio_size or 0
+        video_formats.append({
+            'quality': quality,
+            'format_id': fmt['format_id'],
+            'filesize': size,
+            'fps': fmt.get('fps') or 0,
+        })
+
+    # Offer the MP3 bitrates up to the first one that matches the source;
+    # encoding above the source's bitrate only makes the file bigger
+    source_kbps = best_audio_rank[0] if best_audio else None
+    audio_formats = []
+    for kbps in AUDIO_TARGETS:
+        audio_formats.append({
+            'quality': f'{kbps}kbps',
+            'filesize': int(kbps * duration * 125) if duration else None,
+            'source_bitrate': source_kbps,
+        })
+        if source_kbps and kbps >= source_kbps:
+            break
+
+    return {'video': video_formats, 'audio': audio_formats}
+
 def get_available_formats_info(info):
     """
     Extracts available video qualities (MP4) and audio qualities (MP3)
-    from yt-dlp info dictionary.
+    from yt-dlp info dictionary. The index is normally built once by
+    extract_video_info and cached with the info dict.
     """
     if not info:
         return {'video': [], 'audio': []}
+    index = info.get('_formats_index')
+    if index and index.get('version') == FORMATS_INDEX_VERSION:
+        return index['formats']
+    return build_formats_index(info)
 
-    video_formats = []
-    audio_formats = []
 
-    # Map common video heights to quality strings
-    video_quality_map = {
-        360: '360p', 480: '480p', 720: '720p', 1080: '1080p',
-        1440: '2K', 2160: '4K'
-    }
+class QueueFull(Exception):
+    """
+    Raised when a download is refused because too many are queued.
+    """
 
-    # Extract video formats
-    for fmt in info.get('formats', []):
-        # Check for video formats with 'mp4' extension and a video codec
-        if fmt.get('vcodec') != 'none' and fmt.get('ext') == 'mp4' and fmt.get('height'):
-            height = fmt['height']
-            if height in video_quality_map:
-                # Add only unique qualities to avoid duplicates
-                if video_quality_map[height] not in [f['quality'] for f in video_formats]:
-                    video_formats.append({
-                        'quality': video_quality_map[height],
-                        'format_id': fmt['format_id'],
-                        'filesize': fmt.get('filesize', 0),
-                        'fps': fmt.get('fps', 0)
-                    })
-
-    # Sort video formats by quality (e.g., 360p, 480p, ...)
-    quality_order = {'360p': 1, '480p': 2, '720p': 3, '1080p': 4, '2K': 5, '4K': 6}
-    video_formats.sort(key=lambda x: quality_order.get(x['quality'], 0))
-
-    # For audio, we'll offer fixed bitrates as per frontend request,
-    # as yt-dlp often gives various bitrates and converting to specific ones is common.
-    # In a more advanced setup, you'd parse available audio qualities.
-    audio_formats = ['192kbps', '256kbps', '320kbps'] # These are target bitrates for FFmpeg
+def estimate_cost(url, format_option, quality):
+    """
+    Estimates the work a download takes, in bytes to fetch, so the
+    scheduler can run short jobs (e.g. MP3s) first. Uses the cached info
+    dict when the video was looked up with /get_video_info beforehand.
+    """
+    info = info_cache.get(normalize_video_key(url))
+    duration = (info or {}).get('duration') or DEFAULT_DURATION
+    if format_option == 'mp3':
+        kbps = int(quality.replace('kbps', '')) if quality.replace('kbps', '').isdigit() else 192
+        return duration * kbps * 125
+    if info:
+        for fmt in get_available_formats_info(info)['video']:
+            if fmt['quality'] == quality and fmt.get('filesize'):
+                return fmt['filesize']
+    return duration * VIDEO_BITRATES.get(quality, VIDEO_BITRATES['1080p']) * 125
 
-    return {'video': video_formats, 'audio': audio_formats}
+def is_cancelled(task_id):
+    """
+    Returns True if the task was cancelled while it was running.
+    A worker process cannot see the web process's in-memory task store,
+    so there running downloads finish and their result is discarded.
+    """
+    if _event_queue is not None and TASK_STORE != 'sqlite':
+        return False
+    task = task_store.get(task_id)
+    return task is not None and task['status'] in ('cancelling', 'cancelled')
 
+def check_cancelled(task_id):
+    if is_cancelled(task_id):
+        raise yt_dlp.utils.DownloadCancelled(f"Task {task_id} was cancelled")
 
-def download_worker():
+def update_status(task_id, **fields):
     """
-    Worker function to process download tasks from the queue.
-    Runs in a separate thread.
+    Applies a partial update to a task's status record.
+    Worker processes cannot touch the parent's dictionary directly,
+    so in process mode the update is forwarded through the event queue.
     """
-    while True:
-        task_id, url, format_option, quality = download_queue.get()
-        download_statuses[task_id] = {'status': 'processing', 'progress': 0, 'file_path': None, 'error': None}
-        print(f"Starting download for task {task_id}: {url} ({format_option}, {quality})")
+    _publish(('status', task_id, fields))
+
+def record_wait(stage, seconds):
+    """
+    Records how long a task waited for a slot in the given stage
+    ('queue', 'fetch' or 'postprocess') so the pool can be sized.
+    """
+    _publish(('wait', stage, seconds))
+
+def register_artifact(key, path, title):
+    """
+    Records a finished file in the artifact store so repeat requests
+    for the same video, format and quality are served from it.
+    """
+    _publish(('artifact', key, path, title))
+
+def record_conversion(task_id, path):
+    """
+    Records which CONVERSION_PATHS entry a task took.
+    """
+    update_status(task_id, conversion=path)
+    _publish(('conversion', path))
 
+def record_cache_event(cache_name, outcome):
+    """
+    Counts a cache lookup outcome ('hits' or 'misses') for /stats.
+    """
+    _publish(('cache', cache_name, outcome))
+
+def _publish(event):
+    if _event_queue is not None:
+        _event_queue.put(event)
+    else:
+        _apply_event(event)
+
+def _apply_event(event):
+    kind = event[0]
+    if kind == 'status':
+        _, task_id, fields = event
+        # The task store does its own locking
+        task_store.update(task_id, **fields)
+        return
+
+    with stats_lock:
+        if kind == 'artifact':
+            _, key, path, title = event
+            artifact_store.add(key, path, title)
+        elif kind == 'wait':
+            _, stage, seconds = event
+            stage_stats = pool_stats['stages'][stage]
+            stage_stats['count'] += 1
+            stage_stats['total_wait'] += seconds
+            stage_stats['max_wait'] = max(stage_stats['max_wait'], seconds)
+        elif kind == 'active':
+            pool_stats['active_workers'] += event[1]
+        elif kind == 'conversion':
+            pool_stats['conversions'][event[1]] += 1
+        elif kind == 'cache':
+            _, cache_name, outcome = event
+            cache_stats[cache_name][outcome] += 1
+
+def _expire_tasks_loop():
+    """
+    Periodically forgets finished tasks older than TASK_TTL so the task
+    store does not grow forever.
+    """
+    while True:
+        time.sleep(TASK_SWEEP_INTERVAL)
         try:
-            # First, get video info to determine title for filename
-            ydl_info_opts = {'quiet': True, 'no_warnings': True, 'skip_download': True}
-            if FFMPEG_PATH: # Pass ffmpeg location for info extraction if specified
-                ydl_info_opts['ffmpeg_location'] = FFMPEG_PATH
-            with yt_dlp.YoutubeDL(ydl_info_opts) as ydl_info:
-                info_dict = ydl_info.extract_info(url, download=False)
-                if not info_dict:
-                    raise Exception("Could not retrieve video information.")
-                video_title = info_dict.get('title', 'downloaded_file')
-                sanitized_title = sanitize_filename(video_title)
-
-            final_ext = 'mp3' if format_option == 'mp3' else 'mp4'
-            output_template = os.path.join(DOWNLOAD_FOLDER, f"{sanitized_title}.%(ext)s")
-
-            ydl_opts = {
-                'outtmpl': output_template,
-                'noplaylist': True, # Do not download playlists
-                'progress_hooks': [lambda d: progress_hook(d, task_id)], # Custom progress hook
-                'postprocessors': [],
-                'quiet': True, # Suppress console output from yt-dlp
-                'no_warnings': True, # Suppress warnings
-            }
+            removed = task_store.expire()
+            if removed:
+                print(f"Expired {removed} finished tasks")
+        except Exception as e:
+            print(f"Task expiry failed: {e}")
 
-            # Add ffmpeg location if specified
-            if FFMPEG_PATH:
-                ydl_opts['ffmpeg_location'] = FFMPEG_PATH
-
-            if format_option == 'mp3':
-                ydl_opts['format'] = 'bestaudio/best'
-                ydl_opts['postprocessors'].append({
-                    'key': 'FFmpegExtractAudio',
-                    'preferredcodec': 'mp3',
-                    'preferredquality': quality.replace('kbps', ''), # e.g., '192' from '192kbps'
-                })
-                # Ensure the output template uses .mp3 extension for MP3
-                ydl_opts['outtmpl'] = os.path.join(DOWNLOAD_FOLDER, f"{sanitized_title}.mp3")
-            elif format_option == 'mp4':
-                # Explicitly request best video and best audio formats
-                # Then use FFmpegMerger to combine them and ensure AAC audio.
-                if quality == '360p':
-                    ydl_opts['format'] = 'bestvideo[height<=360]+bestaudio'
-                elif quality == '480p':
-                    ydl_opts['format'] = 'bestvideo[height<=480]+bestaudio'
-                elif quality == '720p':
-                    ydl_opts['format'] = 'bestvideo[height<=720]+bestaudio'
-                elif quality == '1080p':
-                    ydl_opts['format'] = 'bestvideo[height<=1080]+bestaudio'
-                elif quality == '2K': # Corresponds to 1440p
-                    ydl_opts['format'] = 'bestvideo[height<=1440]+bestaudio'
-                elif quality == '4K': # Corresponds to 2160p
-                    ydl_opts['format'] = 'bestvideo[height<=2160]+bestaudio'
-                else: # Fallback for any unhandled quality, or 'best'
-                    ydl_opts['format'] = 'bestvideo+bestaudio'
-                
-                # Use FFmpegMerger to combine video and audio, and re-encode audio to aac
-                ydl_opts['postprocessors'].append({
-                    'key': 'FFmpegVideoConvertor',
-                    'preferedformat': 'mp4'
-                    })
-
-                 # Ensure the output template uses .mp4 extension
-                ydl_opts['outtmpl'] = os.path.join(DOWNLOAD_FOLDER, f"{sanitized_title}.%(ext)s")
-
-                found_file = None
-                expected_ext = 'mp4' if format_option == 'mp4' else 'mp3'
-
-# Check for file with correct prefix and extension
-                for fname in os.listdir(DOWNLOAD_FOLDER):
-                    if fname.startswith(sanitized_title) and fname.endswith(f".{expected_ext}"):
-                        found_file = os.path.join(DOWNLOAD_FOLDER, fname)
-                        break
-
-# Update download status
-                if found_file and os.path.exists(found_file):
-                    download_statuses[task_id]['status'] = 'completed'
-                    download_statuses[task_id]['progress'] = 100
-                    download_statuses[task_id]['file_path'] = found_file
-                    print(f"Download completed for task {task_id}: {found_file}")
-                else:
-                    download_statuses[task_id]['status'] = 'failed'
-                    download_statuses[task_id]['error'] = 'File not found after download. Check yt-dlp output for exact filename.'
-                    print(f"Download failed for task {task_id}: File not found.")
-
-
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                ydl.download([url])
-
-                # Check if the file exists after download
-                found_file = None
-                # yt-dlp might add format_id to filename, so we look for files starting with sanitized title
-                for fname in os.listdir(DOWNLOAD_FOLDER):
-                    if fname.startswith(sanitized_title) and fname.endswith(f".{final_ext}"):
-                        found_file = os.path.join(DOWNLOAD_FOLDER, fname)
-                        break
-
-                if found_file and os.path.exists(found_file):
-                    download_statuses[task_id]['status'] = 'completed'
-                    download_statuses[task_id]['progress'] = 100
-                    download_statuses[task_id]['file_path'] = found_file
-                    print(f"Download completed for task {task_id}: {found_file}")
-                else:
-                    download_statuses[task_id]['status'] = 'failed'
-                    download_statuses[task_id]['error'] = 'File not found after download. Check yt-dlp output for exact filename.'
-                    print(f"Download failed for task {task_id}: File not found.")
+def _evict_artifacts_loop():
+    """
+    Periodically evicts expired artifacts; otherwise files would only
+    be evicted when a new one is added. Also prunes the on-disk info
+    cache, which the artifact budget does not cover.
+    """
+    while True:
+        time.sleep(ARTIFACT_SWEEP_INTERVAL)
+        try:
+            artifact_store.evict()
+        except Exception as e:
+            print(f"Artifact eviction failed: {e}")
+        try:
+            pruned = info_cache.prune()
+            if pruned:
+                print(f"Pruned {pruned} info cache files")
+        except Exception as e:
+            print(f"Info cache pruning failed: {e}")
 
-        except yt_dlp.DownloadError as e:
-            download_statuses[task_id]['status'] = 'failed'
-            download_statuses[task_id]['error'] = str(e)
-            print(f"Download failed for task {task_id} with yt-dlp error: {e}")
+def _heartbeat_loop():
+    """
+    Keeps the leases on this process's unfinished tasks fresh, so other
+    processes can tell them from tasks left behind by a stopped process.
+    """
+    while True:
+        time.sleep(TASK_HEARTBEAT_INTERVAL)
+        try:
+            task_store.heartbeat()
         except Exception as e:
-            download_statuses[task_id]['status'] = 'failed'
-            download_statuses[task_id]['error'] = f"An unexpected error occurred: {str(e)}"
-            print(f"Download failed for task {task_id} with unexpected error: {e}")
+            print(f"Task heartbeat failed: {e}")
+
+def start_task_maintenance():
+    threading.Thread(target=_expire_tasks_loop, daemon=True).start()
+    threading.Thread(target=_evict_artifacts_loop, daemon=True).start()
+    threading.Thread(target=_heartbeat_loop, daemon=True).start()
+
+def _event_pump():
+    """
+    Runs in the web process when WORKER_MODE is 'process' and applies
+    status/stat events sent back by the worker processes.
+    """
+    while True:
+        _apply_event(_pump_queue.get())
+
+@contextmanager
+def stage_slot(task_id, stage, semaphore):
+    """
+    Holds one of the limited slots for a pipeline stage while the body runs,
+    recording the time spent waiting for it.
+    """
+    wait_started = time.time()
+    semaphore.acquire()
+    waited = time.time() - wait_started
+    record_wait(stage, waited)
+    update_status(task_id, stage=stage)
+    try:
+        yield
+    finally:
+        semaphore.release()
+
+def extract_video_info(url, refresh=False):
+    """
+    Returns the yt-dlp info dictionary for a URL.
+    Results are cached by normalized video ID, so /get_video_info and the
+    download worker share a single extraction per video.
+    The returned dictionary is shared; copy it before handing it to yt-dlp.
+    """
+    key = normalize_video_key(url)
+    if refresh:
+        # Its stream URLs failed, so other processes should not reuse it either
+        info_cache.invalidate(key)
+    else:
+        info = info_cache.get(key)
+        if info is not None:
+            record_cache_event('info_cache', 'hits')
+            return info
+    record_cache_event('info_cache', 'misses')
+
+    with ydl_pool.checkout(INFO_YDL_OPTS) as ydl:
+        info = ydl.extract_info(url, download=False)
+        if not info:
+            raise Exception("Could not retrieve video information.")
+        # Make the dictionary JSON-serializable so it can be persisted
+        info = ydl.sanitize_info(info)
+
+    # Cached with the info dict, so /get_video_info and cost estimates do not
+    # walk the format list again
+    info['_formats_index'] = {'version': FORMATS_INDEX_VERSION, 'formats': build_formats_index(info)}
+    info_cache.put(key, info)
+    return info
+
+def extract_playlist_entries(url, limit=MAX_BATCH_ITEMS):
+    """
+    Lists the videos of a playlist (or channel, or a single video) with one
+    flat extraction: only the playlist pages are fetched, not each video's
+    formats, which the workers extract when they download the item.
+    Returns (playlist title, [(video URL, video title)]).
+    """
+    ydl_opts = {
+        'quiet': True, 'no_warnings': True, 'skip_download': True,
+        'extract_flat': 'in_playlist', 'playlistend': limit,
+    }
+    with ydl_pool.checkout(ydl_opts) as ydl:
+        info = ydl.extract_info(url, download=False)
+    if not info:
+        raise Exception("Could not retrieve playlist information.")
+
+    if info.get('_type') not in ('playlist', 'multi_video'):
+        return info.get('title'), [(info.get('webpage_url') or url, info.get('title'))]
+
+    entries = []
+    for entry in info.get('entries') or []:
+        if not entry:
+            continue
+        entry_url = entry.get('url') or entry.get('webpage_url')
+        # Flat YouTube entries may only carry the video ID
+        if entry.get('ie_key') == 'Youtube' and entry.get('id') and not (entry_url or '').startswith('http'):
+            entry_url = f"https://www.youtube.com/watch?v={entry['id']}"
+        if entry_url:
+            entries.append((entry_url, entry.get('title')))
+    return info.get('title'), entries[:limit]
+
+def is_portrait(info):
+    """
+    Returns True for videos taller than they are wide (e.g. Shorts),
+    judged by the info dict's own dimensions or its first sized format.
+    """
+    candidates = [info] + [fmt for fmt in info.get('formats') or [] if fmt.get('vcodec') not in (None, 'none')]
+    for candidate in candidates:
+        if candidate.get('width') and candidate.get('height'):
+            return candidate['width'] < candidate['height']
+    return False
+
+def build_format_selector(format_option, quality, portrait=False):
+    """
+    Returns the yt-dlp format selector for the requested output.
+    Qualities name the shorter side, so for a portrait video the limit
+    applies to the width (see VIDEO_QUALITIES).
+    """
+    if format_option == 'mp3':
+        return 'bestaudio/best'
+    side = 'width' if portrait else 'height'
+    # Explicitly request best video and best audio formats;
+    # yt-dlp merges them once both streams are fetched.
+    if quality == '360p':
+        return f'bestvideo[{side}<=360]+bestaudio'
+    elif quality == '480p':
+        return f'bestvideo[{side}<=480]+bestaudio'
+    elif quality == '720p':
+        return f'bestvideo[{side}<=720]+bestaudio'
+    elif quality == '1080p':
+        return f'bestvideo[{side}<=1080]+bestaudio'
+    elif quality == '2K': # Corresponds to 1440p
+        return f'bestvideo[{side}<=1440]+bestaudio'
+    elif quality == '4K': # Corresponds to 2160p
+        return f'bestvideo[{side}<=2160]+bestaudio'
+    else: # Fallback for any unhandled quality, or 'best'
+        return 'bestvideo+bestaudio'
+
+class FFmpegAudioTranscodePP(FFmpegVideoConvertorPP):
+    """
+    Converts to MP4 copying the video stream and re-encoding only the
+    audio to AAC, for video MP4 can hold paired with audio it cannot.
+    """
+    _ACTION = 'converting audio of'
+
+    @staticmethod
+    def _options(target_ext):
+        yield from FFmpegPostProcessor.stream_copy_opts(False)
+        yield from ('-c:v', 'copy', '-c:a', 'aac', '-b:a', MP4_AUDIO_BITRATE)
+
+def has_codec(codec, prefixes):
+    return bool(codec) and codec.lower().startswith(prefixes)
+
+def plan_conversion(downloaded, format_option):
+    """
+    Picks the cheapest CONVERSION_PATHS entry that turns the downloaded
+    file into the requested output, from the codecs yt-dlp reports.
+    """
+    if format_option == 'mp3':
+        return 'extract_audio'
+    video_ok = has_codec(downloaded.get('vcodec'), MP4_VIDEO_CODECS)
+    acodec = downloaded.get('acodec')
+    audio_ok = acodec == 'none' or has_codec(acodec, MP4_AUDIO_CODECS)
+    if video_ok and audio_ok:
+        return 'copy' if downloaded.get('ext') == 'mp4' else 'remux'
+    if video_ok:
+        return 'audio_transcode'
+    return 'transcode'
+
+def build_postprocessor(ydl, format_option, quality, conversion):
+    """
+    Returns the ffmpeg post-processor for the planned conversion, or None
+    if the file is already in its final form. It is run separately from
+    the download so it can be given its own concurrency limit.
+    """
+    if conversion == 'extract_audio':
+        return FFmpegExtractAudioPP(
+            ydl,
+            preferredcodec='mp3',
+            preferredquality=quality.replace('kbps', ''), # e.g., '192' from '192kbps'
+        )
+    if conversion == 'remux':
+        return FFmpegVideoRemuxerPP(ydl, preferedformat='mp4')
+    if conversion == 'audio_transcode':
+        return FFmpegAudioTranscodePP(ydl, preferedformat='mp4')
+    if conversion == 'transcode':
+        return FFmpegVideoConvertorPP(ydl, preferedformat='mp4')
+    return None
+
+def process_download(task_id, url, format_option, quality):
+    """
+    Downloads a single task: fetches the streams under the fetch limit,
+    then converts them under the post-processing limit.
+    """
+    update_status(task_id, status='processing', progress=0, file_path=None, error=None)
+    print(f"Starting download for task {task_id}: {url} ({format_option}, {quality})")
+
+    artifact_key = None
+    succeeded = False
+    try:
+        check_cancelled(task_id)
+        # First, get video info to determine title for filename
+        # (usually already cached by /get_video_info)
+        info_dict = extract_video_info(url)
+        video_title = info_dict.get('title', 'downloaded_file')
+        update_status(task_id, title=video_title)
+
+        # Files are named after the artifact key rather than the title, so
+        # different videos with the same title never share an output path
+        artifact_key = make_artifact_key(normalize_video_key(url), format_option, quality)
+
+        ydl_opts = {
+            'outtmpl': artifact_store.output_template(artifact_key),
+            'noplaylist': True, # Do not download playlists
+            'progress_hooks': [make_progress_hook(task_id)], # Custom (throttled) progress hook
+            'quiet': True, # Suppress console output from yt-dlp
+            'no_warnings': True, # Suppress warnings
+        }
+
+        # Add ffmpeg location if specified
+        if FFMPEG_PATH:
+            ydl_opts['ffmpeg_location'] = FFMPEG_PATH
+
+        ydl_opts['format'] = build_format_selector(format_option, quality, is_portrait(info_dict))
+        if format_option == 'mp4':
+            ydl_opts['format_sort'] = MP4_FORMAT_SORT
+
+        # Not taken from ydl_pool: the output template and progress hook belong to this task
+        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            # Network-bound stage: fetch (and merge) the selected streams
+            with stage_slot(task_id, 'fetch', fetch_slots):
+                # Download from the already extracted info instead of extracting again
+                try:
+                    downloaded = ydl.process_ie_result(copy.deepcopy(info_dict), download=True)
+                except yt_dlp.DownloadError:
+                    # The cached stream URLs may have expired; re-extract once and retry
+                    info_dict = extract_video_info(url, refresh=True)
+                    downloaded = ydl.process_ie_result(copy.deepcopy(info_dict), download=True)
+            # yt-dlp reports the exact path of each downloaded (and merged) file
+            downloaded = downloaded['requested_downloads'][0]
+
+            check_cancelled(task_id)
+            conversion = plan_conversion(downloaded, format_option)
+            record_conversion(task_id, conversion)
+            postprocessor = build_postprocessor(ydl, format_option, quality, conversion)
+            if conversion in ('copy', 'remux'):
+                # Stream copies are I/O-bound and quick, so they do not wait
+                # behind long transcodes for a post-processing slot
+                if postprocessor:
+                    update_status(task_id, stage='postprocess')
+                    downloaded = ydl.run_pp(postprocessor, downloaded)
+            else:
+                # CPU-bound stage: FFmpegExtractAudio / FFmpegVideoConvertor
+                with stage_slot(task_id, 'postprocess', postprocess_slots):
+                    downloaded = ydl.run_pp(postprocessor, downloaded)
+
+        # The post-processor updates 'filepath' to the converted file,
+        # so there is no need to search the download folder for it
+        found_file = downloaded.get('filepath')
+
+        if found_file and os.path.exists(found_file):
+            register_artifact(artifact_key, found_file, video_title)
+            succeeded = True
+            update_status(task_id, status='completed', stage='done', progress=100, file_path=found_file)
+            print(f"Download completed for task {task_id}: {found_file}")
+        else:
+            update_status(task_id, status='failed', error=f'File not found after download: {found_file}')
+            print(f"Download failed for task {task_id}: File not found.")
+
+    except yt_dlp.utils.DownloadCancelled:
+        # Nothing writes to the output paths any more, so the task can let go of them
+        update_status(task_id, status='cancelled', stage='done')
+        print(f"Download cancelled for task {task_id}")
+    except yt_dlp.DownloadError as e:
+        update_status(task_id, status='failed', error=str(e))
+        print(f"Download failed for task {task_id} with yt-dlp error: {e}")
+    except Exception as e:
+        update_status(task_id, status='failed', error=f"An unexpected error occurred: {str(e)}")
+        print(f"Download failed for task {task_id} with unexpected error: {e}")
+    finally:
+        if artifact_key and not succeeded:
+            discard_leftovers(artifact_key, format_option)
+
+def discard_leftovers(artifact_key, format_option):
+    """
+    Deletes what a failed or cancelled task left in the download folder
+    (partial downloads, separate video/audio streams, unconverted files).
+    """
+    removed = artifact_store.remove_leftovers(artifact_key, final_ext=f'.{format_option}')
+    if removed:
+        print(f"Removed {removed} leftover files of {artifact_key}")
+
+def remove_untracked_files():
+    """
+    Deletes files in the download folder that no artifact owns, e.g. left
+    behind by downloads that were running when the server stopped.
+    Only for the process that owns the folder, before it starts downloading.
+    """
+    removed = artifact_store.remove_leftovers()
+    if removed:
+        print(f"Removed {removed} untracked files from {DOWNLOAD_FOLDER}")
+
+def ffmpeg_executable():
+    """
+    Returns the ffmpeg binary to run directly (FFMPEG_PATH may be the binary
+    itself or the directory containing it).
+    """
+    if not FFMPEG_PATH:
+        return 'ffmpeg'
+    if os.path.isdir(FFMPEG_PATH):
+        return os.path.join(FFMPEG_PATH, 'ffmpeg')
+    return FFMPEG_PATH
+
+def build_stream_command(info, format_option, quality):
+    """
+    Selects the source streams for a streamed download and returns the
+    ffmpeg command that writes the result to stdout.
+    MP3 is encoded on the fly; MP4 is only offered when the streams can
+    be remuxed without re-encoding. Raises yt_dlp.DownloadError if no
+    suitable streams exist.
+    """
+    if format_option == 'mp3':
+        selector = 'bestaudio/best'
+    else:
+        # Only mp4 video + m4a audio can be copied into an MP4 container as-is
+        selector = build_format_selector(format_option, quality, is_portrait(info))
+        selector = selector.replace('bestvideo', 'bestvideo[ext=mp4]', 1).replace('+bestaudio', '+bestaudio[ext=m4a]', 1)
+
+    ydl_opts = {'quiet': True, 'no_warnings': True, 'noplaylist': True, 'format': selector}
+    with ydl_pool.checkout(ydl_opts) as ydl:
+        selected = ydl.process_ie_result(copy.deepcopy(info), download=False)
+    sources = selected.get('requested_formats') or [selected]
+
+    command = [ffmpeg_executable(), '-hide_banner', '-loglevel', 'error']
+    for source in sources:
+        headers = ''.join(f"{name}: {value}\r\n" for name, value in (source.get('http_headers') or {}).items())
+        if headers:
+            command += ['-headers', headers]
+        command += ['-i', source['url']]
+
+    if format_option == 'mp3':
+        bitrate = quality.replace('kbps', '') + 'k' # e.g., '192k' from '192kbps'
+        command += ['-vn', '-codec:a', 'libmp3lame', '-b:a', bitrate, '-f', 'mp3']
+    else:
+        # Fragmented MP4, since a pipe cannot be seeked back to write the index
+        command += ['-map', '0:v:0', '-map', f'{len(sources) - 1}:a:0', '-c', 'copy',
+                    '-movflags', 'frag_keyframe+empty_moov+default_base_moof', '-f', 'mp4']
+    command.append('pipe:1')
+    return command
+
+def download_worker():
+    """
+    Worker function to process download tasks from the queue.
+    Runs in a separate thread or process, DOWNLOAD_WORKERS of them at once.
+    """
+    while True:
+        task_id, url, format_option, quality, queued_at = download_queue.get()
+        record_wait('queue', time.time() - queued_at)
+        _publish(('active', 1))
+        try:
+            process_download(task_id, url, format_option, quality)
         finally:
+            _publish(('active', -1))
             download_queue.task_done() # Mark the task as done in the queue
 
-def progress_hook(d, task_id):
+def _process_worker_main(task_queue, event_queue, fetch_semaphore, postprocess_semaphore):
+    """
+    Entry point of a worker process: rebinds the shared queue and
+    semaphores, then runs the normal worker loop.
+    """
+    global download_queue, _event_queue, fetch_slots, postprocess_slots
+    download_queue = task_queue
+    _event_queue = event_queue
+    fetch_slots = fetch_semaphore
+    postprocess_slots = postprocess_semaphore
+    download_worker()
+
+def make_progress_hook(task_id):
+    """
+    Returns a progress hook bound to a task, remembering what was last
+    published so updates can be throttled.
+    """
+    last_sent = {'progress': None, 'time': 0.0, 'cancel_check': time.time()}
+    return lambda d: progress_hook(d, task_id, last_sent)
+
+def progress_hook(d, task_id, last_sent):
     """
     Custom progress hook for yt-dlp to update download status.
+    yt-dlp calls it many times per second, so an update is only published
+    when the percentage moved enough or enough time has passed.
+    Raising from the hook is how a cancelled download is stopped.
     """
+    if d['status'] == 'downloading' and time.time() - last_sent['cancel_check'] >= CANCEL_CHECK_INTERVAL:
+        last_sent['cancel_check'] = time.time()
+        check_cancelled(task_id)
     if d['status'] == 'downloading':
         if '_percent_str' in d:
             try:
                 progress = float(d['_percent_str'].replace('%', '').strip())
-                download_statuses[task_id]['progress'] = progress
             except ValueError:
-                pass # Ignore if percentage string is not a valid float
+                return # Ignore if percentage string is not a valid float
+            now = time.time()
+            if (last_sent['progress'] is None
+                    or abs(progress - last_sent['progress']) >= PROGRESS_MIN_STEP
+                    or now - last_sent['time'] >= PROGRESS_MIN_INTERVAL):
+                last_sent['progress'] = progress
+                last_sent['time'] = now
+                update_status(task_id, progress=progress)
     elif d['status'] == 'finished':
-        download_statuses[task_id]['progress'] = 100
-        download_statuses[task_id]['status'] = 'completed'
-        if 'filename' in d:
-            download_statuses[task_id]['file_path'] = d['filename']
+        # The stream is fetched, but conversion still has to run before
+        # the task is completed.
+        update_status(task_id, progress=100)
         print(f"Task {task_id} finished downloading.")
 
-# Start the download worker thread
-threading.Thread(target=download_worker, daemon=True).start()
+def start_download_workers(mode=None):
+    """
+    Starts the download worker pool according to WORKER_MODE
+    (or the given mode, 'thread' or 'process').
+    """
+    global download_queue, fetch_slots, postprocess_slots, _pump_queue
+    if (mode or WORKER_MODE) == 'process':
+        ctx = multiprocessing.get_context()
+        download_queue = ctx.JoinableQueue()
+        fetch_slots = ctx.BoundedSemaphore(FETCH_CONCURRENCY)
+        postprocess_slots = ctx.BoundedSemaphore(POSTPROCESS_CONCURRENCY)
+        _pump_queue = ctx.Queue()
+        threading.Thread(target=_event_pump, daemon=True).start()
+        threading.Thread(target=_feed_from_scheduler, daemon=True).start()
+        for i in range(DOWNLOAD_WORKERS):
+            ctx.Process(
+                target=_process_worker_main,
+                args=(download_queue, _pump_queue, fetch_slots, postprocess_slots),
+                name=f"download-worker-{i}",
+                daemon=True,
+            ).start()
+    else:
+        for i in range(DOWNLOAD_WORKERS):
+            threading.Thread(target=download_worker, name=f"download-worker-{i}", daemon=True).start()
+
+def _queue_depth():
+    depth = task_scheduler.qsize()
+    if download_queue is not task_scheduler:
+        try:
+            depth += download_queue.qsize()
+        except NotImplementedError: # multiprocessing queues on macOS
+            pass
+    return depth
+
+def _feed_from_scheduler():
+    """
+    Runs in the web process when WORKER_MODE is 'process' and moves tasks
+    from the scheduler to the worker processes' queue, only as many as
+    there are idle workers, so the order is still decided by the scheduler.
+    """
+    while True:
+        with stats_lock:
+            busy = pool_stats['active_workers']
+        try:
+            handed_off = download_queue.qsize()
+        except NotImplementedError:
+            handed_off = 0
+        if busy + handed_off >= DOWNLOAD_WORKERS:
+            time.sleep(CLAIM_POLL_INTERVAL)
+            continue
+        download_queue.put(task_scheduler.get())
+
+def drain_downloads(timeout=DRAIN_TIMEOUT):
+    """
+    Stops accepting new downloads and waits up to timeout seconds for
+    queued and running ones to finish. Returns True if everything finished.
+    """
+    accepting_downloads.clear()
+    deadline = time.time() + timeout
+    while True:
+        with stats_lock:
+            active_workers = pool_stats['active_workers']
+        if active_workers == 0 and not _queue_depth():
+            return True
+        if time.time() >= deadline:
+            print(f"Shutdown timeout: {active_workers} downloads still running")
+            return False
+        time.sleep(0.5)
+
+def _feed_from_task_store():
+    """
+    Claims queued tasks from the shared task store and hands them to the
+    local pool, only taking as many as there are idle workers so the rest
+    stay available in the store. Returns once shutdown begins.
+    """
+    while accepting_downloads.is_set():
+        with stats_lock:
+            busy = pool_stats['active_workers']
+        task = None
+        if busy + (_queue_depth() or 0) < DOWNLOAD_WORKERS:
+            task = task_store.claim_next()
+        if task is None:
+            time.sleep(CLAIM_POLL_INTERVAL)
+            continue
+        task_scheduler.put(
+            task['task_id'],
+            (task['task_id'], task['url'], task['format_option'], task['quality'], task['queued_at']),
+            task['client'], task['cost'] or 0,
+        )
+
+def run_external_worker():
+    """
+    Entry point of the standalone download worker (worker.py) used with
+    WORKER_MODE=external. Runs a thread pool fed from the SQLite task store
+    and, on SIGTERM/SIGINT, stops claiming tasks and lets running
+    downloads finish before exiting.
+    """
+    global artifact_store
+    # This process owns the download folder
+    artifact_store = ArtifactStore(DOWNLOAD_FOLDER, max_bytes=ARTIFACT_MAX_BYTES, max_age=ARTIFACT_MAX_AGE)
+    # ...and the tasks it claims
+    task_store.owner = TASK_OWNER
+    remove_untracked_files()
+
+    requeued = task_store.requeue_unfinished()
+    if requeued:
+        print(f"Requeued {requeued} tasks left unfinished by a previous worker")
+
+    def handle_shutdown(signum, frame):
+        print("Shutdown requested, finishing running downloads...")
+        accepting_downloads.clear()
+
+    signal.signal(signal.SIGTERM, handle_shutdown)
+    signal.signal(signal.SIGINT, handle_shutdown)
+
+    start_download_workers('thread')
+    start_task_maintenance()
+    print(f"Download worker started with {DOWNLOAD_WORKERS} workers")
+    _feed_from_task_store()
+    if drain_downloads():
+        print("All downloads finished, exiting.")
+
+# Start the download worker pool (only once, not again inside worker processes,
+# and not at all when an external worker does the downloading)
+if multiprocessing.current_process().name == 'MainProcess' and WORKER_MODE != 'external':
+    if TASK_STORE == 'sqlite':
+        # Tasks queued here live in this process's scheduler, so they are leased to it.
+        # Unowned queued tasks were left by an older version or an external
+        # worker setup; nothing will run them in this mode.
+        task_store.owner = TASK_OWNER
+        abandoned = task_store.fail_abandoned(include_unowned=True)
+        if abandoned:
+            print(f"Failed {abandoned} tasks left unfinished by a stopped server process")
+    remove_untracked_files()
+    start_download_workers()
+    start_task_maintenance()
+
+# --- File Serving ---
+
+def artifact_etag(artifact_key, artifact):
+    """
+    Returns a strong ETag for an artifact. The file for a key never changes
+    once written, so the key plus its creation time and size identify the
+    exact bytes without hashing the (possibly multi-GB) file.
+    """
+    digest = hashlib.sha1(f"{artifact_key}|{artifact['created']}|{artifact['size']}".encode('utf-8')).hexdigest()
+    return digest[:32]
+
+class ArtifactFile(io.FileIO):
+    """
+    An unbuffered file that runs a callback once it is closed.
+    File bodies are sent with direct_passthrough, which skips the response's
+    own close callbacks, so this is how we learn the transfer has ended.
+    Unbuffered, so the OS file offset is exactly where sendfile() starts.
+    """
+    def __init__(self, path, on_close):
+        super().__init__(path, 'rb')
+        self._on_close = on_close
+
+    def close(self):
+        if self.closed:
+            return
+        super().close()
+        on_close, self._on_close = self._on_close, None
+        if on_close:
+            on_close()
+
+class FileRange:
+    """
+    WSGI body yielding exactly `length` bytes from the file's current position.
+    """
+    def __init__(self, file, length):
+        self.file = file
+        self.length = length
+
+    def __iter__(self):
+        remaining = self.length
+        while remaining > 0:
+            chunk = self.file.read(min(FILE_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+    def close(self):
+        self.file.close()
+
+def send_artifact(artifact_key, artifact, download_name, mimetype, on_close):
+    """
+    Builds the response for a finished file, with a strong ETag,
+    If-None-Match and If-Range support and single byte-range requests,
+    so interrupted downloads of large files can resume.
+
+    The body is handed to the server's wsgi.file_wrapper when available:
+    gunicorn then sends it with sendfile() (positioned at the range start
+    and limited by Content-Length), so no Python worker copies the bytes.
+    on_close is called once the response has been sent or abandoned.
+    """
+    size = artifact['size']
+    etag = artifact_etag(artifact_key, artifact)
+    last_modified = int(artifact['created'])
+    headers = {
+        'ETag': f'"{etag}"',
+        'Last-Modified': http_date(last_modified),
+        'Accept-Ranges': 'bytes',
+        'Cache-Control': 'private, no-cache', # Always revalidate; the ETag makes that cheap
+        'Content-Disposition': f"attachment; filename*=UTF-8''{quote(download_name)}",
+    }
+
+    # Conditional GET: the client already has these exact bytes.
+    # If-None-Match uses weak comparison, so W/"etag" (e.g. from a proxy) matches too.
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304, headers=headers)
+        response.call_on_close(on_close)
+        return response
+
+    # Single-range requests are honored unless If-Range names a different
+    # version. Multi-range requests are answered with the whole file, which
+    # RFC 9110 allows; only an unsatisfiable single range gets a 416.
+    byte_range = None
+    if request.range and len(request.range.ranges) == 1:
+        if_range = request.if_range
+        if (if_range.etag is None and if_range.date is None) or if_range.etag == etag or (
+                if_range.date is not None and int(if_range.date.timestamp()) == last_modified):
+            byte_range = request.range.range_for_length(size)
+            if byte_range is None:
+                headers['Content-Range'] = f"bytes */{size}"
+                response = Response(status=416, headers=headers)
+                response.call_on_close(on_close)
+                return response
+
+    start, end = byte_range if byte_range else (0, size)
+    length = end - start
+    headers['Content-Length'] = str(length)
+    if byte_range:
+        headers['Content-Range'] = f"bytes {start}-{end - 1}/{size}"
+    status = 206 if byte_range else 200
+
+    # Let nginx send the file (it handles the range itself)
+    if X_ACCEL_REDIRECT_PREFIX:
+        headers['X-Accel-Redirect'] = X_ACCEL_REDIRECT_PREFIX + os.path.basename(artifact['path'])
+        del headers['Content-Length']
+        headers.pop('Content-Range', None)
+        response = Response(status=200, headers=headers, mimetype=mimetype)
+        response.call_on_close(on_close)
+        return response
+
+    file = ArtifactFile(artifact['path'], on_close)
+    file.seek(start)
+    file_wrapper = request.environ.get('wsgi.file_wrapper')
+    # gunicorn sends file_wrapper bodies with sendfile() from the current file
+    # position, limited to Content-Length, so any range is zero-copy there.
+    # Other servers may send the wrapper to EOF, so only use it for ranges that end there.
+    limits_to_length = request.environ.get('SERVER_SOFTWARE', '').startswith('gunicorn')
+    if file_wrapper and (end == size or limits_to_length):
+        body = file_wrapper(file, FILE_CHUNK_SIZE)
+    else:
+        body = FileRange(file, length)
+    return Response(body, status=status, headers=headers, mimetype=mimetype, direct_passthrough=True)
+
+def serve_artifact(artifact_key, title):
+    """
+    Sends the artifact stored under artifact_key, pinned for the lifetime
+    of the response so it cannot be evicted while it is being sent.
+    (An external worker may still evict it, but the open file stays
+    readable until the response is finished on POSIX systems.)
+    Returns None if the artifact no longer exists.
+    """
+    artifact = artifact_store.pin(artifact_key)
+    if not artifact:
+        return None
+
+    try:
+        file_path = artifact['path']
+        # Determine mimetype based on file extension
+        # Use os.path.splitext to get the actual extension from the downloaded file
+        _, ext = os.path.splitext(file_path)
+        mimetype = 'video/mp4' if ext.lower() == '.mp4' else 'audio/mpeg'
+        # Files on disk are named by artifact key; offer the video title to the user
+        download_name = f"{sanitize_filename(title or artifact['title'] or 'downloaded_file')}{ext}"
+        return send_artifact(
+            artifact_key, artifact, download_name, mimetype,
+            on_close=lambda: artifact_store.unpin(artifact_key),
+        )
+    except Exception:
+        artifact_store.unpin(artifact_key)
+        raise
 
 # --- API Endpoints ---
 
@@ -257,30 +1211,20 @@ def get_video_info():
         return jsonify({'error': 'URL is required'}), 400
 
     try:
-        # Use yt-dlp to extract info without downloading
-        ydl_opts = {
-            'quiet': True,
-            'skip_download': True,
-            'force_generic_extractor': True, # Helps with some URLs
-            'no_warnings': True,
-        }
-        # Add ffmpeg location if specified for info extraction (though usually not needed here)
-        if FFMPEG_PATH:
-            ydl_opts['ffmpeg_location'] = FFMPEG_PATH
+        # Use yt-dlp to extract info without downloading (cached per video ID,
+        # and reused by the download worker)
+        info = extract_video_info(url)
+        title = info.get('title', 'No Title Found')
+        thumbnail = info.get('thumbnail', 'https://placehold.co/480x270/e0e0e0/555555?text=No+Thumbnail')
 
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=False)
-            title = info.get('title', 'No Title Found')
-            thumbnail = info.get('thumbnail', 'https://placehold.co/480x270/e0e0e0/555555?text=No+Thumbnail')
-
-            # Get available formats using the new helper function
-            available_formats = get_available_formats_info(info)
-
-            return jsonify({
-                'title': title,
-                'thumbnail': thumbnail,
-                'available_formats': available_formats
-            })
+        # Get available formats using the new helper function
+        available_formats = get_available_formats_info(info)
+
+        return jsonify({
+            'title': title,
+            'thumbnail': thumbnail,
+            'available_formats': available_formats
+        })
     except yt_dlp.DownloadError as e:
         return jsonify({'error': f'Could not get video info: {str(e)}'}), 400
     except Exception as e:
@@ -300,41 +1244,581 @@ def download_video():
     if not all([url, format_option, quality]):
         return jsonify({'error': 'Missing URL, format, or quality'}), 400
 
-    # Generate a unique task ID
-    task_id = os.urandom(16).hex()
-    download_statuses[task_id] = {'status': 'queued', 'progress': 0, 'file_path': None, 'error': None}
-    download_queue.put((task_id, url, format_option, quality))
+    if not accepting_downloads.is_set():
+        return jsonify({'error': 'Server is shutting down, please retry shortly'}), 503
+
+    try:
+        task_id, ready = submit_download(url, format_option, quality, client_id())
+    except QueueFull:
+        return queue_full_response()
+    return jsonify({'message': 'Download ready' if ready else 'Download started', 'taskId': task_id})
+
+def client_id():
+    """
+    Identifies the client of the current request for fair scheduling,
+    backlog limits and cancellation. Derived by the server from the
+    client's address; the X-Client-Id header is only honored from callers
+    holding CLIENT_ID_TOKEN, since anyone else could pick a new identity
+    per request.
+    """
+    claimed = request.headers.get('X-Client-Id')
+    token = request.headers.get('X-Client-Token', '')
+    if claimed and CLIENT_ID_TOKEN and hmac.compare_digest(token, CLIENT_ID_TOKEN):
+        return f"trusted:{claimed}"
+    return request.remote_addr or 'unknown'
+
+def check_backlog(client, count=1):
+    """
+    Raises QueueFull if queueing count more tasks for client would exceed
+    MAX_BACKLOG or MAX_CLIENT_BACKLOG.
+    """
+    if WORKER_MODE == 'external':
+        total, queued = task_store.count_queued(), task_store.count_queued(client)
+    else:
+        total, queued = task_scheduler.backlog(client)
+    if total + count > MAX_BACKLOG or queued + count > MAX_CLIENT_BACKLOG:
+        raise QueueFull()
+
+def queue_full_response():
+    response = jsonify({'error': 'Too many downloads queued, please retry later'})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(BACKLOG_RETRY_AFTER)
+    return response
+
+def submit_download(url, format_option, quality, client, title=None, admit=True):
+    """
+    Creates the task for one download and hands it to the scheduler.
+    Returns (task ID, whether the file is already available). Raises
+    QueueFull if the task would have to be queued and the backlog is full
+    (unless admit is False, for callers that checked it themselves).
+    """
+    artifact_key = make_artifact_key(normalize_video_key(url), format_option, quality)
+
+    # Already downloaded in this format and quality: complete instantly
+    artifact = artifact_store.lookup(artifact_key)
+    if artifact:
+        task_id = os.urandom(16).hex()
+        task_store.create(
+            task_id, status='completed', stage='done', progress=100,
+            file_path=artifact['path'], title=artifact['title'], artifact_key=artifact_key,
+        )
+        print(f"Download task {task_id} served from existing file for {url}")
+        return task_id, True
+
+    if admit:
+        check_backlog(client)
+
+    # Generate a unique task ID. If the same download is already queued or
+    # running (in any server process), the task store returns that task
+    # instead, so identical requests never race on the same output file.
+    new_task_id = os.urandom(16).hex()
+    queued_at = time.time()
+    cost = estimate_cost(url, format_option, quality)
+    task_id = task_store.create_unless_active(
+        new_task_id, artifact_key, title=title, client=client, cost=cost,
+        url=url, format_option=format_option, quality=quality, queued_at=queued_at,
+    )
+    if task_id != new_task_id:
+        print(f"Download request for {url} joined in-flight task {task_id}")
+        return task_id, False
+
+    # External workers pick the task up from the task store
+    if WORKER_MODE != 'external':
+        task_scheduler.put(task_id, (task_id, url, format_option, quality, queued_at), client, cost)
     print(f"Download task {task_id} queued for {url}")
-    return jsonify({'message': 'Download started', 'taskId': task_id})
+    return task_id, False
+
+@app.route('/download_batch', methods=['POST'])
+def download_batch():
+    """
+    API endpoint to download many videos at once: either a list of URLs
+    ('urls') or a playlist URL ('url'), in one format and quality.
+    Every item becomes a normal download task (sharing finished files and
+    in-flight downloads with /download); the returned batch ID follows
+    their combined progress and fetches the finished files as one ZIP.
+    """
+    data = request.json
+    urls = data.get('urls')
+    playlist_url = data.get('url')
+    format_option = data.get('format') # 'mp4' or 'mp3'
+    quality = data.get('quality') # e.g., '720p', '192kbps'
+
+    if not (urls or playlist_url) or not all([format_option, quality]):
+        return jsonify({'error': 'Missing URLs, format, or quality'}), 400
+    if urls and (not isinstance(urls, list) or len(urls) > MAX_BATCH_ITEMS
+                 or not all(isinstance(url, str) and url.strip() for url in urls)):
+        return jsonify({'error': f'urls must be a list of at most {MAX_BATCH_ITEMS} URLs'}), 400
+    if not urls and not isinstance(playlist_url, str):
+        return jsonify({'error': 'url must be a playlist URL'}), 400
+
+    if not accepting_downloads.is_set():
+        return jsonify({'error': 'Server is shutting down, please retry shortly'}), 503
+
+    if urls:
+        title = None
+        entries = [(url.strip(), None) for url in urls]
+    else:
+        try:
+            title, entries = extract_playlist_entries(playlist_url)
+        except yt_dlp.DownloadError as e:
+            return jsonify({'error': f'Could not get playlist info: {str(e)}'}), 400
+        except Exception as e:
+            return jsonify({'error': f'An unexpected error occurred: {str(e)}'}), 500
+        if not entries:
+            return jsonify({'error': 'The playlist has no videos'}), 400
+
+    # The whole batch is admitted or refused at once
+    client = client_id()
+    try:
+        check_backlog(client, len(entries))
+    except QueueFull:
+        return queue_full_response()
+
+    task_ids = [
+        submit_download(url, format_option, quality, client, title=entry_title, admit=False)[0]
+        for url, entry_title in entries
+    ]
+    batch_id = os.urandom(16).hex()
+    task_store.create_batch(batch_id, task_ids, title=title)
+    print(f"Batch {batch_id} queued with {len(task_ids)} items")
+    return jsonify({
+        'message': 'Batch started',
+        'batchId': batch_id,
+        'title': title,
+        'taskIds': task_ids,
+        'zipUrl': f"/get_batch_zip/{batch_id}",
+    })
+
+@app.route('/stream', methods=['GET'])
+def stream_download():
+    """
+    API endpoint that sends the file while it is being produced, piping
+    ffmpeg's output straight into a chunked response instead of waiting
+    for the download and conversion to finish.
+    Supports MP3 and MP4 at qualities that only need a remux; a streamed
+    MP3 is also kept in the artifact store once it has been fully sent.
+    Query parameters: url, format ('mp4' or 'mp3') and quality.
+    """
+    url = request.args.get('url')
+    format_option = request.args.get('format')
+    quality = request.args.get('quality')
+
+    if not all([url, format_option, quality]):
+        return jsonify({'error': 'Missing URL, format, or quality'}), 400
+    if format_option not in ('mp3', 'mp4'):
+        return jsonify({'error': 'Unsupported format'}), 400
+    # The quality ends up in ffmpeg's -b:a argument
+    if format_option == 'mp3' and quality not in [f'{kbps}kbps' for kbps in AUDIO_TARGETS]:
+        return jsonify({'error': 'Unsupported MP3 quality'}), 400
+    if format_option == 'mp4' and quality not in [label for _, label in VIDEO_QUALITIES]:
+        return jsonify({'error': 'Unsupported MP4 quality'}), 400
+
+    artifact_key = make_artifact_key(normalize_video_key(url), format_option, quality)
+    ext = f".{format_option}"
+    mimetype = 'video/mp4' if format_option == 'mp4' else 'audio/mpeg'
+
+    # Already produced: send the finished file instead
+    response = serve_artifact(artifact_key, None)
+    if response is not None:
+        return response
+
+    if not stream_slots.acquire(blocking=False):
+        return jsonify({'error': 'Too many streams in progress, use /download instead'}), 503
+
+    try:
+        info = extract_video_info(url)
+        command = build_stream_command(info, format_option, quality)
+        proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    except yt_dlp.DownloadError as e:
+        stream_slots.release()
+        return jsonify({'error': f'This video cannot be streamed in that quality, use /download instead: {str(e)}'}), 409
+    except Exception as e:
+        stream_slots.release()
+        return jsonify({'error': f'An unexpected error occurred: {str(e)}'}), 500
+
+    title = info.get('title', 'downloaded_file')
+    # Tee MP3s into the artifact store (only the process that owns the folder may
+    # add to it), unless a /download task is already producing the same file.
+    # A streamed MP4 is fragmented, so it is not what /download would produce
+    # for the same key.
+    final_path = os.path.join(DOWNLOAD_FOLDER, f"{artifact_store.file_stem(artifact_key)}{ext}")
+    tee_enabled = (
+        STREAM_TEE_TO_STORE and format_option == 'mp3' and not artifact_store.read_only
+        and not task_store.active_task(artifact_key)
+    )
+    part_path = artifact_store.staging_path(artifact_key, ext) if tee_enabled else None
+
+    stopped = threading.Event()
+
+    def stop_ffmpeg():
+        # Called when the stream ends, and by the server when the response is
+        # closed (e.g. the client disconnected, possibly before the first chunk)
+        if stopped.is_set():
+            return
+        stopped.set()
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+        proc.stdout.close()
+        stream_slots.release()
+
+    def generate():
+        tee = open(part_path, 'wb') if part_path else None
+        completed = False
+        try:
+            while True:
+                # read1 returns whatever ffmpeg has produced so far; while the
+                # client is slow, the pipe fills up and ffmpeg blocks (backpressure)
+                chunk = proc.stdout.read1(STREAM_CHUNK_SIZE)
+                if not chunk:
+                    break
+                if tee:
+                    tee.write(chunk)
+                yield chunk
+            completed = proc.wait() == 0
+        finally:
+            stop_ffmpeg()
+            if tee:
+                tee.close()
+                # A task for the same file may have started meanwhile; it owns final_path
+                if completed and not task_store.active_task(artifact_key):
+                    os.replace(part_path, final_path)
+                    artifact_store.add(artifact_key, final_path, title)
+                else:
+                    os.remove(part_path)
+
+    download_name = f"{sanitize_filename(title)}{ext}"
+    headers = {
+        'Content-Disposition': f"attachment; filename*=UTF-8''{quote(download_name)}",
+        'X-Accel-Buffering': 'no',
+    }
+    response = Response(generate(), mimetype=mimetype, headers=headers)
+    response.call_on_close(stop_ffmpeg)
+    return response
 
 @app.route('/download_status/<task_id>', methods=['GET'])
 def get_download_status(task_id):
     """
     API endpoint to check the status of a download task.
     """
-    status = download_statuses.get(task_id)
+    status = task_store.get(task_id)
     if not status:
         return jsonify({'error': 'Task ID not found'}), 404
     return jsonify(status)
 
+@app.route('/download_events/<task_id>', methods=['GET'])
+def download_events(task_id):
+    """
+    Server-Sent Events stream of a download task's status.
+    Pushes the status record whenever it changes and closes the stream
+    once the task has completed or failed.
+    """
+    if not task_store.get(task_id):
+        return jsonify({'error': 'Task ID not found'}), 404
+
+    def generate():
+        sent_version = None
+        while True:
+            version, status = task_store.wait_for_change(task_id, sent_version, EVENTS_KEEPALIVE)
+            if not status:
+                return
+            if version == sent_version:
+                yield ": keep-alive\n\n"
+                continue
+            sent_version = version
+            yield f"data: {json.dumps(status)}\n\n"
+            if status['status'] in TERMINAL_STATUSES:
+                return
+
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    return Response(generate(), mimetype='text/event-stream', headers=headers)
+
+def batch_status(batch):
+    """
+    Combines the statuses of a batch's tasks into one progress record.
+    Tasks that have already expired count as failed.
+    """
+    tasks = task_store.get_many(batch['task_ids'])
+    items = []
+    counts = {'queued': 0, 'processing': 0, 'cancelling': 0, 'completed': 0, 'failed': 0, 'cancelled': 0}
+    progress = 0.0
+    for task_id in batch['task_ids']:
+        task = tasks.get(task_id) or {'status': 'failed', 'progress': 0, 'title': None, 'error': 'Task expired'}
+        counts[task['status']] = counts.get(task['status'], 0) + 1
+        progress += 100 if task['status'] in TERMINAL_STATUSES else (task['progress'] or 0)
+        items.append({
+            'taskId': task_id, 'status': task['status'], 'progress': task['progress'],
+            'title': task['title'], 'error': task['error'],
+        })
+
+    total = len(items)
+    if counts['queued'] + counts['processing'] + counts['cancelling'] > 0:
+        status = 'processing'
+    elif counts['completed'] > 0:
+        status = 'completed'
+    else:
+        status = 'cancelled' if counts['cancelled'] == total else 'failed'
+    return {
+        'status': status,
+        'title': batch['title'],
+        'total': total,
+        'progress': round(progress / total, 1) if total else 100,
+        **counts,
+        'items': items,
+    }
+
+@app.route('/batch_status/<batch_id>', methods=['GET'])
+def get_batch_status(batch_id):
+    """
+    API endpoint to check the combined status of a batch download.
+    """
+    batch = task_store.get_batch(batch_id)
+    if not batch:
+        return jsonify({'error': 'Batch ID not found'}), 404
+    return jsonify(batch_status(batch))
+
+@app.route('/batch_events/<batch_id>', methods=['GET'])
+def batch_events(batch_id):
+    """
+    Server-Sent Events stream of a batch's combined status, sent whenever
+    it changes and closed once every item has completed or failed.
+    """
+    batch = task_store.get_batch(batch_id)
+    if not batch:
+        return jsonify({'error': 'Batch ID not found'}), 404
+
+    def generate():
+        sent = None
+        idle_since = time.time()
+        while True:
+            status = batch_status(batch)
+            if status != sent:
+                sent = status
+                idle_since = time.time()
+                yield f"data: {json.dumps(status)}\n\n"
+                if status['status'] != 'processing':
+                    return
+            elif time.time() - idle_since >= EVENTS_KEEPALIVE:
+                idle_since = time.time()
+                yield ": keep-alive\n\n"
+            time.sleep(BATCH_EVENTS_INTERVAL)
+
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    return Response(generate(), mimetype='text/event-stream', headers=headers)
+
+class ZipSink:
+    """
+    Write-only file object for zipfile that collects what is written so a
+    generator can send it on. zipfile sees that it cannot seek and writes
+    each entry's sizes after its data, so the archive can be streamed.
+    """
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks.clear()
+        return data
+
+@app.route('/get_batch_zip/<batch_id>', methods=['GET'])
+def get_batch_zip(batch_id):
+    """
+    API endpoint that streams a batch's finished files as one ZIP archive,
+    built while it is being sent (nothing is written to disk). Files are
+    stored uncompressed since audio and video barely compress. Items that
+    failed are left out; the batch must have finished.
+    """
+    batch = task_store.get_batch(batch_id)
+    if not batch:
+        return jsonify({'error': 'Batch ID not found'}), 404
+    status = batch_status(batch)
+    if status['status'] == 'processing':
+        return jsonify({'error': 'Batch still in progress'}), 409
+
+    # Pin every file for the lifetime of the response and open it now: the
+    # worker process may evict a file between here and its turn in the archive,
+    # but an open file stays readable after it is removed.
+    tasks = task_store.get_many(batch['task_ids'])
+    entries = []
+    pinned = []
+    names = set()
+    for task_id in batch['task_ids']:
+        task = tasks.get(task_id)
+        if not task or task['status'] != 'completed' or task['artifact_key'] in pinned:
+            continue
+        artifact = artifact_store.pin(task['artifact_key'])
+        if not artifact:
+            continue
+        pinned.append(task['artifact_key'])
+        try:
+            src = open(artifact['path'], 'rb')
+        except OSError as e:
+            print(f"Leaving {artifact['path']} out of batch {batch_id}: {e}")
+            continue
+        _, ext = os.path.splitext(artifact['path'])
+        stem = sanitize_filename(task['title'] or artifact['title'] or 'downloaded_file')
+        name = f"{stem}{ext}"
+        number = 1
+        while name in names:
+            number += 1
+            name = f"{stem}_{number}{ext}"
+        names.add(name)
+        entries.append((name, artifact, src))
+
+    released = threading.Event()
+
+    def release():
+        # Called when the archive is done, and by the server when the response
+        # is closed (e.g. the client disconnected, possibly before the first chunk)
+        if released.is_set():
+            return
+        released.set()
+        for _, _, src in entries:
+            src.close()
+        for artifact_key in pinned:
+            artifact_store.unpin(artifact_key)
+
+    if not entries:
+        release()
+        return jsonify({'error': 'No finished files in this batch'}), 404
+
+    def generate():
+        sink = ZipSink()
+        try:
+            with zipfile.ZipFile(sink, 'w', zipfile.ZIP_STORED) as archive:
+                for name, artifact, src in entries:
+                    zinfo = zipfile.ZipInfo(name, date_time=time.localtime(artifact['created'])[:6])
+                    # Known up front so zipfile picks ZIP64 for files over 4 GB
+                    zinfo.file_size = os.fstat(src.fileno()).st_size
+                    with archive.open(zinfo, 'w') as dst:
+                        while True:
+                            chunk = src.read(FILE_CHUNK_SIZE)
+                            if not chunk:
+                                break
+                            dst.write(chunk)
+                            yield sink.drain()
+            yield sink.drain()
+        finally:
+            release()
+
+    download_name = f"{sanitize_filename(batch['title'] or 'downloads')}.zip"
+    headers = {
+        'Content-Disposition': f"attachment; filename*=UTF-8''{quote(download_name)}",
+        'X-Accel-Buffering': 'no',
+    }
+    response = Response(generate(), mimetype='application/zip', headers=headers)
+    response.call_on_close(release)
+    return response
+
+def cancel_task(task_id, client):
+    """
+    Cancels one of client's tasks: a queued task is taken off the
+    scheduler, a running one stops at its next progress update and
+    stays 'cancelling' until its worker has let go of the output files.
+    Returns the status the task had (None if it does not exist).
+    """
+    previous = task_store.cancel(task_id, client)
+    if previous == 'queued' and task_scheduler.remove(task_id):
+        # No worker picked it up, so there is nothing to wait for
+        task_store.update(task_id, status='cancelled')
+    return previous
+
+@app.route('/cancel/<task_id>', methods=['POST'])
+def cancel_download(task_id):
+    """
+    API endpoint to cancel a queued or running download.
+    Only the client that started a download may cancel it.
+    """
+    try:
+        previous = cancel_task(task_id, client_id())
+    except PermissionError:
+        return jsonify({'error': 'This download belongs to another client'}), 403
+    if previous is None:
+        return jsonify({'error': 'Task ID not found'}), 404
+    if previous in TERMINAL_STATUSES:
+        return jsonify({'error': f'Download already {previous}'}), 409
+    task = task_store.get(task_id)
+    return jsonify({'message': 'Download cancelled', 'taskId': task_id, 'status': task['status'] if task else 'cancelled'})
+
+@app.route('/batch_cancel/<batch_id>', methods=['POST'])
+def cancel_batch(batch_id):
+    """
+    API endpoint to cancel every unfinished item of a batch.
+    Items shared with other clients' downloads are left running.
+    """
+    batch = task_store.get_batch(batch_id)
+    if not batch:
+        return jsonify({'error': 'Batch ID not found'}), 404
+    client = client_id()
+    cancelled = 0
+    for task_id in batch['task_ids']:
+        try:
+            if cancel_task(task_id, client) in ('queued', 'processing'):
+                cancelled += 1
+        except PermissionError:
+            continue
+    return jsonify({'message': 'Batch cancelled', 'batchId': batch_id, 'cancelled': cancelled})
+
+@app.route('/stats', methods=['GET'])
+def get_stats():
+    """
+    API endpoint exposing worker pool statistics (queue depth, active
+    workers and per-stage wait times) for sizing the pool.
+    """
+    queue_depth = _queue_depth()
+
+    with stats_lock:
+        stages = {}
+        for stage, stage_stats in pool_stats['stages'].items():
+            count = stage_stats['count']
+            stages[stage] = {
+                'count': count,
+                'avg_wait': round(stage_stats['total_wait'] / count, 3) if count else 0.0,
+                'max_wait': round(stage_stats['max_wait'], 3),
+            }
+        active_workers = pool_stats['active_workers']
+        conversions = dict(pool_stats['conversions'])
+        caches = {name: dict(counters) for name, counters in cache_stats.items()}
+    caches['info_cache']['size'] = len(info_cache)
+    caches['ydl_pool'] = ydl_pool.stats()
+
+    return jsonify({
+        'pool': {
+            'mode': WORKER_MODE,
+            'workers': DOWNLOAD_WORKERS,
+            'active_workers': active_workers,
+            'queue_depth': queue_depth,
+            'fetch_concurrency': FETCH_CONCURRENCY,
+            'postprocess_concurrency': POSTPROCESS_CONCURRENCY,
+            'stages': stages,
+            'scheduler': task_scheduler.stats(),
+            'conversions': conversions,
+        },
+        'caches': caches,
+        'artifacts': artifact_store.stats(),
+        'tasks': {'backend': TASK_STORE, 'count': len(task_store)},
+    })
+
 @app.route('/get_file/<task_id>', methods=['GET'])
 def get_downloaded_file(task_id):
     """
     API endpoint to serve the downloaded file once it's complete.
     """
-    status = download_statuses.get(task_id)
+    status = task_store.get(task_id)
     if not status or status['status'] != 'completed' or not status['file_path']:
         return jsonify({'error': 'File not ready or task not found'}), 404
 
-    file_path = status['file_path']
-    if os.path.exists(file_path):
-        # Determine mimetype based on file extension
-        # Use os.path.splitext to get the actual extension from the downloaded file
-        _, ext = os.path.splitext(file_path)
-        mimetype = 'video/mp4' if ext.lower() == '.mp4' else 'audio/mpeg'
-        return send_file(file_path, as_attachment=True, mimetype=mimetype)
-    else:
+    response = serve_artifact(status['artifact_key'], status.get('title'))
+    if response is None:
         return jsonify({'error': 'File not found on server'}), 404
+    return response
 
 
 # Run the Flask app
@@ -0,0 +1,366 @@
+import os
+import re
+import json
+import time
+import hashlib
+import itertools
+import threading
+
+# Name of the index file kept inside the download folder
+INDEX_FILENAME = '.artifacts.json'
+# Directory (inside the download folder) where read-only stores record their pins
+PINS_DIRNAME = '.pins'
+# Suffix of files that are being written by something other than a download task
+STAGING_SUFFIX = '.staging'
+
+
+def make_artifact_key(video_key, format_option, quality):
+    """
+    Returns the key a finished download is stored under.
+    Two requests with the same key produce byte-identical files.
+    """
+    return f"{video_key}|{format_option}|{quality}"
+
+
+class ArtifactStore:
+    """
+    Keeps track of finished downloads in the download folder, keyed by
+    (video ID, format, quality), so repeat requests can be served from the
+    existing file instead of downloading and converting again.
+
+    The store keeps the folder under a byte budget by evicting the least
+    recently used artifacts (and, optionally, any older than max_age).
+    Artifacts that are pinned, i.e. currently being served, are never
+    evicted; files still being written are not registered yet, so they
+    are never candidates either. The index is persisted next to the files
+    so a restart does not need to scan the folder.
+
+    When several processes share the folder, only one of them (the
+    download worker) should own it; the others open the store with
+    read_only=True and pick up its changes from the index file. Their
+    pins are recorded as marker files in PINS_DIRNAME, named after the
+    artifact's file stem and the pinning process, so the owner leaves
+    those artifacts alone too. Markers of processes that have exited
+    are ignored and cleaned up.
+    """
+    def __init__(self, folder, max_bytes=None, max_age=None, read_only=False):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.read_only = read_only
+        self.index_path = os.path.join(folder, INDEX_FILENAME)
+        self.pins_dir = os.path.join(folder, PINS_DIRNAME)
+        self._artifacts = {} # key -> {'path', 'title', 'size', 'created', 'last_access'}
+        self._pins = {} # key -> number of responses currently serving it
+        self._pin_markers = {} # key -> marker files of our pins (read-only stores)
+        self._marker_sequence = itertools.count()
+        self._total_bytes = 0
+        self._evictions = 0
+        self._index_mtime = None # mtime of the index file we last loaded or wrote
+        self._lock = threading.Lock()
+        self._load_index()
+
+    def file_stem(self, key):
+        """
+        Returns the filename (without extension) used for an artifact.
+        It is derived from the key alone, so two different videos never
+        write to the same path even when their titles collide.
+        """
+        stem = re.sub(r'[^0-9A-Za-z_-]', '_', key)
+        if len(stem) > 80:
+            stem = f"{stem[:60]}_{hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]}"
+        return stem
+
+    def output_template(self, key):
+        """
+        Returns the yt-dlp output template for an artifact.
+        """
+        return os.path.join(self.folder, f"{self.file_stem(key)}.%(ext)s")
+
+    def staging_path(self, key, ext):
+        """
+        Returns a unique temporary path to write an artifact to before
+        moving it to its final path (the same stem plus ext).
+        """
+        return os.path.join(self.folder, f"{self.file_stem(key)}{ext}.{os.urandom(4).hex()}{STAGING_SUFFIX}")
+
+    def remove_leftovers(self, key=None, final_ext=None):
+        """
+        Deletes files in the folder that belong to no registered artifact:
+        partial downloads, separate video/audio streams, failed conversions.
+
+        With key, only that artifact's files are considered; call it once the
+        task producing it has stopped. Files ending in final_ext are kept
+        (yt-dlp and ffmpeg only create them once they are complete), and so
+        are staging files, which their writer cleans up itself.
+        Without key the whole folder is swept, which is only safe while
+        nothing is writing to it, i.e. at startup.
+        Dotfiles (the index, task database, caches) are never touched.
+        Returns the number of files removed.
+        """
+        with self._lock:
+            registered = {os.path.abspath(record['path']) for record in self._artifacts.values()}
+        prefix = f"{self.file_stem(key)}." if key is not None else ''
+        removed = 0
+        try:
+            names = os.listdir(self.folder)
+        except OSError as e:
+            print(f"Could not list {self.folder}: {e}")
+            return 0
+        for name in names:
+            if name.startswith('.') or not name.startswith(prefix):
+                continue
+            if key is not None and (name.endswith(STAGING_SUFFIX) or (final_ext and name.endswith(final_ext))):
+                continue
+            path = os.path.join(self.folder, name)
+            if os.path.abspath(path) in registered or not os.path.isfile(path):
+                continue
+            try:
+                os.remove(path)
+            except OSError as e:
+                print(f"Could not remove leftover file {name}: {e}")
+                continue
+            removed += 1
+        return removed
+
+    def lookup(self, key):
+        """
+        Returns a copy of the artifact record for key, or None if it was
+        never produced, has been evicted or its file has disappeared.
+        Counts as an access for LRU purposes.
+        """
+        with self._lock:
+            self._refresh_locked()
+            record = self._get_live(key)
+            if record is None:
+                return None
+            record['last_access'] = time.time()
+            return dict(record)
+
+    def pin(self, key):
+        """
+        Like lookup, but also protects the artifact from eviction until
+        unpin is called. Use while a file is being sent to a client.
+        """
+        with self._lock:
+            self._refresh_locked()
+            record = self._get_live(key)
+            if record is None:
+                return None
+            record['last_access'] = time.time()
+            self._pins[key] = self._pins.get(key, 0) + 1
+            if self.read_only:
+                self._add_pin_marker_locked(key)
+            return dict(record)
+
+    def unpin(self, key):
+        with self._lock:
+            count = self._pins.get(key, 0) - 1
+            if count > 0:
+                self._pins[key] = count
+            else:
+                self._pins.pop(key, None)
+            markers = self._pin_markers.get(key)
+            if markers:
+                marker = markers.pop()
+                if not markers:
+                    del self._pin_markers[key]
+                try:
+                    os.remove(marker)
+                except OSError:
+                    pass
+
+    def add(self, key, path, title):
+        """
+        Registers a finished file under key, then evicts other artifacts
+        if the folder is over its budget.
+        """
+        now = time.time()
+        with self._lock:
+            old = self._artifacts.pop(key, None)
+            if old:
+                self._total_bytes -= old['size']
+            size = os.path.getsize(path)
+            self._artifacts[key] = {
+                'path': path,
+                'title': title,
+                'size': size,
+                'created': now,
+                'last_access': now,
+            }
+            self._total_bytes += size
+            self._evict_locked(keep=key)
+            self._save_index_locked()
+
+    def evict(self):
+        """
+        Runs an eviction pass (expired artifacts first, then LRU until the
+        folder fits in max_bytes).
+        """
+        if self.read_only:
+            return
+        with self._lock:
+            if self._evict_locked():
+                self._save_index_locked()
+
+    def stats(self):
+        with self._lock:
+            self._refresh_locked()
+            return {
+                'artifacts': len(self._artifacts),
+                'bytes': self._total_bytes,
+                'max_bytes': self.max_bytes,
+                'pinned': len(self._pins),
+                'evictions': self._evictions,
+            }
+
+    def _get_live(self, key):
+        record = self._artifacts.get(key)
+        if record is None:
+            return None
+        if not os.path.exists(record['path']):
+            self._forget_locked(key)
+            return None
+        return record
+
+    def _forget_locked(self, key):
+        record = self._artifacts.pop(key)
+        self._total_bytes -= record['size']
+
+    def _add_pin_marker_locked(self, key):
+        marker = os.path.join(
+            self.pins_dir, f"{self.file_stem(key)}.{os.getpid()}.{next(self._marker_sequence)}"
+        )
+        try:
+            os.makedirs(self.pins_dir, exist_ok=True)
+            open(marker, 'w').close()
+        except OSError as e:
+            print(f"Could not record pin for artifact {key}: {e}")
+            return
+        self._pin_markers.setdefault(key, []).append(marker)
+
+    def _shared_pins_locked(self):
+        """
+        Returns the file stems pinned by other processes, removing the
+        markers left behind by processes that have exited.
+        """
+        try:
+            names = os.listdir(self.pins_dir)
+        except OSError:
+            return set()
+        stems = set()
+        for name in names:
+            try:
+                stem, pid, _ = name.rsplit('.', 2)
+                alive = _process_alive(int(pid))
+            except ValueError:
+                continue
+            if alive:
+                stems.add(stem)
+                continue
+            try:
+                os.remove(os.path.join(self.pins_dir, name))
+            except OSError:
+                pass
+        return stems
+
+    def _evict_locked(self, keep=None):
+        """
+        Removes expired and least recently used artifacts. Pinned artifacts
+        (by this or any other process) and `keep` (the one just added) are
+        skipped. Returns True if anything was removed.
+        """
+        shared_pins = self._shared_pins_locked()
+        candidates = sorted(
+            (
+                key for key in self._artifacts
+                if key != keep and key not in self._pins and self.file_stem(key) not in shared_pins
+            ),
+            key=lambda k: self._artifacts[k]['last_access'],
+        )
+        now = time.time()
+        removed = False
+        for key in candidates:
+            record = self._artifacts[key]
+            expired = self.max_age is not None and now - record['created'] > self.max_age
+            over_budget = self.max_bytes is not None and self._total_bytes > self.max_bytes
+            if not (expired or over_budget):
+                continue
+            try:
+                os.remove(record['path'])
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print(f"Could not evict artifact {key}: {e}")
+                continue
+            self._forget_locked(key)
+            self._evictions += 1
+            removed = True
+            print(f"Evicted artifact {key} ({'expired' if expired else 'over budget'})")
+
+        if self.max_bytes is not None and self._total_bytes > self.max_bytes:
+            print(f"Artifact store still over budget ({self._total_bytes} > {self.max_bytes} bytes); remaining files are in use")
+        return removed
+
+    def _load_index(self):
+        """
+        Rebuilds the in-memory index from the persisted index file,
+        dropping entries whose files no longer exist.
+        """
+        try:
+            self._index_mtime = os.stat(self.index_path).st_mtime_ns
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                artifacts = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            print(f"Could not read artifact index, starting empty: {e}")
+            return
+
+        self._artifacts = {}
+        self._total_bytes = 0
+        for key, record in artifacts.items():
+            if os.path.exists(record['path']):
+                self._artifacts[key] = record
+                self._total_bytes += record['size']
+        if not self.read_only:
+            self._evict_locked()
+            self._save_index_locked()
+
+    def _refresh_locked(self):
+        """
+        Reloads the index if another process rewrote it since we last
+        read or wrote it.
+        """
+        try:
+            mtime = os.stat(self.index_path).st_mtime_ns
+        except OSError:
+            return
+        if mtime != self._index_mtime:
+            self._load_index()
+
+    def _save_index_locked(self):
+        if self.read_only:
+            return
+        tmp_path = f"{self.index_path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self._artifacts, f)
+            os.replace(tmp_path, self.index_path) # Atomic, so a crash never leaves half an index
+            self._index_mtime = os.stat(self.index_path).st_mtime_ns
+        except OSError as e:
+            print(f"Could not save artifact index: {e}")
+
+
+def _process_alive(pid):
+    if os.name == 'nt':
+        # os.kill would terminate the process on Windows; shared folders are a
+        # gunicorn (POSIX) setup, so treat every marker as live there
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
@@ -0,0 +1,84 @@
+# Gunicorn configuration for production serving:
+#   gunicorn -c gunicorn.conf.py wsgi:app
+#
+# Web requests are served by several worker processes, while downloads run in a
+# single separate worker.py process. They share task state through the SQLite
+# task store, and finished files and cached video info (INFO_CACHE_DIR, by
+# default DOWNLOAD_FOLDER/.info_cache) through DOWNLOAD_FOLDER.
+import os
+import sys
+import subprocess
+import threading
+
+# The web processes must not run downloads themselves, and task state must be
+# shared between processes. Set before the app is imported by any process.
+os.environ.setdefault('WORKER_MODE', 'external')
+os.environ.setdefault('TASK_STORE', 'sqlite')
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+workers = int(os.getenv('WEB_CONCURRENCY', '2'))
+# Threaded workers, since each /download_events stream holds a thread open
+worker_class = 'gthread'
+threads = int(os.getenv('WEB_THREADS', '8'))
+timeout = 120
+# Time given to in-flight requests (e.g. large file transfers) on shutdown
+graceful_timeout = int(os.getenv('GRACEFUL_TIMEOUT', '60'))
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+DRAIN_TIMEOUT = int(os.getenv('DRAIN_TIMEOUT', '600'))
+# Seconds to wait before restarting a download worker that exited unexpectedly
+WORKER_RESTART_DELAY = int(os.getenv('WORKER_RESTART_DELAY', '5'))
+
+
+def start_download_worker(server):
+    server.download_worker = subprocess.Popen([sys.executable, 'worker.py'], cwd=APP_DIR)
+    server.log.info(f"Started download worker (pid {server.download_worker.pid})")
+
+
+def watch_download_worker(server):
+    """
+    Restarts the download worker whenever it exits before the server
+    shuts down, so queued downloads are not left waiting forever.
+    """
+    while True:
+        code = server.download_worker.wait()
+        if server.download_worker_stopping.is_set():
+            return
+        server.log.error(f"Download worker exited with code {code}, restarting in {WORKER_RESTART_DELAY}s")
+        if server.download_worker_stopping.wait(WORKER_RESTART_DELAY):
+            return
+        with server.download_worker_lock:
+            if server.download_worker_stopping.is_set():
+                return
+            start_download_worker(server)
+
+
+def when_ready(server):
+    """
+    Starts the download worker once the web processes are up.
+    """
+    server.download_worker_stopping = threading.Event()
+    server.download_worker_lock = threading.Lock()
+    start_download_worker(server)
+    threading.Thread(target=watch_download_worker, args=(server,), daemon=True).start()
+
+
+def on_exit(server):
+    """
+    Asks the download worker to finish its running downloads and waits for it.
+    """
+    stopping = getattr(server, 'download_worker_stopping', None)
+    if stopping is None:
+        return
+    with server.download_worker_lock:
+        stopping.set()
+    proc = server.download_worker
+    if proc.poll() is not None:
+        return
+    server.log.info("Waiting for the download worker to finish running downloads...")
+    proc.terminate()
+    try:
+        proc.wait(timeout=DRAIN_TIMEOUT + 10)
+    except subprocess.TimeoutExpired:
+        server.log.warning("Download worker did not stop in time, killing it")
+        proc.kill()
@@ -0,0 +1,157 @@
+import os
+import re
+import json
+import time
+import threading
+from collections import OrderedDict
+
+# Matches the 11-character video ID in the common YouTube URL shapes:
+# watch?v=, youtu.be/, shorts/, embed/, live/ and music.youtube.com
+YOUTUBE_ID_RE = re.compile(
+    r'(?:youtube\.com/(?:watch\?(?:.*&)?v=|shorts/|embed/|live/|v/)|youtu\.be/)([0-9A-Za-z_-]{11})'
+)
+
+
+def normalize_video_key(url):
+    """
+    Returns a cache key for a video URL that does not depend on the exact
+    URL form (tracking params, youtu.be vs youtube.com, timestamps...).
+    Falls back to the stripped URL for sites we cannot parse locally.
+    """
+    url = (url or '').strip()
+    match = YOUTUBE_ID_RE.search(url)
+    if match:
+        return f"youtube:{match.group(1)}"
+    return url
+
+
+class InfoCache:
+    """
+    A thread-safe cache of yt-dlp info dictionaries with TTL expiry and
+    size-bounded LRU eviction. When a directory is given, entries are also
+    written there as JSON so they survive restarts and can be shared
+    between worker processes. Expired files are deleted when read, and
+    prune() keeps the directory itself within ttl and max_entries.
+    """
+    def __init__(self, max_entries=256, ttl=3600, disk_dir=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.disk_dir = disk_dir
+        self._entries = OrderedDict() # key -> (stored_at, info)
+        self._lock = threading.Lock()
+        if self.disk_dir:
+            # Several processes may start at once and share the directory
+            os.makedirs(self.disk_dir, exist_ok=True)
+
+    def _disk_path(self, key):
+        safe_key = re.sub(r'[^0-9A-Za-z_-]', '_', key)[:200]
+        return os.path.join(self.disk_dir, f"{safe_key}.json")
+
+    def _is_fresh(self, stored_at):
+        return time.time() - stored_at < self.ttl
+
+    def get(self, key):
+        """
+        Returns the cached info for key, or None if missing or expired.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if self._is_fresh(entry[0]):
+                    self._entries.move_to_end(key)
+                    return entry[1]
+                del self._entries[key]
+
+        if not self.disk_dir:
+            return None
+
+        # Fall back to the on-disk store
+        path = self._disk_path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not self._is_fresh(record['stored_at']):
+            self._remove_expired_file(path)
+            return None
+        self._remember(key, record['stored_at'], record['info'])
+        return record['info']
+
+    def put(self, key, info):
+        """
+        Stores info under key, evicting the least recently used entries
+        once max_entries is exceeded.
+        """
+        stored_at = time.time()
+        self._remember(key, stored_at, info)
+
+        if self.disk_dir:
+            path = self._disk_path(key)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            try:
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump({'stored_at': stored_at, 'info': info}, f)
+                os.replace(tmp_path, path) # Atomic, so readers never see half a file
+            except (OSError, TypeError, ValueError) as e:
+                print(f"Could not persist info cache entry {key}: {e}")
+
+    def invalidate(self, key):
+        """
+        Drops key from memory and disk, e.g. after its stream URLs expired.
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+        if self.disk_dir:
+            try:
+                os.remove(self._disk_path(key))
+            except OSError:
+                pass
+
+    def prune(self):
+        """
+        Deletes expired files from the disk directory, then the oldest
+        ones beyond max_entries. Returns the number of files removed.
+        """
+        if not self.disk_dir:
+            return 0
+        files = []
+        try:
+            with os.scandir(self.disk_dir) as entries:
+                for entry in entries:
+                    if entry.name.endswith('.json') and entry.is_file():
+                        files.append((entry.stat().st_mtime, entry.path))
+        except OSError as e:
+            print(f"Could not list info cache directory: {e}")
+            return 0
+        files.sort(reverse=True) # newest first
+        now = time.time()
+        removed = 0
+        for position, (mtime, path) in enumerate(files):
+            if position < self.max_entries and now - mtime < self.ttl:
+                continue
+            try:
+                os.remove(path)
+                removed += 1
+            except OSError:
+                pass
+        return removed
+
+    def _remove_expired_file(self, path):
+        # Another process may have just replaced it with a fresh entry
+        try:
+            if time.time() - os.path.getmtime(path) >= self.ttl:
+                os.remove(path)
+        except OSError:
+            pass
+
+    def _remember(self, key, stored_at, info):
+        with self._lock:
+            self._entries[key] = (stored_at, info)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
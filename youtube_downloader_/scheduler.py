@@ -0,0 +1,107 @@
+import heapq
+import itertools
+import threading
+import time
+
+
+class FairScheduler:
+    """
+    Queue of download tasks shared fairly between clients.
+
+    Every client has its own queue, ordered by estimated cost so short
+    jobs (e.g. MP3s) go first. Clients are served by start-time fair
+    queuing: each client's virtual time is the total cost of the work
+    dispatched for it, and the next task comes from the waiting client
+    with the lowest virtual time. A client that queues 50 4K videos
+    therefore gets its share of the workers, not all of them.
+
+    A client that was idle joins at the current virtual time, so it cannot
+    bank credit while away and then monopolize the pool.
+
+    Offers the get()/task_done()/qsize() part of queue.Queue, so the
+    download workers can take tasks from it directly.
+    """
+    def __init__(self):
+        self._queues = {} # client -> heap of (cost, sequence, task ID)
+        self._items = {} # task ID -> (client, cost, item) for queued tasks
+        self._vtime = {} # client -> virtual time
+        self._clock = 0.0 # virtual time of the last dispatched task
+        self._sequence = itertools.count()
+        self._changed = threading.Condition()
+
+    def put(self, task_id, item, client, cost):
+        with self._changed:
+            heap = self._queues.setdefault(client, [])
+            if not heap:
+                self._vtime[client] = max(self._vtime.get(client, 0.0), self._clock)
+            heapq.heappush(heap, (cost, next(self._sequence), task_id))
+            self._items[task_id] = (client, cost, item)
+            self._changed.notify()
+
+    def get(self, timeout=None):
+        """
+        Removes and returns the next item, waiting for one if needed.
+        Raises TimeoutError if timeout passes first.
+        """
+        deadline = time.time() + timeout if timeout is not None else None
+        with self._changed:
+            while not self._items:
+                remaining = deadline - time.time() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    raise TimeoutError
+                self._changed.wait(remaining)
+            client = min(
+                (client for client, heap in self._queues.items() if heap),
+                key=lambda client: (self._vtime[client], self._queues[client][0][1]),
+            )
+            heap = self._queues[client]
+            _, _, task_id = heapq.heappop(heap)
+            _, cost, item = self._items.pop(task_id)
+            self._clock = self._vtime[client]
+            self._vtime[client] += cost
+            self._prune_locked(client)
+            # Idle clients the clock has caught up with would rejoin at the clock anyway
+            for idle in [c for c, vtime in self._vtime.items() if c not in self._queues and vtime <= self._clock]:
+                del self._vtime[idle]
+            return item
+
+    def task_done(self):
+        pass
+
+    def remove(self, task_id):
+        """
+        Drops a queued task (e.g. when it is cancelled).
+        Returns False if it is not queued here.
+        """
+        with self._changed:
+            entry = self._items.pop(task_id, None)
+            if entry is None:
+                return False
+            client = entry[0]
+            heap = self._queues[client]
+            heap[:] = [queued for queued in heap if queued[2] != task_id]
+            heapq.heapify(heap)
+            self._prune_locked(client)
+            return True
+
+    def qsize(self):
+        with self._changed:
+            return len(self._items)
+
+    def backlog(self, client):
+        """
+        Returns (tasks queued in total, tasks queued for client).
+        """
+        with self._changed:
+            return len(self._items), len(self._queues.get(client, ()))
+
+    def stats(self):
+        with self._changed:
+            return {
+                'queued': len(self._items),
+                'clients': sum(1 for heap in self._queues.values() if heap),
+            }
+
+    def _prune_locked(self, client):
+        if not self._queues[client]:
+            del self._queues[client]
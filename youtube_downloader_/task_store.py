@@ -0,0 +1,580 @@
+import os
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+
+# Statuses after which a task never changes again
+TERMINAL_STATUSES = ('completed', 'failed', 'cancelled')
+
+
+class TaskRecord:
+    """
+    Status of a single download task.
+    Uses __slots__ since a busy server keeps thousands of these around.
+    """
+    __slots__ = (
+        'task_id', 'status', 'stage', 'progress', 'file_path', 'error',
+        'title', 'artifact_key', 'url', 'format_option', 'quality',
+        'queued_at', 'updated_at', 'version', 'client', 'cost', 'conversion',
+    )
+
+    # Fields returned to API clients
+    PUBLIC_FIELDS = ('status', 'stage', 'progress', 'file_path', 'error', 'title', 'artifact_key', 'conversion')
+    # Fields callers may change through update()
+    UPDATABLE_FIELDS = PUBLIC_FIELDS + ('url', 'format_option', 'quality', 'queued_at')
+
+    def __init__(self, task_id, status='queued', stage='queued', progress=0, file_path=None,
+                 error=None, title=None, artifact_key=None, url=None, format_option=None,
+                 quality=None, queued_at=None, updated_at=None, version=0, client=None, cost=0,
+                 conversion=None):
+        self.task_id = task_id
+        self.status = status
+        self.stage = stage
+        self.progress = progress
+        self.file_path = file_path
+        self.error = error
+        self.title = title
+        self.artifact_key = artifact_key
+        self.url = url
+        self.format_option = format_option
+        self.quality = quality
+        self.queued_at = queued_at if queued_at is not None else time.time()
+        self.updated_at = updated_at if updated_at is not None else time.time()
+        self.version = version
+        self.client = client # who queued the task, for fair scheduling and cancellation
+        self.cost = cost # estimated work, see estimate_cost() in app.py
+        self.conversion = conversion # how the file was converted, see CONVERSION_PATHS in app.py
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in self.PUBLIC_FIELDS}
+
+
+class MemoryTaskStore:
+    """
+    Task store kept in this process's memory.
+    All access goes through one lock; completed and failed tasks expire
+    after ttl seconds, and at most max_tasks records are kept.
+    """
+    def __init__(self, ttl=3600, max_tasks=10000):
+        self.ttl = ttl
+        self.max_tasks = max_tasks
+        self._tasks = OrderedDict() # task_id -> TaskRecord, oldest first
+        self._active_by_artifact = {} # artifact key -> task ID of its unfinished task
+        self._batches = OrderedDict() # batch ID -> (created_at, title, task IDs), oldest first
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+
+    def create(self, task_id, **fields):
+        with self._lock:
+            self._create_locked(task_id, fields)
+
+    def create_unless_active(self, task_id, artifact_key, **fields):
+        """
+        Creates the task unless an unfinished task for the same artifact
+        exists. Returns the ID of the task that will produce the artifact.
+        """
+        with self._lock:
+            active_id = self._active_by_artifact.get(artifact_key)
+            if active_id is not None:
+                return active_id
+            self._create_locked(task_id, dict(fields, artifact_key=artifact_key))
+            return task_id
+
+    def _create_locked(self, task_id, fields):
+        record = TaskRecord(task_id, **fields)
+        self._tasks[task_id] = record
+        if record.status not in TERMINAL_STATUSES and record.artifact_key:
+            self._active_by_artifact[record.artifact_key] = task_id
+        if len(self._tasks) > self.max_tasks:
+            self._drop_oldest_finished_locked()
+
+    def get(self, task_id):
+        """
+        Returns a snapshot dict of the task, or None if unknown or expired.
+        """
+        with self._lock:
+            record = self._tasks.get(task_id)
+            return record.to_dict() if record else None
+
+    def active_task(self, artifact_key):
+        """
+        Returns the ID of the unfinished task producing artifact_key, if any.
+        """
+        with self._lock:
+            return self._active_by_artifact.get(artifact_key)
+
+    def get_many(self, task_ids):
+        """
+        Returns {task ID: snapshot dict} for the given tasks that exist.
+        """
+        with self._lock:
+            return {
+                task_id: self._tasks[task_id].to_dict()
+                for task_id in task_ids if task_id in self._tasks
+            }
+
+    def create_batch(self, batch_id, task_ids, title=None):
+        """
+        Groups tasks under one batch ID so their progress can be followed together.
+        """
+        with self._lock:
+            self._batches[batch_id] = (time.time(), title, list(task_ids))
+
+    def get_batch(self, batch_id):
+        """
+        Returns {'title', 'task_ids'} for a batch, or None if unknown or expired.
+        """
+        with self._lock:
+            batch = self._batches.get(batch_id)
+            return {'title': batch[1], 'task_ids': list(batch[2])} if batch else None
+
+    def update(self, task_id, **fields):
+        """
+        Applies a partial update. Returns False if the task does not exist
+        or was cancelled (a cancelled task's worker may still report in).
+        While a task is 'cancelling' only its worker's final update is
+        applied, and it always finishes the task as 'cancelled'.
+        """
+        with self._lock:
+            record = self._tasks.get(task_id)
+            if record is None or record.status == 'cancelled':
+                return False
+            if record.status == 'cancelling':
+                if fields.get('status') not in TERMINAL_STATUSES:
+                    return False
+                fields = {'status': 'cancelled', 'stage': 'done'}
+            for field, value in fields.items():
+                setattr(record, field, value)
+            if record.status in TERMINAL_STATUSES and self._active_by_artifact.get(record.artifact_key) == task_id:
+                del self._active_by_artifact[record.artifact_key]
+            record.updated_at = time.time()
+            record.version += 1
+            self._changed.notify_all()
+            return True
+
+    def cancel(self, task_id, client=None):
+        """
+        Asks a queued or running task to stop. When client is given, only
+        that client's tasks may be cancelled (PermissionError otherwise).
+        Returns the status the task had, or None if it does not exist;
+        a task that had already finished is left alone.
+
+        The task becomes 'cancelling' rather than 'cancelled': its worker
+        may still be writing the artifact's output paths, so it stays the
+        active task for its artifact until the worker reports that it has
+        stopped (or, for a task that never started, until the caller
+        finishes it with update(status='cancelled')).
+        """
+        with self._lock:
+            record = self._tasks.get(task_id)
+            if record is None or record.status in TERMINAL_STATUSES:
+                return record.status if record else None
+            if client is not None and record.client != client:
+                raise PermissionError(task_id)
+            previous = record.status
+            record.status = 'cancelling'
+            record.updated_at = time.time()
+            record.version += 1
+            self._changed.notify_all()
+            return previous
+
+    def heartbeat(self):
+        # Tasks live and die with this process, so there is no lease to renew
+        pass
+
+    def count_queued(self, client=None):
+        """
+        Returns how many tasks are queued, in total or for one client.
+        """
+        with self._lock:
+            return sum(
+                1 for record in self._tasks.values()
+                if record.status == 'queued' and (client is None or record.client == client)
+            )
+
+    def wait_for_change(self, task_id, seen_version, timeout):
+        """
+        Blocks until the task's version differs from seen_version or the
+        timeout passes. Returns (version, snapshot dict or None).
+        """
+        with self._changed:
+            self._changed.wait_for(
+                lambda: self._version_locked(task_id) != seen_version,
+                timeout=timeout,
+            )
+            record = self._tasks.get(task_id)
+            if record is None:
+                return None, None
+            return record.version, record.to_dict()
+
+    def expire(self):
+        """
+        Removes finished tasks older than the TTL. Returns how many were removed.
+        """
+        cutoff = time.time() - self.ttl
+        with self._lock:
+            expired = [
+                task_id for task_id, record in self._tasks.items()
+                if record.status in TERMINAL_STATUSES and record.updated_at < cutoff
+            ]
+            for task_id in expired:
+                del self._tasks[task_id]
+            if expired:
+                self._changed.notify_all()
+            # A batch goes once all of its tasks have
+            for batch_id, (created_at, _, task_ids) in list(self._batches.items()):
+                if created_at < cutoff and not any(task_id in self._tasks for task_id in task_ids):
+                    del self._batches[batch_id]
+            return len(expired)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._tasks)
+
+    def _version_locked(self, task_id):
+        record = self._tasks.get(task_id)
+        return record.version if record else None
+
+    def _drop_oldest_finished_locked(self):
+        for task_id, record in self._tasks.items():
+            if record.status in TERMINAL_STATUSES:
+                del self._tasks[task_id]
+                return
+
+
+class SQLiteTaskStore:
+    """
+    Task store backed by a SQLite database, so several server processes
+    (e.g. gunicorn workers) can share task state.
+    Each thread uses its own connection; waiting for changes polls the
+    row's version, since other processes cannot notify us directly.
+
+    Unfinished tasks are leased to the process that queued or claimed
+    them (owner): it refreshes their heartbeat, and tasks whose heartbeat
+    is older than lease seconds belong to a process that stopped. Those
+    are failed, so new requests for the same file do not join a task that
+    will never finish. Queued tasks without an owner wait for the
+    external worker and are not leased.
+    """
+    POLL_INTERVAL = 0.25
+
+    def __init__(self, path, ttl=3600, max_tasks=10000, lease=60):
+        self.path = path
+        self.ttl = ttl
+        self.max_tasks = max_tasks
+        self.lease = lease
+        self.owner = None # set by the process that queues or runs tasks
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        with self._connection() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS tasks ('
+                ' task_id TEXT PRIMARY KEY, status TEXT, stage TEXT, progress REAL,'
+                ' file_path TEXT, error TEXT, title TEXT, artifact_key TEXT,'
+                ' url TEXT, format_option TEXT, quality TEXT, queued_at REAL,'
+                ' updated_at REAL, version INTEGER, client TEXT, cost REAL, conversion TEXT,'
+                ' owner TEXT, heartbeat REAL)'
+            )
+            # Databases created before tasks had these columns
+            columns = {row[1] for row in conn.execute('PRAGMA table_info(tasks)')}
+            for column, column_type in (('client', 'TEXT'), ('cost', 'REAL'), ('conversion', 'TEXT'),
+                                        ('owner', 'TEXT'), ('heartbeat', 'REAL')):
+                if column not in columns:
+                    conn.execute(f'ALTER TABLE tasks ADD COLUMN {column} {column_type}')
+            conn.execute('CREATE INDEX IF NOT EXISTS tasks_finished ON tasks (status, updated_at)')
+            conn.execute('CREATE INDEX IF NOT EXISTS tasks_queue ON tasks (status, queued_at)')
+            conn.execute('CREATE INDEX IF NOT EXISTS tasks_artifact ON tasks (artifact_key, status)')
+            conn.execute('CREATE TABLE IF NOT EXISTS batches (batch_id TEXT PRIMARY KEY, title TEXT, created_at REAL)')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS batch_tasks ('
+                ' batch_id TEXT, position INTEGER, task_id TEXT, PRIMARY KEY (batch_id, position))'
+            )
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # isolation_level=None so transactions are opened explicitly with BEGIN
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            # WAL lets readers in other processes proceed while a worker writes
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def create(self, task_id, **fields):
+        with self._connection() as conn:
+            self._insert(conn, TaskRecord(task_id, **fields))
+
+    def create_unless_active(self, task_id, artifact_key, **fields):
+        """
+        Creates the task unless an unfinished task for the same artifact
+        exists. The check and insert happen in one write transaction, so
+        two server processes cannot both start the same download.
+        Returns the ID of the task that will produce the artifact.
+        """
+        conn = self._connection()
+        placeholders = ', '.join('?' for _ in TERMINAL_STATUSES)
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            self._fail_abandoned(conn, 'artifact_key = ?', (artifact_key,))
+            row = conn.execute(
+                f'SELECT task_id FROM tasks WHERE artifact_key = ? AND status NOT IN ({placeholders}) LIMIT 1',
+                (artifact_key, *TERMINAL_STATUSES),
+            ).fetchone()
+            if row:
+                return row['task_id']
+            self._insert(conn, TaskRecord(task_id, artifact_key=artifact_key, **fields))
+            return task_id
+
+    def claim_next(self):
+        """
+        Atomically marks the next queued task as processing and returns
+        its record as a dict (including url, format_option and quality),
+        or None if nothing is queued. Used by the external download worker.
+
+        Tasks of the client with the fewest running tasks go first, then
+        the cheapest, then the oldest: an approximation of the in-process
+        FairScheduler that works across processes.
+        """
+        conn = self._connection()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute(
+                "SELECT * FROM tasks t WHERE status = 'queued' ORDER BY"
+                " (SELECT COUNT(*) FROM tasks p WHERE p.status = 'processing' AND p.client IS t.client),"
+                " cost, queued_at LIMIT 1"
+            ).fetchone()
+            if row is None:
+                return None
+            now = time.time()
+            conn.execute(
+                "UPDATE tasks SET status = 'processing', owner = ?, heartbeat = ?, updated_at = ?,"
+                " version = version + 1 WHERE task_id = ?",
+                (self.owner, now, now, row['task_id']),
+            )
+            return dict({field: row[field] for field in TaskRecord.__slots__}, status='processing')
+
+    def requeue_unfinished(self):
+        """
+        Puts tasks left 'processing' by a worker that stopped without
+        finishing them back in the queue, and finishes the ones it was
+        cancelling. Returns how many were requeued.
+        """
+        with self._connection() as conn:
+            now = time.time()
+            conn.execute(
+                "UPDATE tasks SET status = 'cancelled', stage = 'done', owner = NULL,"
+                " updated_at = ?, version = version + 1 WHERE status = 'cancelling'",
+                (now,),
+            )
+            cursor = conn.execute(
+                "UPDATE tasks SET status = 'queued', stage = 'queued', progress = 0, owner = NULL,"
+                " updated_at = ?, version = version + 1 WHERE status = 'processing'",
+                (now,),
+            )
+            return cursor.rowcount
+
+    def heartbeat(self):
+        """
+        Renews the lease on every unfinished task owned by this process.
+        """
+        if self.owner is None:
+            return
+        placeholders = ', '.join('?' for _ in TERMINAL_STATUSES)
+        with self._connection() as conn:
+            conn.execute(
+                f'UPDATE tasks SET heartbeat = ? WHERE owner = ? AND status NOT IN ({placeholders})',
+                (time.time(), self.owner, *TERMINAL_STATUSES),
+            )
+
+    def fail_abandoned(self, include_unowned=False):
+        """
+        Fails unfinished tasks whose owner stopped renewing their lease.
+        With include_unowned, queued tasks without an owner are failed too
+        (when no external worker will ever claim them).
+        Returns how many tasks were failed.
+        """
+        conn = self._connection()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            return self._fail_abandoned(conn, include_unowned=include_unowned)
+
+    def _fail_abandoned(self, conn, where='1', params=(), include_unowned=False):
+        placeholders = ', '.join('?' for _ in TERMINAL_STATUSES)
+        unowned = ' OR owner IS NULL' if include_unowned else ''
+        now = time.time()
+        cursor = conn.execute(
+            f"UPDATE tasks SET status = 'failed', error = 'The server stopped before finishing this download',"
+            f' updated_at = ?, version = version + 1'
+            f' WHERE {where} AND status NOT IN ({placeholders})'
+            f' AND ((owner IS NOT NULL AND heartbeat < ?){unowned})',
+            (now, *params, *TERMINAL_STATUSES, now - self.lease),
+        )
+        return cursor.rowcount
+
+    def _insert(self, conn, record):
+        columns = TaskRecord.__slots__ + ('owner', 'heartbeat')
+        # Unfinished tasks are leased to this process, unless they wait for the external worker
+        owner = self.owner if record.status not in TERMINAL_STATUSES else None
+        placeholders = ', '.join('?' for _ in columns)
+        conn.execute(
+            f'INSERT OR REPLACE INTO tasks ({", ".join(columns)}) VALUES ({placeholders})',
+            (*(getattr(record, field) for field in TaskRecord.__slots__), owner, time.time()),
+        )
+
+    def get(self, task_id):
+        row = self._fetch(task_id)
+        return self._to_dict(row) if row else None
+
+    def active_task(self, artifact_key):
+        placeholders = ', '.join('?' for _ in TERMINAL_STATUSES)
+        row = self._connection().execute(
+            f'SELECT task_id FROM tasks WHERE artifact_key = ? AND status NOT IN ({placeholders}) LIMIT 1',
+            (artifact_key, *TERMINAL_STATUSES),
+        ).fetchone()
+        return row['task_id'] if row else None
+
+    def get_many(self, task_ids):
+        tasks = {}
+        task_ids = list(task_ids)
+        conn = self._connection()
+        # Stay well below SQLite's limit on the number of query parameters
+        for start in range(0, len(task_ids), 500):
+            chunk = task_ids[start:start + 500]
+            placeholders = ', '.join('?' for _ in chunk)
+            for row in conn.execute(f'SELECT * FROM tasks WHERE task_id IN ({placeholders})', chunk):
+                tasks[row['task_id']] = self._to_dict(row)
+        return tasks
+
+    def create_batch(self, batch_id, task_ids, title=None):
+        conn = self._connection()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute(
+                'INSERT INTO batches (batch_id, title, created_at) VALUES (?, ?, ?)',
+                (batch_id, title, time.time()),
+            )
+            conn.executemany(
+                'INSERT INTO batch_tasks (batch_id, position, task_id) VALUES (?, ?, ?)',
+                [(batch_id, position, task_id) for position, task_id in enumerate(task_ids)],
+            )
+
+    def get_batch(self, batch_id):
+        conn = self._connection()
+        row = conn.execute('SELECT title FROM batches WHERE batch_id = ?', (batch_id,)).fetchone()
+        if row is None:
+            return None
+        task_ids = [r['task_id'] for r in conn.execute(
+            'SELECT task_id FROM batch_tasks WHERE batch_id = ? ORDER BY position', (batch_id,)
+        )]
+        return {'title': row['title'], 'task_ids': task_ids}
+
+    def update(self, task_id, **fields):
+        for field in fields:
+            if field not in TaskRecord.UPDATABLE_FIELDS:
+                raise ValueError(f"Unknown task field: {field}")
+        assignments = ''.join(f'{field} = ?, ' for field in fields)
+        with self._connection() as conn:
+            now = time.time()
+            cursor = conn.execute(
+                f'UPDATE tasks SET {assignments}updated_at = ?, version = version + 1'
+                " WHERE task_id = ? AND status NOT IN ('cancelling', 'cancelled')",
+                (*fields.values(), now, task_id),
+            )
+            if cursor.rowcount == 0 and fields.get('status') in TERMINAL_STATUSES:
+                cursor = conn.execute(
+                    "UPDATE tasks SET status = 'cancelled', stage = 'done', owner = NULL,"
+                    " updated_at = ?, version = version + 1 WHERE task_id = ? AND status = 'cancelling'",
+                    (now, task_id),
+                )
+            return cursor.rowcount > 0
+
+    def cancel(self, task_id, client=None):
+        conn = self._connection()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute('SELECT status, client, owner FROM tasks WHERE task_id = ?', (task_id,)).fetchone()
+            if row is None or row['status'] in TERMINAL_STATUSES:
+                return row['status'] if row else None
+            if client is not None and row['client'] != client:
+                raise PermissionError(task_id)
+            # A queued task nobody has claimed yet has no worker to wait for
+            status = 'cancelled' if row['status'] == 'queued' and row['owner'] is None else 'cancelling'
+            conn.execute(
+                'UPDATE tasks SET status = ?, updated_at = ?, version = version + 1 WHERE task_id = ?',
+                (status, time.time(), task_id),
+            )
+            return row['status']
+
+    def count_queued(self, client=None):
+        conn = self._connection()
+        if client is None:
+            return conn.execute("SELECT COUNT(*) FROM tasks WHERE status = 'queued'").fetchone()[0]
+        return conn.execute(
+            "SELECT COUNT(*) FROM tasks WHERE status = 'queued' AND client = ?", (client,)
+        ).fetchone()[0]
+
+    def wait_for_change(self, task_id, seen_version, timeout):
+        deadline = time.time() + timeout
+        while True:
+            row = self._fetch(task_id)
+            if row is None:
+                return None, None
+            if row['version'] != seen_version or time.time() >= deadline:
+                return row['version'], self._to_dict(row)
+            time.sleep(self.POLL_INTERVAL)
+
+    def expire(self):
+        self.fail_abandoned()
+        cutoff = time.time() - self.ttl
+        placeholders = ', '.join('?' for _ in TERMINAL_STATUSES)
+        with self._connection() as conn:
+            cursor = conn.execute(
+                f'DELETE FROM tasks WHERE status IN ({placeholders}) AND updated_at < ?',
+                (*TERMINAL_STATUSES, cutoff),
+            )
+            removed = cursor.rowcount
+            # Enforce the size bound by dropping the oldest finished tasks
+            overflow = len(self) - self.max_tasks
+            if overflow > 0:
+                cursor = conn.execute(
+                    f'DELETE FROM tasks WHERE task_id IN (SELECT task_id FROM tasks'
+                    f' WHERE status IN ({placeholders}) ORDER BY updated_at LIMIT ?)',
+                    (*TERMINAL_STATUSES, overflow),
+                )
+                removed += cursor.rowcount
+            # A batch goes once all of its tasks have
+            conn.execute(
+                'DELETE FROM batches WHERE created_at < ? AND batch_id NOT IN'
+                ' (SELECT bt.batch_id FROM batch_tasks bt JOIN tasks t ON t.task_id = bt.task_id)',
+                (cutoff,),
+            )
+            conn.execute('DELETE FROM batch_tasks WHERE batch_id NOT IN (SELECT batch_id FROM batches)')
+        return removed
+
+    def __len__(self):
+        return self._connection().execute('SELECT COUNT(*) FROM tasks').fetchone()[0]
+
+    def _fetch(self, task_id):
+        return self._connection().execute(
+            'SELECT * FROM tasks WHERE task_id = ?', (task_id,)
+        ).fetchone()
+
+    @staticmethod
+    def _to_dict(row):
+        return {field: row[field] for field in TaskRecord.PUBLIC_FIELDS}
+
+
+def create_task_store(backend, ttl, max_tasks, db_path=None, lease=60):
+    """
+    Builds the task store selected by configuration ('memory' or 'sqlite').
+    """
+    if backend == 'sqlite':
+        return SQLiteTaskStore(db_path, ttl=ttl, max_tasks=max_tasks, lease=lease)
+    if backend == 'memory':
+        return MemoryTaskStore(ttl=ttl, max_tasks=max_tasks)
+    raise ValueError(f"Unknown TASK_STORE backend: {backend}")
@@ -0,0 +1,16 @@
+# Standalone download worker for production (WORKER_MODE=external).
+# Claims queued downloads from the shared SQLite task store, so the web
+# processes only accept requests and report status. On SIGTERM it stops
+# taking new tasks and waits (up to DRAIN_TIMEOUT) for running ones to finish.
+#
+# Usually started by gunicorn.conf.py; can also be run on its own:
+#   WORKER_MODE=external TASK_STORE=sqlite python worker.py
+import os
+
+os.environ.setdefault('WORKER_MODE', 'external')
+os.environ.setdefault('TASK_STORE', 'sqlite')
+
+from app import run_external_worker
+
+if __name__ == '__main__':
+    run_external_worker()
@@ -0,0 +1,4 @@
+# WSGI entry point for production servers, e.g.:
+#   gunicorn -c gunicorn.conf.py wsgi:app
+# gunicorn.conf.py also starts the download worker (worker.py) next to the web processes.
+from app import app
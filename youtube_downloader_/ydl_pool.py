@@ -0,0 +1,123 @@
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+import yt_dlp
+
+
+class YoutubeDLPool:
+    """
+    Reusable yt_dlp.YoutubeDL instances, grouped by option profile.
+
+    Building a YoutubeDL costs ~100 ms, and a fresh one also starts with
+    cold extractors (YouTube's player code has to be fetched and parsed
+    again) and no open HTTP connections. Instances checked back in keep
+    all of that for the next request with the same options.
+
+    A YoutubeDL is not safe to share between threads, so each instance is
+    lent to one caller at a time; callers that find no idle instance get a
+    new one. At most max_idle instances per profile are kept, and each is
+    retired after max_uses checkouts or max_age seconds so per-instance
+    state (cookies, caches) cannot grow without bound.
+    """
+    def __init__(self, max_idle=4, max_uses=500, max_age=3600):
+        self.max_idle = max_idle
+        self.max_uses = max_uses
+        self.max_age = max_age
+        self._idle = {} # profile key -> [[ydl, created, uses], ...]
+        self._lock = threading.Lock()
+        self._stats = {'created': 0, 'reused': 0, 'retired': 0}
+
+    @staticmethod
+    def profile_key(opts):
+        # Options are plain values (no hooks), so their JSON identifies the profile
+        return json.dumps(opts, sort_keys=True)
+
+    @contextmanager
+    def checkout(self, opts):
+        """
+        Lends a YoutubeDL built with opts for the duration of the block.
+        An instance whose block raised something other than a yt-dlp error
+        may be in a broken state and is closed instead of reused.
+        """
+        key = self.profile_key(opts)
+        entry = self._take(key)
+        broken = False
+        try:
+            yield entry[0]
+        except yt_dlp.utils.YoutubeDLError:
+            raise
+        except BaseException:
+            broken = True
+            raise
+        finally:
+            entry[2] += 1
+            self._give_back(key, entry, broken)
+
+    def prewarm(self, opts, count=1, extractors=('Youtube',)):
+        """
+        Builds count idle instances for opts ahead of the first request,
+        with the given extractors already initialized.
+        """
+        key = self.profile_key(opts)
+        for _ in range(count):
+            entry = self._create(opts)
+            for ie_key in extractors:
+                entry[0].get_info_extractor(ie_key)
+            self._give_back(key, entry, False)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['idle'] = sum(len(idle) for idle in self._idle.values())
+            stats['profiles'] = len(self._idle)
+        checkouts = stats['created'] + stats['reused']
+        stats['reuse_rate'] = round(stats['reused'] / checkouts, 3) if checkouts else None
+        return stats
+
+    def _take(self, key):
+        stale = []
+        entry = None
+        with self._lock:
+            idle = self._idle.get(key, [])
+            while idle:
+                candidate = idle.pop()
+                if self._is_fresh(candidate):
+                    entry = candidate
+                    break
+                stale.append(candidate)
+            if entry is not None:
+                self._stats['reused'] += 1
+        self._retire(stale)
+        if entry is None:
+            entry = self._create(json.loads(key))
+        return entry
+
+    def _create(self, opts):
+        # YoutubeDL fills in its params dict, so give it a copy
+        ydl = yt_dlp.YoutubeDL(dict(opts))
+        with self._lock:
+            self._stats['created'] += 1
+        return [ydl, time.time(), 0]
+
+    def _give_back(self, key, entry, broken):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if not broken and self._is_fresh(entry) and len(idle) < self.max_idle:
+                idle.append(entry)
+                return
+        self._retire([entry])
+
+    def _is_fresh(self, entry):
+        return entry[2] < self.max_uses and time.time() - entry[1] < self.max_age
+
+    def _retire(self, entries):
+        for ydl, _, _ in entries:
+            try:
+                ydl.close()
+            except Exception as e:
+                print(f"Could not close pooled YoutubeDL: {e}")
+        if entries:
+            with self._lock:
+                self._stats['retired'] += len(entries)